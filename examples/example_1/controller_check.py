@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Smoke check of controllers.NeuronController: a single compartment
+Hodgkin-Huxley cell (NEURON's built-in hh mechanism, so that no mechanisms
+need compiling) is built once and simulated for a few candidates, with and
+without a recording spec and abort predicates.
+
+Skipped if NEURON is not installed.
+"""
+
+import sys
+
+import numpy as np
+
+try:
+    from neuron import h
+except ImportError:
+    print("NEURON is not installed, skipping the NeuronController check")
+    sys.exit(0)
+
+from neurotune import controllers
+from neurotune.traces import RecordingSpec
+
+
+class HHCellController(controllers.NeuronController):
+    """
+    A soma with Hodgkin-Huxley channels, whose sodium and potassium
+    conductances are the parameters.
+    """
+
+    default_stimulus = {"delay": 20, "amp": 0.2, "dur": 150}
+
+    def __init__(self):
+        super(HHCellController, self).__init__(sim_time=200, dt=0.025, v_init=-65.0)
+
+    def build_cell(self):
+        self.soma = h.Section(name="soma")
+        self.soma.L = 20
+        self.soma.diam = 20
+        self.soma.insert("hh")
+
+        self.stimulus = h.IClamp(self.soma(0.5))
+
+        return self.soma(0.5)
+
+    def parameter_map(self):
+        return {
+            "gnabar": [(seg.hh, "gnabar_hh") for seg in self.soma],
+            "gkbar": [(seg.hh, "gkbar_hh") for seg in self.soma],
+        }
+
+
+controller = HHCellController()
+parameters = ["gnabar", "gkbar"]
+candidates = [[0.12, 0.036], [0.2, 0.036], [0.0, 0.036]]
+
+# full traces: the cell fires with sodium channels and stays passive without
+simulations_data = controller.run(candidates, parameters)
+for t, v in simulations_data:
+    assert v is not None and len(t) == len(v)
+    assert abs(t[-1] - controller.sim_time) < controller.dt
+assert [bool(np.max(v) > 0) for t, v in simulations_data] == [True, True, False]
+
+# the same candidate gives the same trace on the reused model
+t, v = controller.run(candidates[:1], parameters)[0]
+assert np.array_equal(v, simulations_data[0][1])
+
+# recording spec: only the analysis window is returned, every 0.1 ms
+controller.set_recording_spec(RecordingSpec(50, 150, dt=0.1))
+t, v = controller.run(candidates[:1], parameters)[0]
+assert t[0] >= 50 - 0.05 and t[-1] <= 150 + 0.05
+assert np.allclose(np.diff(t), 0.1)
+assert len(v) == len(t)
+controller.set_recording_spec(None)
+
+# abort predicates: a spiking cell is stopped early, a passive one is not
+controller.add_abort_predicate(controllers.SpikeCountAbove(2))
+t, v = controller.run(candidates[:1], parameters)[0]
+assert v is None and t[-1] < controller.sim_time
+t, v = controller.run(candidates[2:], parameters)[0]
+assert v is not None and abs(t[-1] - controller.sim_time) < controller.dt
+
+print("NeuronController check passed")
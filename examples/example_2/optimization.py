@@ -7,189 +7,103 @@ Automated optimization of simulation of Basket cell
 __version__ = 0.1
 
 from neuron import h
-import neuron
 import numpy as np
 from neurotune import optimizers
 from neurotune import evaluators
+from neurotune import controllers
 from pyelectro import analysis
 import sys
 
 
-class Simulation(object):
+class BasketCellController(controllers.NeuronController):
 
     """
-    Simulation class - inspired by example of Philipp Rautenberg
-
-        Objects of this class control a current clamp simulation. Example of use:
+    This is a canonical example of a controller class
 
-            >>> cell = Cell() #some kind of NEURON section
-            >>> sim = Simulation(cell)
-            >>> sim.go()
-            >>> sim.show()
+    It provides a run() method, this run method must accept at least two parameters:
+        1. candidates (list of list of numbers)
+        2. The corresponding parameters.
 
+    The cell is built once, by build_cell, and each candidate only assigns
+    its channel densities to the segments listed by parameter_map.
     """
 
-    def __init__(self, recording_section, sim_time=1000, dt=0.05, v_init=-60):
-
-        self.recording_section = recording_section
-        self.sim_time = sim_time
-        self.dt = dt
-        self.go_already = False
-        self.v_init = v_init
-
-    def set_IClamp(self, delay=5, amp=0.1, dur=1000):
-        """
-        Initializes values for current clamp.
-
-        Default values:
+    default_stimulus = {"delay": 150, "amp": 0.1, "dur": 750}
 
-          delay = 5 [ms]
-          amp   = 0.1 [nA]
-          dur   = 1000 [ms]
+    def __init__(self):
+        super(BasketCellController, self).__init__(sim_time=1000, dt=0.025, v_init=-70.0)
 
+    def build_cell(self):
         """
-        stim = h.IClamp(self.recording_section(0.5))
-        stim.delay = delay
-        stim.amp = amp
-        stim.dur = dur
-        self.stim = stim
-
-    def set_recording(self):
-        # Record Time
-        self.rec_t = neuron.h.Vector()
-        self.rec_t.record(h._ref_t)
-        # Record Voltage
-        self.rec_v = h.Vector()
-        self.rec_v.record(self.recording_section(0.5)._ref_v)
-
-    def show(self):
+        Make the compartments, connect them and insert their mechanisms
         """
-        Plot the result of the simulation once it's been intialized
-        """
-
-        from matplotlib import pyplot as plt
-
-        if self.go_already:
-            x = np.array(self.rec_t)
-            y = np.array(self.rec_v)
-
-            plt.plot(x, y)
-            plt.title("Simulation voltage vs time")
-            plt.xlabel("Time [ms]")
-            plt.ylabel("Voltage [mV]")
-
-        else:
-            print("""First you have to `go()` the simulation.""")
-        plt.show()
-
-    def go(self, sim_time=None):
-        """
-        Start the simulation once it's been intialized
-        """
-
-        self.set_recording()
-        h.dt = self.dt
-        h.initnrn()
+        self.soma = h.Section(name="soma")
+        self.axon = h.Section(name="axon")
+        self.soma.connect(self.axon)
+
+        for sec in (self.soma, self.axon):
+            sec.insert("na")
+            sec.insert("kv")
+            sec.insert("kv_3")
+            sec.insert("pas")
+            sec.Ra = 300
+            sec.cm = 0.75
+            for seg in sec:
+                seg.pas.g = 1.0 / 30000
+                seg.pas.e = -70
 
-        h.finitialize(self.v_init)
-        h.load_file("stdrun.hoc")
-        if sim_time:
-            h.continuerun(sim_time)
-        else:
-            h.continuerun(self.sim_time)
-        self.go_already = True
+        self.soma.diam = 10
+        self.soma.L = 10
+        self.axon.diam = 2
+        self.axon.L = 100
 
+        # soma.insert('canrgc')
+        # soma.insert('cad2')
 
-class BasketCellController:
+        h.vshift_na = -5.0
 
-    """
-    This is a canonical example of a controller class
+        self.stimulus = h.IClamp(self.soma(0.5))
 
-    It provides a run() method, this run method must accept at least two parameters:
-        1. candidates (list of list of numbers)
-        2. The corresponding parameters.
-    """
+        return self.soma(0.5)
 
-    def run(self, candidates, parameters):
+    def parameter_map(self):
         """
-        Run simulation for each candidate
-
-        This run method will loop through each candidate and run the simulation
-        corresponding to it's parameter values. It will populate an array called
-        traces with the resulting voltage traces for the simulation and return it.
+        The mechanism attributes set by each parameter
         """
 
-        traces = []
-        for candidate in candidates:
-            sim_var = dict(zip(parameters, candidate))
-            t, v = self.run_individual(sim_var)
-            traces.append([t, v])
+        def mechanism_refs(sec, mech, mech_attribute):
+            return [(getattr(seg, mech), mech_attribute) for seg in sec]
 
-        return traces
+        return {
+            "axon_gbar_na": mechanism_refs(self.axon, "na", "gbar"),
+            "axon_gbar_kv": mechanism_refs(self.axon, "kv", "gbar"),
+            "axon_gbar_kv3": mechanism_refs(self.axon, "kv_3", "gbar"),
+            "soma_gbar_na": mechanism_refs(self.soma, "na", "gbar"),
+            "soma_gbar_kv": mechanism_refs(self.soma, "kv", "gbar"),
+            "soma_gbar_kv3": mechanism_refs(self.soma, "kv_3", "gbar"),
+        }
 
-    def set_section_mechanism(self, sec, mech, mech_attribute, mech_value):
+    def run_individual(self, sim_var, show=False, protocol=None):
         """
-        Set the value of an attribute of a NEURON section
-        """
-        for seg in sec:
-            setattr(getattr(seg, mech), mech_attribute, mech_value)
+        Run an individual simulation, optionally plotting its voltage trace.
 
-    def run_individual(self, sim_var, show=False):
+        A neurotune.controllers.Protocol may override the current clamp
+        settings (delay, amp, dur) and the simulation time.
         """
-        Run an individual simulation.
-
-        The candidate data has been flattened into the sim_var dict. The
-        sim_var dict contains parameter:value key value pairs, which are
-        applied to the model before it is simulated.
-
-        The simulation itself is carried out via the instantiation of a
-        Simulation object (see Simulation class above).
-
-        """
-
-        # make compartments and connect them
-        soma = h.Section()
-        axon = h.Section()
-        soma.connect(axon)
-
-        axon.insert("na")
-        axon.insert("kv")
-        axon.insert("kv_3")
-        soma.insert("na")
-        soma.insert("kv")
-        soma.insert("kv_3")
+        t, v = super(BasketCellController, self).run_individual(
+            sim_var, protocol=protocol
+        )
 
-        soma.diam = 10
-        soma.L = 10
-        axon.diam = 2
-        axon.L = 100
+        if show and v is not None:
+            from matplotlib import pyplot as plt
 
-        # soma.insert('canrgc')
-        # soma.insert('cad2')
-
-        self.set_section_mechanism(axon, "na", "gbar", sim_var["axon_gbar_na"])
-        self.set_section_mechanism(axon, "kv", "gbar", sim_var["axon_gbar_kv"])
-        self.set_section_mechanism(axon, "kv_3", "gbar", sim_var["axon_gbar_kv3"])
-        self.set_section_mechanism(soma, "na", "gbar", sim_var["soma_gbar_na"])
-        self.set_section_mechanism(soma, "kv", "gbar", sim_var["soma_gbar_kv"])
-        self.set_section_mechanism(soma, "kv_3", "gbar", sim_var["soma_gbar_kv3"])
-
-        for sec in h.allsec():
-            sec.insert("pas")
-            sec.Ra = 300
-            sec.cm = 0.75
-            self.set_section_mechanism(sec, "pas", "g", 1.0 / 30000)
-            self.set_section_mechanism(sec, "pas", "e", -70)
-
-        h.vshift_na = -5.0
-        sim = Simulation(soma, sim_time=1000, v_init=-70.0)
-        sim.set_IClamp(150, 0.1, 750)
-        sim.go()
-
-        if show:
-            sim.show()
+            plt.plot(t, v)
+            plt.title("Simulation voltage vs time")
+            plt.xlabel("Time [ms]")
+            plt.ylabel("Voltage [mV]")
+            plt.show()
 
-        return np.array(sim.rec_t), np.array(sim.rec_v)
+        return t, v
 
 
 def main(
@@ -0,0 +1,37 @@
+"""
+Check that BatchSchedulerController, which runs the simulations as the
+array tasks of a batch scheduler job (here the processes of a
+LocalScheduler, standing in for SLURM or HTCondor), gives the same fitness
+as running the controller directly.
+"""
+
+import os
+import shutil
+import tempfile
+
+import SineWaveChecks as checks
+
+from neurotune.controllers import BatchSchedulerController, LocalScheduler
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    work_dir = tempfile.mkdtemp(prefix="neurotune_check_")
+    try:
+        scheduler = BatchSchedulerController(
+            swc,
+            LocalScheduler(max_processes=2),
+            candidates_per_job=4,
+            work_dir=work_dir,
+        )
+        fitness = checks.evaluator(scheduler, targets).evaluate(checks.population, {})
+
+        # the job directory is removed once all tasks have succeeded
+        assert os.listdir(work_dir) == []
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    checks.check_same_fitness("BatchSchedulerController", fitness, expected)
@@ -0,0 +1,94 @@
+"""
+Set-up shared by the checks of the evaluation modes (SineWave*Check.py):
+the sine wave model and targets of SineWaveOptimizer.py, a fixed
+population to evaluate, and a comparison of the fitness a mode gives with
+that of the default evaluation.
+"""
+
+import numpy as np
+from pyelectro import analysis
+
+from neurotune import evaluators
+from neurotune.controllers import SineWaveController
+
+sim_vars = {"amp": 65, "period": 250, "offset": -10}
+
+parameters = list(sim_vars.keys())
+
+analysis_var = {
+    "peak_delta": 0,
+    "baseline": 0,
+    "dvdt_threshold": 0,
+    "peak_threshold": 0,
+}
+
+# features available in every evaluation mode
+weights = {
+    "average_minimum": 1.0,
+    "mean_spike_frequency": 1,
+    "average_maximum": 1.0,
+    "min_peak_no": 1,
+    "max_peak_no": 1.0,
+    "first_spike_time": 1.0,
+}
+
+population = [
+    [65, 250, -10],
+    [70, 200, 0],
+    [90, 160, -30],
+    [62, 290, 20],
+    [80, 240, -45],
+    [100, 150, 40],
+]
+
+
+def controller():
+    return SineWaveController(1000, 0.1)
+
+
+def surrogate_targets(swc, sim_vars=sim_vars):
+    """
+    The weighted features of the surrogate model, used as targets.
+    """
+    times, volts = swc.run_individual(sim_vars)
+    results = analysis.IClampAnalysis(
+        volts,
+        times,
+        analysis_var,
+        start_analysis=0,
+        end_analysis=1000,
+        smooth_data=False,
+        show_smoothed_data=False,
+    ).analyse()
+    return dict((target, results[target]) for target in weights)
+
+
+def evaluator(swc, targets, **options):
+    """
+    An IClampEvaluator of the sine waves, with extra options selecting the
+    evaluation mode.
+    """
+    return evaluators.IClampEvaluator(
+        controller=swc,
+        analysis_start_time=0,
+        analysis_end_time=1000,
+        target_data_path="",
+        parameters=parameters,
+        analysis_var=analysis_var,
+        weights=weights,
+        targets=targets,
+        verbose=False,
+        **options,
+    )
+
+
+def check_same_fitness(mode, fitness, expected):
+    """
+    Fail unless the fitness values of a mode match the default evaluation.
+    """
+    print("Default fitness: %s" % expected)
+    print("%s fitness: %s" % (mode, fitness))
+    assert np.allclose(fitness, expected, rtol=1e-9, atol=1e-12), (
+        "%s fitness differs from the default evaluation" % mode
+    )
+    print("%s gives the same fitness as the default evaluation" % mode)
@@ -0,0 +1,48 @@
+"""
+Check that a trace missing a weighted feature gets the worst fitness both
+when its features are analysed in full and lazily (with prune_survivors).
+IClampAnalysis.analyse leaves out the features it fails to compute;
+broadening_index, which it never computes, stands in for one of those.
+"""
+
+import SineWaveChecks as checks
+
+from neurotune import evaluators
+
+
+def missing_feature_evaluator(swc, targets, **options):
+    return evaluators.IClampEvaluator(
+        controller=swc,
+        analysis_start_time=0,
+        analysis_end_time=1000,
+        target_data_path="",
+        parameters=checks.parameters,
+        analysis_var=checks.analysis_var,
+        weights=dict(checks.weights, broadening_index=1.0),
+        targets=dict(targets, broadening_index=1.0),
+        verbose=False,
+        **options,
+    )
+
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+    times, samples = swc.run_individual(checks.sim_vars)
+
+    full = missing_feature_evaluator(swc, targets)
+    fitness = full.score_trace(times, samples)
+    print("Full analysis fitness: %s" % fitness)
+    assert fitness == full.worst_fitness()
+
+    lazy = missing_feature_evaluator(
+        swc, targets, prune_survivors=len(checks.population)
+    )
+    # features are only analysed lazily from the second generation
+    lazy.evaluate(checks.population, {})
+    assert lazy.prune_bound() is not None
+    fitness = lazy.score_trace(times, samples)
+    print("Lazy analysis fitness: %s" % fitness)
+    assert fitness == lazy.worst_fitness()
+
+    print("A missing feature gives the worst fitness in both analyses")
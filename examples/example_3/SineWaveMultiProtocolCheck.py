@@ -0,0 +1,77 @@
+"""
+Check that MultiProtocolEvaluator, which runs the stimulus protocols of a
+fit in parallel worker processes, gives each candidate the sum of the
+fitness the default evaluation gives it under each protocol.
+"""
+
+import SineWaveChecks as checks
+
+from neurotune import evaluators
+from neurotune.controllers import Protocol, SineWaveController
+
+
+class ProtocolSineWaveController(SineWaveController):
+    """
+    Sine waves whose offset is shifted by the "offset" of a protocol's
+    stimulus, by default that of the protocol given to the constructor.
+    """
+
+    def __init__(self, sim_time, dt, protocol=None):
+        super(ProtocolSineWaveController, self).__init__(sim_time, dt)
+        self.protocol = protocol
+
+    def run(self, candidates, parameters, protocol=None):
+        if protocol is None:
+            protocol = self.protocol
+
+        shift = 0
+        if protocol is not None:
+            shift = protocol.stimulus.get("offset", 0)
+
+        offset = list(parameters).index("offset")
+        shifted = []
+        for candidate in candidates:
+            candidate = list(candidate)
+            candidate[offset] += shift
+            shifted.append(candidate)
+
+        return super(ProtocolSineWaveController, self).run(shifted, parameters)
+
+
+if __name__ == "__main__":
+    protocols = [
+        Protocol("rest"),
+        Protocol("depolarised", stimulus={"offset": 15}),
+    ]
+
+    expected = [0.0] * len(checks.population)
+    entries = []
+    for protocol in protocols:
+        swc = ProtocolSineWaveController(1000, 0.1, protocol)
+
+        sim_vars = dict(checks.sim_vars)
+        sim_vars["offset"] += protocol.stimulus.get("offset", 0)
+        evaluator = checks.evaluator(swc, checks.surrogate_targets(swc, sim_vars))
+
+        fitness = evaluator.evaluate(checks.population, {})
+        expected = [total + value for total, value in zip(expected, fitness)]
+        entries.append((protocol, evaluator))
+
+    # no candidate skips a protocol, so that every protocol is scored; the
+    # survivors are simulated one per job, then in uneven chunks
+    for candidates_per_job in (1, 4):
+        multi_protocol = evaluators.MultiProtocolEvaluator(
+            ProtocolSineWaveController(1000, 0.1),
+            checks.parameters,
+            entries,
+            fail_fitness=float("inf"),
+            candidates_per_job=candidates_per_job,
+        )
+        fitness = multi_protocol.evaluate(checks.population, {})
+        multi_protocol.close()
+
+        checks.check_same_fitness(
+            "MultiProtocolEvaluator (%i candidates per job)" % candidates_per_job,
+            fitness,
+            expected,
+        )
@@ -0,0 +1,69 @@
+"""
+Check that a trace whose PPTD error cannot be computed only gets the worst
+cost for its pptd_error target, rather than being treated as
+non-analysable, when its features are analysed in full, lazily (with
+prune_survivors) or in batch (vectorized_analysis).
+"""
+
+import SineWaveChecks as checks
+
+from neurotune import evaluators
+
+
+class FailingDensity(object):
+    """
+    A target phase plane density whose error cannot be computed.
+    """
+
+    def error(self, t, v):
+        raise ValueError("no PPTD error")
+
+    def errors(self, t, volts):
+        raise ValueError("no PPTD error")
+
+
+class FailingPPTDEvaluator(evaluators.IClampEvaluator):
+    def pptd_density(self):
+        return FailingDensity()
+
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    # pptd_error adds its full weight to the fitness of every trace, which
+    # is the worst fitness of the non-analysable ones already
+    expected = [
+        fitness + 1.0
+        for fitness in checks.evaluator(swc, targets).evaluate(checks.population, {})
+    ]
+
+    pptd_targets = dict(targets, pptd_error=0.0)
+    pptd_weights = dict(checks.weights, pptd_error=1.0)
+
+    for mode, options in [
+        ("Full analysis", {}),
+        ("Lazy analysis", {"prune_survivors": len(checks.population)}),
+        ("Vectorized analysis", {"vectorized_analysis": True}),
+    ]:
+        evaluator = FailingPPTDEvaluator(
+            controller=swc,
+            analysis_start_time=0,
+            analysis_end_time=1000,
+            target_data_path="",
+            parameters=checks.parameters,
+            analysis_var=checks.analysis_var,
+            weights=pptd_weights,
+            targets=pptd_targets,
+            verbose=False,
+            **options,
+        )
+        fitness = evaluator.evaluate(checks.population, {})
+        if "prune_survivors" in options:
+            # features are only analysed lazily from the second generation
+            assert evaluator.prune_bound() is not None
+            fitness = evaluator.evaluate(checks.population, {})
+
+        checks.check_same_fitness(
+            "%s with a failing PPTD error" % mode, fitness, expected
+        )
@@ -0,0 +1,26 @@
+"""
+Check that ParallelContextController, which farms the simulations out over
+MPI ranks through NEURON's bulletin board, gives the same fitness as
+running the controller directly.
+
+Without NEURON or MPI the simulations run in this process; to check the
+bulletin board, run e.g. ``mpiexec -n 3 python SineWaveParallelContextCheck.py``.
+"""
+
+import SineWaveChecks as checks
+
+from neurotune.controllers import ParallelContextController
+
+if __name__ == "__main__":
+    swc = checks.controller()
+
+    # worker ranks stay in the constructor, running jobs, until close()
+    parallel = ParallelContextController(swc)
+
+    targets = checks.surrogate_targets(swc)
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    fitness = checks.evaluator(parallel, targets).evaluate(checks.population, {})
+    parallel.close()
+
+    checks.check_same_fitness("ParallelContextController", fitness, expected)
@@ -0,0 +1,27 @@
+"""
+Check that RacingEvaluator, which re-evaluates the candidates whose rank
+around the selection cutoff is uncertain and returns their mean fitness,
+gives the same fitness as a single evaluation of a deterministic model.
+"""
+
+import SineWaveChecks as checks
+
+from neurotune import evaluators
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    racing = evaluators.RacingEvaluator(
+        checks.evaluator(swc, targets), cutoff=2, max_samples=3
+    )
+    fitness = racing.evaluate(checks.population, {})
+
+    # candidates near the cutoff were evaluated again, none too often
+    samples = [racing.statistics(candidate)[0] for candidate in checks.population]
+    print("Evaluations of each candidate: %s" % samples)
+    assert max(samples) > 1 and max(samples) <= 3
+
+    checks.check_same_fitness("RacingEvaluator", fitness, expected)
@@ -0,0 +1,18 @@
+"""
+Check that streaming mode (stream_chunk_time), which analyses the traces
+chunk by chunk as the controller produces them, gives the same fitness as
+analysing whole traces.
+"""
+
+import SineWaveChecks as checks
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    streaming = checks.evaluator(swc, targets, stream_chunk_time=100)
+    fitness = streaming.evaluate(checks.population, {})
+
+    checks.check_same_fitness("Streaming mode", fitness, expected)
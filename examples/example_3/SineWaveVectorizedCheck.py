@@ -0,0 +1,18 @@
+"""
+Check that vectorized analysis (vectorized_analysis=True), which detects
+the spikes of the whole population at once with NumPy, gives the same
+fitness as pyelectro's IClampAnalysis of each trace.
+"""
+
+import SineWaveChecks as checks
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    vectorized = checks.evaluator(swc, targets, vectorized_analysis=True)
+    fitness = vectorized.evaluate(checks.population, {})
+
+    checks.check_same_fitness("Vectorized analysis", fitness, expected)
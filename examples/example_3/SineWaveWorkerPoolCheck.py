@@ -0,0 +1,49 @@
+"""
+Check that a WorkerPoolController whose workers are replaced after
+maxtasksperchild candidates gives the same fitness as simulating in the
+main process, and that its workers were actually replaced.
+"""
+
+import functools
+import os
+import shutil
+import tempfile
+
+import SineWaveChecks as checks
+
+from neurotune.controllers import WorkerPoolController
+
+
+def record_worker(directory, controller):
+    """
+    Worker setup leaving a file named after the worker's process id.
+    """
+    open(os.path.join(directory, str(os.getpid())), "w").close()
+
+
+if __name__ == "__main__":
+    swc = checks.controller()
+    targets = checks.surrogate_targets(swc)
+
+    expected = checks.evaluator(swc, targets).evaluate(checks.population, {})
+
+    directory = tempfile.mkdtemp()
+    pool = WorkerPoolController(
+        swc,
+        processes=2,
+        setup=functools.partial(record_worker, directory),
+        preload=("neurotune.controllers", "pyelectro.analysis", "SineWaveChecks"),
+        maxtasksperchild=1,
+    )
+    try:
+        fitness = checks.evaluator(pool, targets).evaluate(checks.population, {})
+    finally:
+        pool.close()
+    workers = os.listdir(directory)
+    shutil.rmtree(directory)
+
+    checks.check_same_fitness("Worker pool", fitness, expected)
+
+    print("%i worker processes started" % len(workers))
+    assert len(workers) > pool.processes, "the workers were not replaced"
+    print("The workers were replaced after maxtasksperchild candidates")
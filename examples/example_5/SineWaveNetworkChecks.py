@@ -0,0 +1,92 @@
+"""
+Set-up shared by the checks of the network evaluation modes
+(SineWaveNetwork*Check.py): the network and targets of
+SineWaveNetworkOptimizer.py, a fixed population to evaluate, and a
+comparison of the fitness a mode gives with that of the default evaluation.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from pyelectro import analysis
+from SineWaveNetworkController import SineWaveNetworkController
+
+from neurotune import evaluators
+
+sim_vars = OrderedDict(
+    [
+        ("amp", 15),
+        ("amp_increment", 5),
+        ("period", 125),
+        ("period_increment", 50),
+        ("offset", 10),
+    ]
+)
+
+parameters = list(sim_vars.keys())
+
+analysis_var = {
+    "peak_delta": 0,
+    "baseline": 0,
+    "dvdt_threshold": 0,
+    "peak_threshold": 0,
+}
+
+weights = {
+    "wave_0:average_maximum": 1,
+    "wave_0:average_minimum": 1,
+    "wave_0:mean_spike_frequency": 10,
+    "wave_1:average_maximum": 1,
+    "wave_1:average_minimum": 1,
+    "wave_1:mean_spike_frequency": 10,
+}
+
+population = [
+    [15, 5, 125, 50, 10],
+    [10, 0, 100, 20, 0],
+    [20, 15, 200, 100, -10],
+    [5, 10, 60, 150, 12],
+]
+
+
+def controller():
+    return SineWaveNetworkController("wave", 2)
+
+
+def surrogate_targets(swc):
+    """
+    The weighted features of the surrogate network, used as targets.
+    """
+    times, volts = swc.run_individual(sim_vars)
+    return analysis.NetworkAnalysis(
+        volts, times, analysis_var, start_analysis=0, end_analysis=1000
+    ).analyse(weights.keys())
+
+
+def evaluator(swc, targets, **options):
+    """
+    A NetworkEvaluator of the sine waves, with extra options selecting the
+    evaluation mode.
+    """
+    return evaluators.NetworkEvaluator(
+        controller=swc,
+        analysis_start_time=0,
+        analysis_end_time=1000,
+        parameters=parameters,
+        analysis_var=analysis_var,
+        weights=weights,
+        targets=targets,
+        **options,
+    )
+
+
+def check_same_fitness(mode, fitness, expected):
+    """
+    Fail unless the fitness values of a mode match the default evaluation.
+    """
+    print("Default fitness: %s" % expected)
+    print("%s fitness: %s" % (mode, fitness))
+    assert np.allclose(fitness, expected, rtol=1e-9, atol=1e-12), (
+        "%s fitness differs from the default evaluation" % mode
+    )
+    print("%s gives the same fitness as the default evaluation" % mode)
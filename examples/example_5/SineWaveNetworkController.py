@@ -1,13 +1,34 @@
 import math
 
-import numpy as np
+from neurotune.traces import TraceBatch
 
 
 class SineWaveNetworkController:
+
+    sim_time = 1000
+    dt = 0.1
+
     def __init__(self, population_id, pop_num):
         self.population_id = population_id
         self.pop_num = pop_num
 
+    def times(self):
+        """
+        Sample times shared by all simulations.
+        """
+        t = 0
+        times = []
+        while t <= self.sim_time:
+            times.append(t)
+            t += self.dt
+        return times
+
+    def channels(self):
+        """
+        References of the population members, one channel each.
+        """
+        return ["%s_%i" % (self.population_id, i) for i in range(self.pop_num)]
+
     def run_individual(self, sim_var, gen_plot=False, show_plot=True, prefix=""):
         """
         Run an individual simulation.
@@ -18,16 +39,13 @@ class SineWaveNetworkController:
 
         """
         print(">> Running individual: %s" % (sim_var))
-        sim_time = 1000
-        dt = 0.1
-        t = 0
-        times = []
+        times = self.times()
         volts = {}
 
         for i in range(self.pop_num):
             volts["%s_%i" % (self.population_id, i)] = []
 
-        while t <= sim_time:
+        for t in times:
             for i in range(self.pop_num):
                 period = max(sim_var["period"] + i * sim_var["period_increment"], 1)
                 v = sim_var["offset"] + (
@@ -37,9 +55,6 @@ class SineWaveNetworkController:
 
                 volts["%s_%i" % (self.population_id, i)].append(v)
 
-            times.append(t)
-            t += dt
-
         if gen_plot:
 
             from matplotlib import pyplot as plt
@@ -67,17 +82,18 @@ class SineWaveNetworkController:
         Run simulation for each candidate
 
         This run method will loop through each candidate and run the simulation
-        corresponding to its parameter values. It will populate an array called
-        traces with the resulting voltage traces for the simulation and return it.
+        corresponding to its parameter values. The resulting voltage traces of
+        all population members are returned as one TraceBatch, with a channel
+        per population member.
         """
 
-        traces = []
-        for candidate in candidates:
+        batch = TraceBatch.empty(len(candidates), self.times(), self.channels())
+        for index, candidate in enumerate(candidates):
             sim_var = dict(zip(parameters, candidate))
             t, v = self.run_individual(sim_var)
-            traces.append([t, v])
+            batch.set_trace(index, v)
 
-        return traces
+        return batch
 
 
 if __name__ == "__main__":
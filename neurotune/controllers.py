@@ -8,7 +8,27 @@ parameters and chromosomes and (usually) returns
 corresponding simulation data.
 This is implemented polymporphically in subclasses.
 Each controller class must therefore provide a run method, which is used by
-the evaluator to run a simulation.
+the evaluator to run a simulation. Controllers returning traces may also
+provide a run_iter method, which yields each candidate's trace as soon as
+its simulation has finished so that the evaluator can analyse it while the
+remaining simulations are still running.
+
+Evaluators can register abort predicates (see AbortPredicate) with a
+controller; controllers supporting them check the predicates periodically
+while integrating and stop a simulation as soon as one of them is tripped.
+Such a simulation is returned with None in place of its samples, and the
+evaluator assigns the candidate the worst possible fitness.
+
+Controllers also provide run_async, an asynchronous counterpart of run
+awaited by the evaluators' evaluate_async.
+
+Controllers able to hand back traces piecewise while simulating provide
+run_chunked, which evaluators in streaming mode use to accumulate features
+chunk by chunk.
+
+Evaluators also publish a traces.RecordingSpec (analysis window, sampling
+interval and channels) to controllers offering set_recording_spec, so that
+only the data which will be analysed is recorded and returned.
 
 A controller must be able to accept simulation parameters (chromosomes)
 from the evaluator.
@@ -21,10 +41,141 @@ reutrn sample and time arrays for arbitrary chromosome and parameter
 lists a range of evaluators would be able to utilise it.
 """
 
+import asyncio
+import copy
+import json
+import math
+import multiprocessing
 import os
+import pickle
+import queue
+import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
 
-import math
+import numpy as np
+
+from neurotune.traces import TraceBatch, unlink_shared_trace, write_shared_trace
+
+
+class AbortPredicate(object):
+    """
+    Base class for cheap checks run periodically during a simulation.
+
+    A predicate is called with the times and voltages simulated since the
+    previous check and returns True if the simulation should be stopped.
+    reset() is called before each simulation, so predicates may keep state
+    between calls.
+    """
+
+    def reset(self):
+        pass
+
+    def __call__(self, times, volts):
+        raise NotImplementedError("Valid abort predicate requires __call__ method!")
+
+
+class SpikeCountAbove(AbortPredicate):
+    """
+    Abort once more than max_spikes upward crossings of threshold have occurred.
+    """
+
+    def __init__(self, max_spikes, threshold=0.0):
+        self.max_spikes = max_spikes
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.spikes = 0
+        self.above = False
+
+    def __call__(self, times, volts):
+        above = np.asarray(volts) >= self.threshold
+        if len(above) == 0:
+            return False
+        self.spikes += int(np.count_nonzero(above[1:] & ~above[:-1]))
+        self.spikes += int(above[0] and not self.above)
+        self.above = bool(above[-1])
+        return self.spikes > self.max_spikes
+
+
+class NoSpikesBy(AbortPredicate):
+    """
+    Abort if the voltage has not reached threshold by time spike_time.
+    """
+
+    def __init__(self, spike_time, threshold=0.0):
+        self.spike_time = spike_time
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.spiked = False
+
+    def __call__(self, times, volts):
+        if len(volts) == 0:
+            return False
+        self.spiked = self.spiked or bool(np.max(volts) >= self.threshold)
+        return not self.spiked and times[-1] >= self.spike_time
+
+
+class VoltageOutOfRange(AbortPredicate):
+    """
+    Abort as soon as the voltage leaves [v_min, v_max], e.g. on depolarisation
+    block or numerical instability.
+    """
+
+    def __init__(self, v_min=-150.0, v_max=100.0):
+        self.v_min = v_min
+        self.v_max = v_max
+
+    def __call__(self, times, volts):
+        if len(volts) == 0:
+            return False
+        volts = np.asarray(volts)
+        return bool(
+            np.min(volts) < self.v_min
+            or np.max(volts) > self.v_max
+            or np.isnan(volts).any()
+        )
+
+
+class Protocol(object):
+    """
+    Description of a stimulus protocol, passed to a controller's run method
+    as protocol=... by evaluators fitting several protocols (see
+    evaluators.MultiProtocolEvaluator).
+
+    :param name: name of the protocol, e.g. "IClamp 150pA"
+    :param stimulus: dict of stimulus settings, interpreted by the
+        controller; for a current clamp e.g. {"delay": 150, "amp": 0.15, "dur": 750}
+    :param sim_time: simulated time (ms); None for the controller's default
+    :param cost: estimated relative cost of the protocol, used to run the
+        cheapest protocol first; defaults to sim_time (or 1)
+    """
+
+    def __init__(self, name, stimulus=None, sim_time=None, cost=None):
+
+        self.name = name
+        self.stimulus = {} if stimulus is None else dict(stimulus)
+        self.sim_time = sim_time
+        if cost is None:
+            cost = 1.0 if sim_time is None else sim_time
+        self.cost = cost
+
+    def __repr__(self):
+        return "Protocol(%r, stimulus=%s, sim_time=%s)" % (
+            self.name,
+            self.stimulus,
+            self.sim_time,
+        )
 
 
 class __Controller:
@@ -32,36 +183,437 @@ class __Controller:
     Controller base class
     """
 
+    #: predicates checked during each simulation, see add_abort_predicate
+    abort_predicates = ()
+
+    #: simulated time (ms) between checks of the abort predicates
+    abort_check_interval = 50.0
+
+    #: traces.RecordingSpec published by the evaluator, see set_recording_spec
+    recording_spec = None
+
+    def set_recording_spec(self, recording_spec):
+        """
+        Tell the controller which part of the traces the evaluator needs,
+        as a traces.RecordingSpec (or None for everything). Controllers
+        should only record and return that part, although returning more
+        is not an error.
+        """
+        self.recording_spec = recording_spec
+
+    async def run_async(self, candidates, parameters):
+        """
+        Asynchronous counterpart of run, awaited by the evaluators'
+        evaluate_async. This default runs run in the event loop's default
+        executor; controllers wrapping subprocesses, sockets or remote
+        simulators can override it to await their simulations instead of
+        blocking a thread on each.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.run, candidates, parameters)
+
+    def add_abort_predicate(self, predicate):
+        """
+        Register an AbortPredicate to be checked during each simulation.
+        """
+        self.abort_predicates = list(self.abort_predicates) + [predicate]
+
+    def _reset_abort_predicates(self):
+        for predicate in self.abort_predicates:
+            predicate.reset()
+
+    def _should_abort(self, times, volts):
+        """
+        Check the abort predicates against the newest part of the trace.
+        """
+        return any(predicate(times, volts) for predicate in self.abort_predicates)
+
     def run(self, candidates, parameters):
         """
         At a high level - accepts a list of parameters and chromosomes
         and (usually) returns corresponding simulation data. This is
         implemented polymporphically in subclasses.
+
+        Controllers supporting several stimulus protocols also accept a
+        protocol keyword argument (a Protocol, or None for their default
+        stimulus).
         """
         raise NotImplementedError("Valid controller requires run method!")
 
+    def run_iter(self, candidates, parameters):
+        """
+        Run the simulations and yield (index, times, samples) for each
+        candidate, where index is the position of the candidate in candidates.
+
+        Traces may be yielded in any order. This default implementation waits
+        for run to return the whole batch; controllers which can hand back
+        traces as they complete should override it.
+        """
+        for index, data in enumerate(self.run(candidates, parameters)):
+            yield index, data[0], data[1]
+
+    def run_chunked(self, candidates, parameters, chunk_time):
+        """
+        Run the simulations and yield each candidate's trace in consecutive
+        chunks of about chunk_time ms, as (index, times, samples, last),
+        where last flags the final chunk of a candidate. Chunks of different
+        candidates may be interleaved, but each candidate's chunks come in
+        order. An aborted simulation ends with a chunk whose samples are None.
+
+        This lets evaluators analyse very long simulations without holding
+        whole traces (see features.StreamingIClampAnalysis). This default
+        implementation yields each whole trace as a single chunk.
+        """
+        for index, times, samples in self.run_iter(candidates, parameters):
+            yield index, times, samples, True
+
+
+def _run_command(args, stdout_path, stderr_path, timeout=None):
+    """
+    Run a command without a shell, writing its output to stdout_path and
+    stderr_path. Return False if it was killed after timeout seconds.
+    """
+    with open(stdout_path, "w") as stdout, open(stderr_path, "w") as stderr:
+        try:
+            subprocess.run(args, stdout=stdout, stderr=stderr, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+    return True
+
 
 class CLIController(__Controller):
     """
-    Control simulations via command line arguments executed through the Python os module.
+    Control simulations via command line arguments.
+
+    Each candidate is run as ``cli_argument fitness_file gene1 gene2 ...``
+    (without a shell), the command being expected to write the candidate's
+    fitness to fitness_file. Up to max_processes commands run concurrently,
+    each with its own fitness file and its stdout and stderr captured to
+    <fitness_filename>.<index>.out and .err. Once all have finished the
+    fitness values are appended to fitness_filename in candidate order, so
+    it reads as if the candidates had been run one after another.
+
+    :param cli_argument: the command, as a string (split like a shell would)
+        or a list of arguments
+    :param max_processes: maximum number of commands running at once
+    :param timeout: seconds after which a command is killed; None for no limit
+    :param fail_fitness: fitness recorded for candidates which time out or
+        do not report a fitness; if None, a RuntimeError is raised instead
     """
 
-    def __init__(self, cli_argument):
-        self.cli_argument = cli_argument
+    def __init__(self, cli_argument, max_processes=1, timeout=None, fail_fitness=None):
+        if isinstance(cli_argument, str):
+            cli_argument = shlex.split(cli_argument)
+        self.cli_argument = list(cli_argument)
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self.fail_fitness = fail_fitness
+
+    def command(self, chromosome, fitness_filename):
+        """
+        Return the argument list running one candidate.
+        """
+        return self.cli_argument + [fitness_filename] + [str(e) for e in chromosome]
+
+    def _candidate_files(self, candidates, fitness_filename):
+        candidate_files = [
+            "%s.%i" % (fitness_filename, index) for index in range(len(candidates))
+        ]
+        for file_name in candidate_files:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        return candidate_files
+
+    def _collect_fitness(self, candidate_files, completed, fitness_filename):
+        """
+        Append the candidates' fitness values to fitness_filename, in order.
+        """
+        fitness = []
+        failed = []
+        for index, file_name in enumerate(candidate_files):
+            value = ""
+            if os.path.exists(file_name):
+                with open(file_name) as fitness_file:
+                    value = fitness_file.read().strip()
+                os.remove(file_name)
+            if not completed[index] or not value:
+                if self.fail_fitness is None:
+                    failed.append(index)
+                    continue
+                value = str(self.fail_fitness)
+            fitness.append(value)
+
+        if failed:
+            raise RuntimeError(
+                "Candidates %s timed out or reported no fitness, see %s.<index>.err"
+                % (failed, fitness_filename)
+            )
+
+        with open(fitness_filename, "a") as fitness_file:
+            for value in fitness:
+                fitness_file.write(value + "\n")
 
     def run(self, candidates, parameters, fitness_filename="evaluations"):
 
         # "Run simulation"
 
-        for chromosome in candidates:
-            self.chromosome = chromosome
-            self.parameters = parameters  # actually unneeded
-            # this manipulation is slightly messy, done for conversion of chromosome
-            # into something that can be executed on the shell
-            chromosome_str = "".join(str(e) + " " for e in chromosome)
-            cla = self.cli_argument + " " + fitness_filename + " " + chromosome_str
-            print(cla)
-            subprocess.call(cla, shell=True)
+        candidate_files = self._candidate_files(candidates, fitness_filename)
+
+        with ThreadPoolExecutor(max_workers=self.max_processes) as pool:
+            futures = []
+            for chromosome, file_name in zip(candidates, candidate_files):
+                args = self.command(chromosome, file_name)
+                print(" ".join(args))
+                futures.append(
+                    pool.submit(
+                        _run_command,
+                        args,
+                        file_name + ".out",
+                        file_name + ".err",
+                        self.timeout,
+                    )
+                )
+            completed = [future.result() for future in futures]
+
+        self._collect_fitness(candidate_files, completed, fitness_filename)
+
+    async def run_async(self, candidates, parameters, fitness_filename="evaluations"):
+        """
+        Asynchronous counterpart of run: the commands are awaited on the
+        event loop rather than each blocking a thread.
+        """
+        candidate_files = self._candidate_files(candidates, fitness_filename)
+        semaphore = asyncio.Semaphore(self.max_processes)
+
+        async def run_command(chromosome, file_name):
+            async with semaphore:
+                args = self.command(chromosome, file_name)
+                print(" ".join(args))
+                with open(file_name + ".out", "w") as stdout, open(
+                    file_name + ".err", "w"
+                ) as stderr:
+                    process = await asyncio.create_subprocess_exec(
+                        *args, stdout=stdout, stderr=stderr
+                    )
+                    try:
+                        await asyncio.wait_for(process.wait(), self.timeout)
+                    except asyncio.TimeoutError:
+                        process.kill()
+                        await process.wait()
+                        return False
+                return True
+
+        completed = await asyncio.gather(
+            *[
+                run_command(chromosome, file_name)
+                for chromosome, file_name in zip(candidates, candidate_files)
+            ]
+        )
+
+        self._collect_fitness(candidate_files, completed, fitness_filename)
+
+
+class _CLIWorker(object):
+    """
+    A long-running simulator process answering one request line with one
+    reply line.
+    """
+
+    def __init__(self, args, stderr_path):
+        self.args = args
+        self.stderr_path = stderr_path
+        self.process = None
+        self._stderr = None
+
+    def start(self):
+        self._stderr = open(self.stderr_path, "a")
+        self.process = subprocess.Popen(
+            self.args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+    def request(self, line, timeout=None):
+        """
+        Send a request and return the reply, or None if the worker died or
+        did not answer within timeout seconds, in which case it is stopped.
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self.process.kill)
+            timer.start()
+        try:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline()
+        except OSError:
+            reply = ""
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if reply == "":
+            self.stop()
+            return None
+        return reply.strip()
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+
+
+class PersistentCLIController(CLIController):
+    """
+    Run candidates on max_processes long-running simulator processes,
+    started once and reused across generations, so that the simulator's
+    start-up (e.g. loading the model) is paid once per worker rather than
+    once per candidate.
+
+    Each worker is started as cli_argument and reads candidates from its
+    stdin, one per line, as the space separated values of their genes. For
+    each candidate it writes a single line on its stdout: the fitness, or,
+    with results="trace", a JSON list [times, samples]. Anything else the
+    worker prints must go to stderr, which is appended to
+    <log_prefix>.<worker>.err.
+
+    A worker which exits, or does not answer within timeout seconds, is
+    restarted and the candidate retried, up to max_retries times (the
+    timeout of the first candidate sent to a worker includes its start-up,
+    so it must allow for loading the model). After
+    that the candidate gets fail_fitness (or raises a RuntimeError if it
+    is None); trace results come back with None samples, as aborted
+    simulations. Call close() to stop the workers.
+
+    :param results: "fitness" or "trace"
+    """
+
+    def __init__(
+        self,
+        cli_argument,
+        max_processes=1,
+        timeout=None,
+        fail_fitness=None,
+        results="fitness",
+        max_retries=1,
+        log_prefix="worker",
+    ):
+        super(PersistentCLIController, self).__init__(
+            cli_argument, max_processes, timeout, fail_fitness
+        )
+
+        if results not in ("fitness", "trace"):
+            raise ValueError("results must be 'fitness' or 'trace', not %s" % results)
+        self.results = results
+        self.max_retries = max_retries
+        self.log_prefix = log_prefix
+
+        self._workers = None
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _start_workers(self):
+        with self._lock:
+            if self._workers is None:
+                self._workers = [
+                    _CLIWorker(self.cli_argument, "%s.%i.err" % (self.log_prefix, k))
+                    for k in range(self.max_processes)
+                ]
+                for worker in self._workers:
+                    self._idle.put(worker)
+
+    def close(self):
+        """
+        Stop the worker processes; they are restarted by the next run.
+        """
+        with self._lock:
+            if self._workers is not None:
+                for worker in self._workers:
+                    worker.stop()
+                self._workers = None
+                self._idle = queue.Queue()
+
+    def _run_candidate(self, chromosome):
+        """
+        Return the reply of a worker for one candidate, or None if it failed.
+        """
+        line = " ".join(repr(float(e)) for e in chromosome)
+
+        for attempt in range(self.max_retries + 1):
+            worker = self._idle.get()
+            try:
+                reply = worker.request(line, self.timeout)
+            finally:
+                self._idle.put(worker)
+            if reply is not None:
+                break
+            print(">> Worker failed on %s, restarting it" % line)
+        else:
+            return None
+
+        try:
+            if self.results == "trace":
+                times, samples = json.loads(reply)
+                return [times, samples]
+            return float(reply)
+        except ValueError:
+            print(">> Unexpected reply to %s: %s" % (line, reply))
+            return None
+
+    def run(self, candidates, parameters, fitness_filename=None):
+        """
+        Run the candidates on the workers and return their fitness values
+        (or [times, samples] pairs) in candidate order. Fitness values are
+        also appended to fitness_filename if it is given, as CLIController
+        does.
+        """
+        self._start_workers()
+
+        with ThreadPoolExecutor(max_workers=self.max_processes) as pool:
+            replies = list(pool.map(self._run_candidate, candidates))
+
+        if self.results == "trace":
+            return [[[], None] if reply is None else reply for reply in replies]
+
+        failed = [index for index, reply in enumerate(replies) if reply is None]
+        if failed and self.fail_fitness is None:
+            raise RuntimeError(
+                "Candidates %s got no fitness from the workers, see %s.<worker>.err"
+                % (failed, self.log_prefix)
+            )
+        fitness = [self.fail_fitness if reply is None else reply for reply in replies]
+
+        if fitness_filename is not None:
+            with open(fitness_filename, "a") as fitness_file:
+                for value in fitness:
+                    fitness_file.write("%s\n" % value)
+
+        return fitness
+
+    async def run_async(self, candidates, parameters, fitness_filename=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.run, candidates, parameters, fitness_filename
+        )
 
 
 class NrnProject(__Controller):
@@ -113,352 +665,1141 @@ class NrnProject(__Controller):
         return exp_data_array
 
 
-class __CondorContext(object):
-    """Context for Condor-based grid"""
+class NeuronController(__Controller):
+    """
+    Base class for controllers of NEURON models which are built once per
+    process and reused for every candidate.
+
+    Subclasses implement build_cell, which creates the model (sections,
+    mechanisms, stimuli) and returns the segment whose voltage is recorded,
+    and parameter_map, which returns the (object, attribute) pairs each
+    parameter sets, e.g. [(seg.na, "gbar") for seg in axon]. These
+    references are cached, so applying a candidate only assigns its values,
+    and the state of the model is reset with finitialize before each
+    simulation.
+
+    If build_cell stores a point process (e.g. an IClamp) in self.stimulus,
+    default_stimulus and the stimulus settings of a Protocol passed to run
+    are applied to it before each simulation.
+
+    :param sim_time: simulated time (ms)
+    :param dt: integration time step (ms)
+    :param v_init: initial membrane potential (mV)
+    """
 
-    def __init__(self, host, username, password, port):
+    #: stimulus settings applied before those of a protocol, e.g. {"delay": 150, "amp": 0.1, "dur": 750}
+    default_stimulus = {}
 
-        self.messagehost = ssh_utils.host(host, username, password, port)
+    def __init__(self, sim_time, dt=0.025, v_init=-65.0):
 
-    def __split_list(self, alist, wanted_parts=1):
+        self.sim_time = sim_time
+        self.dt = dt
+        self.v_init = v_init
+        self.stimulus = None
+
+        self._segment = None
+        self._refs = None
+        self._vectors = None
+
+    def __getstate__(self):
+        # NEURON objects cannot be pickled, the model is built again in the
+        # process the controller is sent to
+        state = self.__dict__.copy()
+        state["stimulus"] = None
+        state["_segment"] = None
+        state["_refs"] = None
+        state["_vectors"] = None
+        return state
+
+    def build_cell(self):
+        """
+        Create the model and return the segment to record the voltage of.
+        """
+        raise NotImplementedError("Valid NEURON controller requires build_cell method!")
+
+    def parameter_map(self):
+        """
+        Return a dict of parameter name vs. list of (object, attribute)
+        pairs the parameter's value is assigned to.
+        """
+        raise NotImplementedError(
+            "Valid NEURON controller requires parameter_map method!"
+        )
 
-        length = len(alist)
+    def _setup(self):
+        """
+        Build the model and cache the parameter references, once.
+        """
+        from neuron import h
+
+        if self._refs is None:
+            h.load_file("stdrun.hoc")
+            self._segment = self.build_cell()
+            self._refs = dict(
+                (parameter, list(refs))
+                for parameter, refs in self.parameter_map().items()
+            )
+        return h
+
+    def _recording_vectors(self, h):
+        """
+        Return the time and voltage recording vectors, sampled at the
+        recording spec's dt if it has one.
+        """
+        record_dt = None
+        if self.recording_spec is not None:
+            record_dt = self.recording_spec.dt
+
+        if self._vectors is None or self._vectors[0] != record_dt:
+            rec_t = h.Vector()
+            rec_v = h.Vector()
+            if record_dt is None:
+                rec_t.record(h._ref_t)
+                rec_v.record(self._segment._ref_v)
+            else:
+                rec_t.record(h._ref_t, record_dt)
+                rec_v.record(self._segment._ref_v, record_dt)
+            self._vectors = (record_dt, rec_t, rec_v)
+
+        return self._vectors[1], self._vectors[2]
+
+    def set_parameters(self, sim_var, refs=None):
+        """
+        Assign the values of a candidate's sim_var dict to the model, or to
+        the objects of a cached parameter map refs.
+        """
+        if refs is None:
+            refs = self._refs
+        for parameter, value in sim_var.items():
+            if parameter not in refs:
+                raise KeyError(
+                    "Parameter %s is not in the parameter map of %s" % (parameter, self)
+                )
+            for obj, attribute in refs[parameter]:
+                setattr(obj, attribute, value)
+
+    def set_stimulus(self, protocol=None, stimulus=None):
+        """
+        Apply default_stimulus, then the protocol's stimulus, to
+        self.stimulus (or to stimulus).
+        """
+        if stimulus is None:
+            stimulus = self.stimulus
+        if stimulus is None:
+            return
+        settings = dict(self.default_stimulus)
+        if protocol is not None:
+            settings.update(protocol.stimulus)
+        for attribute, value in settings.items():
+            setattr(stimulus, attribute, value)
+
+    def run_individual(self, sim_var, protocol=None):
+        """
+        Run an individual simulation.
+
+        The candidate data has been flattened into the sim_var dict. The
+        sim_var dict contains parameter:value key value pairs, which are
+        applied to the model before it is simulated.
+
+        If an abort predicate stops the simulation, the times simulated so
+        far are returned with None for the voltages. Only the samples the
+        recording spec asks for are returned.
+        """
+        h = self._setup()
+        self.set_parameters(sim_var)
+        self.set_stimulus(protocol)
+
+        sim_time = self.sim_time
+        if protocol is not None and protocol.sim_time:
+            sim_time = protocol.sim_time
+
+        rec_t, rec_v = self._recording_vectors(h)
+
+        h.dt = self.dt
+        h.finitialize(self.v_init)
+
+        aborted = False
+        if self.abort_predicates:
+            self._reset_abort_predicates()
+            checked = 0
+            while h.t < sim_time - self.dt / 2:
+                h.continuerun(min(h.t + self.abort_check_interval, sim_time))
+                times = rec_t.as_numpy()
+                if self._should_abort(times[checked:], rec_v.as_numpy()[checked:]):
+                    aborted = True
+                    break
+                checked = len(times)
+        else:
+            h.continuerun(sim_time)
+
+        times = np.array(rec_t.as_numpy())
+        if aborted:
+            return times, None
+        volts = np.array(rec_v.as_numpy())
+
+        if self.recording_spec is not None:
+            return self.recording_spec.select(times, volts)
+
+        return times, volts
+
+    def run(self, candidates, parameters, protocol=None):
+        """
+        Run simulation for each candidate, returning a list of
+        [times, volts] pairs.
+        """
         return [
-            alist[i * length // wanted_parts : (i + 1) * length // wanted_parts]
-            for i in range(wanted_parts)
+            [t, v] for index, t, v in self.run_iter(candidates, parameters, protocol)
         ]
 
-    def __prepare_candidates(self, candidates, candidates_per_job=1):
+    def run_iter(self, candidates, parameters, protocol=None):
+        """
+        Run simulation for each candidate, yielding (index, times, volts)
+        as soon as each simulation has finished.
+        """
+        for index, candidate in enumerate(candidates):
+            sim_var = dict(zip(parameters, candidate))
+            t, v = self.run_individual(sim_var, protocol=protocol)
+            yield index, t, v
 
-        # Split candidate list into smaller ones (jobs):
-        # and make a job list
-        if optimizer_params.candidates_in_job != None:
-            candidates_in_job = optimizer_params.candidates_in_job
-        else:
-            candidates_in_job = candidates_per_job
-
-        num_candidates = len(candidates)
-        ids = range(num_candidates)
-        enumerated_candidates = zip(candidates, ids)
-        num_jobs = num_candidates / candidates_in_job
-        self.num_jobs = num_jobs
-        self.job_list = self.__split_list(
-            enumerated_candidates, wanted_parts=self.num_jobs
-        )
 
-    def __make_job_file(self, job, job_number):
-        # write the header:
-        filepath = os.path.join(self.tmpdir, "run" + str(job_number) + ".sh")
-        run_shell = open(filepath, "w")
-        run_shell.write("#!/bin/bash\n")
-        run_shell.write("reldir=`dirname $0`\n")
-        run_shell.write("cd $reldir\n")
-        run_shell.write("directory=`pwd`\n")
-        run_shell.write("pndirectory=$directory\n")
-        run_shell.write("#Untar the file:\n")
-        run_shell.write("/bin/tar xzf ./portable-neuron.tar.gz\n")
-        tarfile_name = optimizer_params.tarred_nrnproj
-        run_shell.write("/bin/tar xzf ./" + tarfile_name + "\n")
-
-        # CandidateData_list=[]
-        for enumerated_candidate in job:
-
-            chromosome = enumerated_candidate[0]
-            candidate_info = CandidateData(chromosome)
-            exp_id = enumerated_candidate[1]
-            candidate_info.set_exp_id(exp_id)
-            candidate_info.set_job_num(job_number)
-            self.CandidateData_list.append(candidate_info)
-
-            nproj = controllers.NrnProjSimRun(optimizer_params.project_path, chromosome)
-            run_shell.write("#issue the commands\n")
-            run_shell.write(
-                "$pndirectory/pnpython.sh \
-                    $directory/src/simrunner.py \"sim_var['exp_id'] \
-                    = "
-                + str(exp_id)
-                + '" '
-                + "\"sim_var['"
-                "dbname"
-                "'] \
-                    = 'outputdb"
-                + str(job_number)
-                + ".sqlite'\""
-                + nproj.sim_var_string
-                + "\n"
+class BatchNeuronController(NeuronController):
+    """
+    NeuronController simulating batch_size candidates at once, in one NEURON
+    instance, to amortise the Python and NEURON overhead of small models.
+
+    build_cell is called batch_size times, each call creating an independent
+    copy of the cell; parameter_map and self.stimulus are read right after
+    each call, so they must refer to the copy just built. Each batch of
+    candidates is then integrated in a single continuerun, every copy with
+    its own candidate's parameter values and recording vector, and the
+    traces are split afterwards. The copies must not interact (e.g. through
+    synapses or gap junctions).
+
+    Every copy checks its own copies of the abort predicates: a tripped
+    copy is returned as aborted, and the batch stops once all its copies
+    are aborted. The copies left idle by a last, partial batch are reset
+    to the parameter values they were built with and, if their stimulus
+    has an amp, unstimulated, so that they rest rather than repeating the
+    previous batch's simulations.
+
+    An existing NeuronController subclass is batched by listing this class
+    first, e.g. ``class BatchedCell(BatchNeuronController, MyCell): pass``.
+    Positional and keyword arguments other than batch_size are passed on
+    to the next constructor in the method resolution order, so
+    BatchedCell is constructed like MyCell, plus an optional keyword
+    batch_size; used directly, BatchNeuronController takes NeuronController's
+    arguments (sim_time, dt, v_init).
+
+    :param batch_size: number of copies of the cell, i.e. of candidates
+        simulated together (keyword only); defaults to the batch_size
+        class attribute
+    """
+
+    #: number of copies of the cell
+    batch_size = 10
+
+    _copies = None
+
+    def __init__(self, *args, **kwargs):
+
+        batch_size = kwargs.pop("batch_size", None)
+        super(BatchNeuronController, self).__init__(*args, **kwargs)
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    def __getstate__(self):
+        state = super(BatchNeuronController, self).__getstate__()
+        state["_copies"] = None
+        return state
+
+    def _setup(self):
+        """
+        Build the batch_size copies of the model and cache their parameter
+        references, once.
+        """
+        from neuron import h
+
+        if self._copies is None:
+            h.load_file("stdrun.hoc")
+            copies = []
+            for k in range(self.batch_size):
+                segment = self.build_cell()
+                refs = dict(
+                    (parameter, list(refs))
+                    for parameter, refs in self.parameter_map().items()
+                )
+                built = dict(
+                    (parameter, [getattr(obj, attribute) for obj, attribute in r])
+                    for parameter, r in refs.items()
+                )
+                copies.append((segment, refs, self.stimulus, built))
+            self._copies = copies
+        return h
+
+    def _rest(self, refs, stimulus, built):
+        """
+        Reset an idle copy to the parameter values it was built with and
+        switch its stimulus off.
+        """
+        for parameter, values in built.items():
+            for (obj, attribute), value in zip(refs[parameter], values):
+                setattr(obj, attribute, value)
+        if stimulus is not None and hasattr(stimulus, "amp"):
+            stimulus.amp = 0
+
+    def _recording_vectors(self, h):
+        """
+        Return the time recording vector and the voltage recording vectors of
+        all copies, sampled at the recording spec's dt if it has one.
+        """
+        record_dt = None
+        if self.recording_spec is not None:
+            record_dt = self.recording_spec.dt
+
+        if self._vectors is None or self._vectors[0] != record_dt:
+            refs = [h._ref_t] + [segment._ref_v for segment, _, _, _ in self._copies]
+            vectors = []
+            for ref in refs:
+                vector = h.Vector()
+                if record_dt is None:
+                    vector.record(ref)
+                else:
+                    vector.record(ref, record_dt)
+                vectors.append(vector)
+            self._vectors = (record_dt, vectors[0], vectors[1:])
+
+        return self._vectors[1], self._vectors[2]
+
+    def run_batch(self, sim_vars, protocol=None):
+        """
+        Simulate up to batch_size candidates together, given their sim_var
+        dicts, and return a list of their (times, volts). Aborted
+        simulations are returned with None for the voltages.
+        """
+        if len(sim_vars) > self.batch_size:
+            raise ValueError(
+                "%i candidates given for a batch of %i" % (len(sim_vars), self.batch_size)
             )
-            run_shell.write("echo 'done'\n")
 
-        run_shell.write(
-            "cp $directory/sims/outputdb" + str(job_number) + ".sqlite $directory\n"
-        )
-        # self.CandidateData_list=CandidateData_list
-        run_shell.close()
-
-    def __make_submit_file(self):
-        """write the condor submit files"""
-
-        filepath = os.path.join(self.tmpdir, "submitfile.submit")
-        submit_file = open(filepath, "w")
-
-        submit_file.write("universe   = vanilla\n")
-        submit_file.write("log        = pneuron.log\n")
-        submit_file.write("Error   = err.$(Process)\n")
-        submit_file.write("Output  = out.$(Process)\n")
-        submit_file.write('requirements = GLIBC == "2.11"\n')
-        tarfile_name = optimizer_params.tarred_nrnproj
-        submit_file.write(
-            "transfer_input_files = portable-neuron.tar.gz," + tarfile_name + "\n"
-        )
-        submit_file.write("should_transfer_files   = yes\n")
-        submit_file.write("when_to_transfer_output = on_exit_or_evict\n")
-        # this is where you have to do the clever stuff:
+        h = self._setup()
+        for k, (segment, refs, stimulus, built) in enumerate(self._copies):
+            if k < len(sim_vars):
+                self.set_parameters(sim_vars[k], refs)
+                self.set_stimulus(protocol, stimulus)
+            else:
+                self._rest(refs, stimulus, built)
+
+        sim_time = self.sim_time
+        if protocol is not None and protocol.sim_time:
+            sim_time = protocol.sim_time
+
+        rec_t, rec_vs = self._recording_vectors(h)
+        rec_vs = rec_vs[: len(sim_vars)]
+
+        h.dt = self.dt
+        h.finitialize(self.v_init)
+
+        # samples simulated when each copy was aborted
+        aborted = [None] * len(sim_vars)
+
+        if self.abort_predicates:
+            predicates = [
+                copy.deepcopy(list(self.abort_predicates)) for sim_var in sim_vars
+            ]
+            for copy_predicates in predicates:
+                for predicate in copy_predicates:
+                    predicate.reset()
+
+            checked = 0
+            while h.t < sim_time - self.dt / 2 and None in aborted:
+                h.continuerun(min(h.t + self.abort_check_interval, sim_time))
+                times = rec_t.as_numpy()
+                for k, rec_v in enumerate(rec_vs):
+                    if aborted[k] is not None:
+                        continue
+                    volts = rec_v.as_numpy()[checked:]
+                    if any(p(times[checked:], volts) for p in predicates[k]):
+                        aborted[k] = len(times)
+                checked = len(times)
+        else:
+            h.continuerun(sim_time)
+
+        times = np.array(rec_t.as_numpy())
+        results = []
+        for k, rec_v in enumerate(rec_vs):
+            if aborted[k] is not None:
+                results.append((times[: aborted[k]], None))
+                continue
+            volts = np.array(rec_v.as_numpy())
+            if self.recording_spec is not None:
+                results.append(self.recording_spec.select(times, volts))
+            else:
+                results.append((times, volts))
+
+        return results
+
+    def run_individual(self, sim_var, protocol=None):
+        return self.run_batch([sim_var], protocol)[0]
+
+    def run_iter(self, candidates, parameters, protocol=None):
+        """
+        Run the candidates batch_size at a time, yielding (index, times,
+        volts) for each candidate once its batch has finished.
+        """
+        for first in range(0, len(candidates), self.batch_size):
+            sim_vars = [
+                dict(zip(parameters, candidate))
+                for candidate in candidates[first : first + self.batch_size]
+            ]
+            for k, (t, v) in enumerate(self.run_batch(sim_vars, protocol)):
+                yield first + k, t, v
+
+
+#: controllers run by ParallelContextController jobs, by name, on every rank
+_bulletin_board_controllers = {}
+
+
+def _run_candidate(
+    controller, candidate, parameters, protocol, abort_predicates, recording_spec
+):
+    """
+    Simulate one candidate in a worker, with the abort predicates and
+    recording spec of the parent controller, and return its (times, samples).
+    """
+    controller.abort_predicates = abort_predicates
+    controller.recording_spec = recording_spec
+
+    if protocol is None:
+        simulations_data = controller.run([candidate], parameters)
+    else:
+        simulations_data = controller.run([candidate], parameters, protocol=protocol)
+
+    times, samples = simulations_data[0]
+    return _as_arrays(times, samples)
+
+
+def _as_arrays(times, samples):
+    """
+    Convert a trace to numpy arrays, for sending it to another process.
+    """
+    if isinstance(samples, dict):
+        samples = dict((k, np.asarray(v)) for k, v in samples.items())
+    elif samples is not None:
+        samples = np.asarray(samples)
+    return np.asarray(times), samples
+
+
+def _bulletin_board_job(name, *job):
+    """
+    Simulate one candidate with the registered controller name, on
+    whichever rank picked the job.
+    """
+    return _run_candidate(_bulletin_board_controllers[name], *job)
+
+
+class ParallelContextController(__Controller):
+    """
+    Farm the simulations of another controller out over MPI ranks, through
+    NEURON's ParallelContext bulletin board.
+
+    The script must create the wrapped controller and this controller on
+    every rank, e.g. when started with ``mpiexec -n N python script.py``.
+    Worker ranks then stay in the constructor, running the jobs posted by
+    rank 0, where the script carries on and runs the optimization; call
+    close() at the end to release them. Each candidate is submitted as a
+    job simulated by the worker's own instance of the wrapped controller
+    (so e.g. a NeuronController builds its model once per rank), together
+    with the abort predicates and recording spec current on rank 0.
+
+    Without NEURON or MPI, the wrapped controller simply runs the
+    candidates in this process.
+
+    :param controller: the controller running the simulations, which must
+        return [times, samples] pairs (or a TraceBatch)
+    :param name: name identifying the wrapped controller on every rank
+        (needed if several ParallelContextControllers are used)
+    """
+
+    def __init__(self, controller, name="controller"):
 
-        for shellno in range(self.num_jobs):
-            submit_file.write("executable = run" + str(shellno) + ".sh\n")
-            submit_file.write("queue\n")
+        self.controller = controller
+        self.name = name
+        _bulletin_board_controllers[name] = controller
 
-        # finally close the submit file
-        submit_file.close()
+        self.pc = None
+        try:
+            from neuron import h
+        except ImportError:
+            return
 
-    def __build_condor_files(self, candidates, parameters, candidates_per_job=100):
+        if hasattr(h, "nrnmpi_init"):
+            h.nrnmpi_init()
+        self.pc = h.ParallelContext()
+        # worker ranks run jobs here until close() is called on rank 0
+        self.pc.runworker()
+
+    def close(self):
+        """
+        Release the worker ranks.
+        """
+        if self.pc is not None:
+            self.pc.done()
 
-        # prepare list of candidates to be farmed on grid:
-        self.__prepare_candidates(candidates, candidates_per_job=100)
+    def _distributed(self):
+        return self.pc is not None and self.pc.nhost() > 1
 
-        # make the job files (shell scripts to be executed on the execute nodes)
-        job_number = 0  # run shell script number
-        for job in self.job_list:
-            self.__make_job_file(job, job_number)
-            job_number += 1
+    def run(self, candidates, parameters, protocol=None):
+        """
+        Run the simulations on the worker ranks and return their
+        [times, samples] in candidate order.
+        """
+        if not self._distributed():
+            self.controller.abort_predicates = list(self.abort_predicates)
+            self.controller.recording_spec = self.recording_spec
+            if protocol is None:
+                return self.controller.run(candidates, parameters)
+            return self.controller.run(candidates, parameters, protocol=protocol)
+
+        simulations_data = [None] * len(candidates)
+        for index, times, samples in self.run_iter(candidates, parameters, protocol):
+            simulations_data[index] = [times, samples]
+        return simulations_data
+
+    def run_iter(self, candidates, parameters, protocol=None):
+        """
+        Run the simulations on the worker ranks, yielding (index, times,
+        samples) as each job's result comes back to rank 0.
+        """
+        if not self._distributed():
+            for index, data in enumerate(self.run(candidates, parameters, protocol)):
+                yield index, data[0], data[1]
+            return
+
+        for index, candidate in enumerate(candidates):
+            # user ids start at 1, working() returns 0 once all jobs are done
+            self.pc.submit(
+                index + 1,
+                _bulletin_board_job,
+                self.name,
+                list(candidate),
+                list(parameters),
+                protocol,
+                list(self.abort_predicates),
+                self.recording_spec,
+            )
 
-        # now make the submit file
-        self.__make_submit_file()
+        while True:
+            userid = int(self.pc.working())
+            if userid == 0:
+                break
+            times, samples = self.pc.pyret()
+            yield userid - 1, times, samples
 
-    def __delete_remote_files(self, host):
-        import ssh_utils
 
-        command = "rm -rf ./*"
-        ssh_utils.issue_command(host, command)
+#: controller of a WorkerPoolController worker process
+_pool_controller = None
 
-    def __put_multiple_files(self, host, filelist, localdir="/", remotedir="/"):
-        import ssh_utils
 
-        for file in filelist:
-            localpath = os.path.join(localdir, file)
-            remotepath = os.path.join(remotedir, file)
-            ssh_utils.put_file(host, localpath, remotepath)
+def _init_pool_worker(controller, setup):
+    global _pool_controller
+    _pool_controller = controller
+    if setup is not None:
+        setup(controller)
 
 
-class NrnProjectCondor(NrnProject):
+def _pool_job(indexed_job):
+    index, shared_name, job = indexed_job
+    times, samples = _run_candidate(_pool_controller, *job)
+    if shared_name is None:
+        return index, (times, samples)
+    return index, write_shared_trace(shared_name, times, samples)
+
+
+class WorkerPoolController(__Controller):
     """
-    Run NrnProject-based simulations on a Condor-managed
-    federated system
+    Run another controller's simulations on a pool of warm worker
+    processes, kept across the generations of an optimization.
+
+    Workers are started with the forkserver (or spawn) method, so they do
+    not inherit the parent's NEURON state. With forkserver, the preload
+    modules (neurotune, pyelectro and e.g. the module defining the model)
+    are imported once by the fork server and inherited by every worker.
+    Each worker receives the wrapped controller and calls setup(controller)
+    exactly once when it starts, e.g. to load compiled mechanisms; a
+    NeuronController then builds its model once per worker. With
+    maxtasksperchild, the workers are replaced together once the pool has
+    simulated maxtasksperchild candidates per process, to contain memory
+    leaks of long NEURON runs, and their replacements run setup again; the
+    candidates of a run are then submitted in waves of at most that many.
+
+    If a worker dies (e.g. NEURON crashes or runs out of memory), the pool
+    is replaced and the candidates whose results were lost are simulated
+    again one at a time, so that the candidate killing its worker can be
+    told apart; that candidate is returned as aborted (with None samples,
+    i.e. the worst fitness) and the run carries on.
+
+    With shared_memory, workers write each trace to a shared memory block
+    named by this controller and only send back its handle; the traces
+    returned are read-only views of those blocks, valid until the next run
+    or close(). Blocks whose handle never arrives (e.g. because a worker
+    failed) are removed when the run ends.
+
+    The pool is started on first use and kept until close(). As with any
+    forkserver or spawn pool, the wrapped controller and setup must be
+    picklable, and scripts must guard their entry point with
+    ``if __name__ == "__main__":``.
+
+    :param controller: controller running the simulations in the workers
+    :param processes: number of worker processes; None for the number of CPUs
+    :param setup: function called with the worker's controller once per worker
+    :param start_method: "forkserver" or "spawn"
+    :param preload: modules imported by the fork server
+    :param maxtasksperchild: candidates simulated by a worker before it is
+        replaced; None to keep the workers for the whole optimization
+    :param shared_memory: whether to transfer traces through shared memory
     """
 
     def __init__(
         self,
-        host,
-        username,
-        password,
-        port=80,
-        local_analysis=False,
-        candidates_per_job=100,
+        controller,
+        processes=None,
+        setup=None,
+        start_method="forkserver",
+        preload=("neurotune.controllers", "pyelectro.analysis"),
+        maxtasksperchild=None,
+        shared_memory=False,
     ):
 
-        super(NrnProjectCondor, self).__init__()
+        if start_method not in ("forkserver", "spawn"):
+            raise ValueError(
+                "start_method must be 'forkserver' or 'spawn', not %s" % start_method
+            )
 
-        # other things like the number of nodes to divide the work onto and
-        # host connection parameters need to go into this constructor
-        # the more I think about it the less this seems like a good idea
-        # though
+        self.controller = controller
+        self.processes = processes
+        self.setup = setup
+        self.start_method = start_method
+        self.preload = list(preload)
+        self.maxtasksperchild = maxtasksperchild
+        self.shared_memory = shared_memory
+
+        self._pool = None
+        self._pool_tasks = 0
+        self._shared_blocks = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_pool_tasks"] = 0
+        state["_shared_blocks"] = []
+        return state
+
+    def _release_shared_blocks(self):
+        """
+        Release the shared memory of the traces of the previous run.
+        """
+        for block in self._shared_blocks:
+            try:
+                block.close()
+            except BufferError:
+                # views still in use keep the (unlinked) block mapped
+                pass
+        self._shared_blocks = []
+
+    def _get_pool(self):
+        if self._pool is None:
+            context = multiprocessing.get_context(self.start_method)
+            if self.start_method == "forkserver":
+                context.set_forkserver_preload(self.preload)
+            self._pool = ProcessPoolExecutor(
+                self.processes,
+                mp_context=context,
+                initializer=_init_pool_worker,
+                initargs=(self.controller, self.setup),
+            )
+        return self._pool
 
-        if local_analysis:
-            self.run = self.__local_run
-        else:
-            self.run = self.__remote_run__
+    def _pool_capacity(self):
+        """
+        The number of candidates the current pool may still simulate before
+        its workers are replaced; None if they are kept.
+        """
+        if self.maxtasksperchild is None:
+            return None
+        processes = self.processes or os.cpu_count() or 1
+        return max(processes * self.maxtasksperchild - self._pool_tasks, 0)
 
-        # make a context which provides grid utilities
-        self.context = __CondorContext(host, username, password, port)
+    def _replace_pool(self):
+        """
+        Discard a pool broken by the death of a worker, or whose workers
+        have simulated their share of candidates; the next job starts a new
+        one.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._pool_tasks = 0
 
-        self.cpj = candidates_per_job
+    def close(self):
+        """
+        Stop the worker processes and release the traces' shared memory.
+        """
+        self._release_shared_blocks()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._pool_tasks = 0
+
+    def run(self, candidates, parameters, protocol=None):
+        """
+        Run the simulations on the workers and return their
+        [times, samples] in candidate order.
+        """
+        simulations_data = [None] * len(candidates)
+        for index, times, samples in self.run_iter(candidates, parameters, protocol):
+            simulations_data[index] = [times, samples]
+        return simulations_data
 
-    def __condor_run(self, candidates, parameters):
+    def run_iter(self, candidates, parameters, protocol=None):
+        """
+        Run the simulations on the workers, yielding (index, times, samples)
+        as each of them finishes.
         """
-        Run simulations on grid and analyse data locally (???I'm quite confused here...there is a mistake somewhere as the name doesn't match the description - which method is which?)
+        self._release_shared_blocks()
+
+        shared_names = [None] * len(candidates)
+        if self.shared_memory:
+            token = uuid.uuid4().hex[:8]
+            shared_names = [
+                "nt%i_%s_%i" % (os.getpid(), token, index)
+                for index in range(len(candidates))
+            ]
+
+        jobs = [
+            (
+                index,
+                shared_names[index],
+                (
+                    list(candidate),
+                    list(parameters),
+                    protocol,
+                    list(self.abort_predicates),
+                    self.recording_spec,
+                ),
+            )
+            for index, candidate in enumerate(candidates)
+        ]
 
-            Once each generation has finished, all data is pulled to local
-            workstation in form of sqlite databases (1 database per job)
-            and these are analysed and the fitness estimated sequentially
-            the fitness array is then returned.
+        pending = set(name for name in shared_names if name is not None)
+        futures = {}
+        try:
+            while jobs:
+                capacity = self._pool_capacity()
+                if capacity == 0:
+                    # the workers have simulated their share of candidates
+                    self._replace_pool()
+                    capacity = self._pool_capacity()
+                if capacity is None:
+                    capacity = len(jobs)
+                wave, jobs = jobs[:capacity], jobs[capacity:]
+
+                pool = self._get_pool()
+                wave_futures = dict((pool.submit(_pool_job, job), job) for job in wave)
+                futures.update(wave_futures)
+                self._pool_tasks += len(wave)
+                lost = []
+                for future in as_completed(wave_futures):
+                    try:
+                        index, result = future.result()
+                    except BrokenProcessPool:
+                        lost.append(wave_futures[future])
+                        continue
+                    yield (index,) + self._received(result, pending)
+
+                if lost:
+                    for item in self._rerun_lost(lost, futures, pending):
+                        yield item
+        finally:
+            if pending:
+                # wait for the jobs still running, so that no block is
+                # written after the cleanup
+                for future in futures:
+                    future.cancel()
+                wait_futures(futures)
+                for name in pending:
+                    unlink_shared_trace(name)
+
+    def _rerun_lost(self, lost, futures, pending):
+        """
+        Simulate again, one at a time on a new pool, the jobs lost when a
+        worker died, to find the candidate killing its worker; yield
+        (index, times, samples) for each of them.
         """
+        self._replace_pool()
+        print("A worker process died, simulating %i candidates again" % len(lost))
+        for job in sorted(lost, key=lambda job: job[0]):
+            index, shared_name = job[0], job[1]
+            if shared_name is not None:
+                # the dead worker may have created the block already
+                unlink_shared_trace(shared_name)
+            future = self._get_pool().submit(_pool_job, job)
+            futures[future] = job
+            self._pool_tasks += 1
+            try:
+                index, result = future.result()
+            except BrokenProcessPool:
+                print(
+                    "Candidate %s killed its worker process, returning it as aborted"
+                    % job[2][0]
+                )
+                self._replace_pool()
+                if shared_name is not None:
+                    unlink_shared_trace(shared_name)
+                    pending.discard(shared_name)
+                yield index, np.zeros(0), None
+                continue
+            yield (index,) + self._received(result, pending)
+
+    def _received(self, result, pending):
+        """
+        Return the (times, samples) of a job's result, attaching to its
+        shared memory block if traces are transferred that way.
+        """
+        if not self.shared_memory:
+            return result
+        block, times, samples = result.attach()
+        pending.discard(result.name)
+        self._shared_blocks.append(block)
+        return times, samples
 
-        import time
-        import ssh_utils
 
-        # Build submit and runx.sh files, exp_id now corresponds
-        # to position in chromosome and fitness arrays
-        self.context.__build_condor_files(
-            candidates, parameters, candidates_per_job=self.cpj
+def run_scheduler_task(job_dir, task):
+    """
+    Entry point of the array tasks of a BatchSchedulerController: simulate
+    the task-th slice of the candidates stored in job_dir and write their
+    traces to result_<task>.pkl in it.
+    """
+    task = int(task)
+    with open(os.path.join(job_dir, "job.pkl"), "rb") as job_file:
+        job = pickle.load(job_file)
+
+    per_job = job["candidates_per_job"]
+    candidates = job["candidates"][task * per_job : (task + 1) * per_job]
+
+    controller = job["controller"]
+    controller.abort_predicates = job["abort_predicates"]
+    controller.recording_spec = job["recording_spec"]
+    if job["protocol"] is None:
+        simulations_data = controller.run(candidates, job["parameters"])
+    else:
+        simulations_data = controller.run(
+            candidates, job["parameters"], protocol=job["protocol"]
         )
 
-        # This is a file handling block..
-        # delete everything in the ssh_utilse directory you're about to put files in
-        self.__delete_remote_files__()
-        filelist = os.listdir(self.tmpdir)
-        # copy local files over, some stuff is missing here as it needs to be an attribute in the condor context
-        self.__put_multiple_files(filelist, localdir=self.tmpdir)
-        filelist = os.listdir(self.portableswdir)
-        # copy portable software files over:
-        self.__put_multiple_files(filelist, localdir=self.portableswdir)
-
-        # issue a command to the message host to issue commands to the grid:
-        ssh_utils.issue_command(
-            context.messagehost,
-            "export PATH=/opt/Condor/release/bin:$PATH\ncondor_submit submitfile.submit",
-        )
+    traces = [_as_arrays(data[0], data[1]) for data in simulations_data]
 
-        # make a list of the database files we need:
-        self.jobdbnames = []
-        for job_num in range(self.num_jobs):
-            jobdbname = "outputdb" + str(job_num) + ".sqlite"
-            self.jobdbnames.append(jobdbname)
-
-        # wait till we know file exists:
-        dbs_created = False
-        pulled_dbs = (
-            []
-        )  # list of databases which have been extracted from remote server
-        while dbs_created == False:
-            print("waiting..")
-            time.sleep(20)
-            print("checking if dbs created:")
-            command = "ls"
-            remote_filelist = ssh_utils.issue_command(self.messagehost, command)
-            for jobdbname in self.jobdbnames:
-                db_exists = jobdbname + "\n" in remote_filelist
-                if db_exists == False:
-                    print(jobdbname + " has not been generated")
-                    dbs_created = False
-                elif db_exists == True and jobdbname not in pulled_dbs:
-                    print(jobdbname + " has been generated")
-                    remotefile = optimizer_params.remotedir + jobdbname
-                    localpath = os.path.join(
-                        self.datadir, str(self.generation) + jobdbname
-                    )
-                    ssh_utils.get_file(self.messagehost, remotefile, localpath)
-                    pulled_dbs.append(
-                        jobdbname
-                    )  # so that it is not extracted more than once
-                    # here pop-in the fitness evaluation
-                if len(pulled_dbs) == len(self.jobdbnames):
-                    dbs_created = True
-
-        # this block can be simplified, it need simply return exp_data containers
-        fitness = []
-        for CandidateData in self.CandidateData_list:
-            job_num = CandidateData.job_num
-
-            dbname = str(self.generation) + "outputdb" + str(job_num) + ".sqlite"
-            dbpath = os.path.join(self.datadir, dbname)
-            exp_id = CandidateData.exp_id
-
-            connection = sqldbutils.db_connect(
-                dbpath
-            )  # establish a database connection
-            query = (
-                "SELECT numerical_value\
-                    FROM output_params WHERE experiment_id=\
-                    "
-                + str(exp_id)
-                + ' AND parameter="fitness"'
-            )
+    # written under a temporary name first, so a result file is always complete
+    result_path = os.path.join(job_dir, "result_%i.pkl" % task)
+    with open(result_path + ".tmp", "wb") as result_file:
+        pickle.dump(traces, result_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(result_path + ".tmp", result_path)
 
-            exp_fitness = sqldbutils.execute_query(connection, query)
-            exp_fitness = exp_fitness.fetchall()
-            exp_fitness = exp_fitness[0][0]
 
-            print("Fitness:")
-            print(exp_fitness)
+#: shell script run by each array task, taking the task index from the scheduler
+_TASK_SCRIPT = """#!/bin/sh
+exec %(python)s -c 'import sys; from neurotune.controllers import run_scheduler_task; run_scheduler_task(sys.argv[1], sys.argv[2])' %(job_dir)s "%(task)s"
+"""
 
-            fitness.append(exp_fitness)
 
-        self.generation += 1
-        return fitness
+class LocalScheduler(object):
+    """
+    Stand-in for a batch scheduler, running the array tasks as processes on
+    this machine, max_processes at a time. Useful for testing a
+    BatchSchedulerController set up before moving it to a cluster.
 
-    ###ignore this for now###
-    def __local_evaluate(self, candidates, args):
-        import time
+    :param max_processes: number of tasks run concurrently; None for the
+        number of CPUs
+    """
 
-        analysis
+    #: shell expression giving the index of the array task
+    task_argument = "$1"
 
-        self.CandidateData_list = []
-        analysis_var = self.analysis_var
+    def __init__(self, max_processes=None):
+        self.max_processes = max_processes or os.cpu_count() or 1
 
-        # Build submitfile.submit and runx.sh files:
-        self.__buil_condor_files(
-            candidates
-        )  # exp_id now corresponds to position in chromosome/fitness array
+    def run_array(self, script, n_tasks, job_dir):
+        """
+        Run tasks 0 to n_tasks - 1 of script and return when all have exited.
+        """
 
-        fitness = []
-        # submit the jobs to the grid
-        os.chdir(self.tmpdir)
-        os.system("condor_submit submitfile.submit")
-
-        # wait till you know file exists:
-        dbs_created = False
-        while dbs_created == False:
-            print("checking if dbs created:")
-            for job_num in range(self.num_jobs):
-                jobdbname = "outputdb" + str(job_num) + ".sqlite"
-                jobdbpath = os.path.join(self.datadir, jobdbname)
-                print(jobdbpath)
-                db_exists = os.path.exists(jobdbpath)
-
-                if db_exists == False:
-                    time.sleep(60)
-                    dbs_created = False
-                    break
+        def run_task(task):
+            log = os.path.join(job_dir, "task_%i" % task)
+            _run_command(["/bin/sh", script, str(task)], log + ".out", log + ".err")
 
-                dbs_created = True
+        with ThreadPoolExecutor(max_workers=self.max_processes) as executor:
+            list(executor.map(run_task, range(n_tasks)))
+
+
+class SlurmScheduler(object):
+    """
+    Run the array tasks as a SLURM job array, submitted with
+    ``sbatch --wait`` so that submission returns once every task has ended.
+
+    :param options: further sbatch options, e.g. ["--partition=short",
+        "--time=00:30:00"]
+    :param max_running: maximum number of tasks running at once; None for
+        no limit
+    """
+
+    task_argument = "$SLURM_ARRAY_TASK_ID"
+
+    def __init__(self, options=(), max_running=None):
+        self.options = list(options)
+        self.max_running = max_running
+
+    def run_array(self, script, n_tasks, job_dir):
+        """
+        Submit tasks 0 to n_tasks - 1 of script and return when all have ended.
+        """
+        array = "0-%i" % (n_tasks - 1)
+        if self.max_running is not None:
+            array += "%%%i" % self.max_running
+
+        args = [
+            "sbatch",
+            "--wait",
+            "--array=" + array,
+            "--job-name=neurotune",
+            "--output=" + os.path.join(job_dir, "task_%a.out"),
+            "--error=" + os.path.join(job_dir, "task_%a.err"),
+        ]
+        completed = subprocess.run(
+            args + self.options + [script],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        # sbatch --wait also exits with an error if any task failed, which
+        # shows as missing results; only a failed submission is an error here
+        if "Submitted batch job" not in completed.stdout:
+            raise RuntimeError("sbatch failed: %s" % completed.stderr.strip())
+
+
+class HTCondorScheduler(object):
+    """
+    Run the array tasks as the jobs of one HTCondor cluster, submitted with
+    condor_submit and followed with condor_wait on the job log until every
+    job has left the queue.
 
-        for CandidateData in self.CandidateData_list:
-            job_num = CandidateData.job_num
-            dbname = "/outputdb" + str(job_num) + ".sqlite"
-            dbpath = self.datadir + dbname
-            exp_id = CandidateData.exp_id
-            exp_data = sqldbutils.sim_data(dbpath, exp_id)
-            analysis = analysis.IClampAnalysis(
-                exp_data.samples, exp_data.t, analysis_var, 5000, 10000
+    :param submit_options: further submit description commands, e.g.
+        {"request_memory": "2GB"}, overriding the defaults
+    """
+
+    task_argument = "$1"
+
+    def __init__(self, submit_options=None):
+        self.submit_options = dict(submit_options or {})
+
+    def run_array(self, script, n_tasks, job_dir):
+        """
+        Submit tasks 0 to n_tasks - 1 of script and return when all have ended.
+        """
+        log_path = os.path.join(job_dir, "condor.log")
+        description = {
+            "universe": "vanilla",
+            "executable": script,
+            "arguments": "$(Process)",
+            "output": os.path.join(job_dir, "task_$(Process).out"),
+            "error": os.path.join(job_dir, "task_$(Process).err"),
+            "log": log_path,
+            "getenv": "True",
+            "should_transfer_files": "NO",
+        }
+        description.update(self.submit_options)
+
+        submit_path = os.path.join(job_dir, "tasks.submit")
+        with open(submit_path, "w") as submit_file:
+            for command in sorted(description):
+                submit_file.write("%s = %s\n" % (command, description[command]))
+            submit_file.write("queue %i\n" % n_tasks)
+
+        for args in (["condor_submit", submit_path], ["condor_wait", log_path]):
+            completed = subprocess.run(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
             )
-            exp_fitness = analysis.evaluate_fitness(
-                self.targets,
-                self.weights,
-                cost_function=analysis.normalised_cost_function,
+            if completed.returncode != 0:
+                raise RuntimeError(
+                    "%s failed: %s" % (args[0], completed.stderr.strip())
+                )
+
+
+class BatchSchedulerController(__Controller):
+    """
+    Run another controller's simulations as a job array on a batch
+    scheduler, each array task simulating candidates_per_job candidates
+    with its own instance of the wrapped controller.
+
+    Each run pickles the wrapped controller, the candidates, the abort
+    predicates and the recording spec into a new job directory under
+    work_dir and submits the array. The scheduler backend returns once it
+    reports the whole array finished (sbatch --wait, condor_wait on the job
+    log, or the local processes exiting), and the traces written by the
+    tasks are then collected from the job directory. work_dir must be on a
+    filesystem shared with the execute nodes, where python must be able to
+    import neurotune and the module defining the wrapped controller.
+
+    Candidates of an array task which failed come back with None in place
+    of their samples, so the evaluator gives them the worst fitness, and
+    the job directory is kept with the tasks' logs (task_<i>.out and
+    task_<i>.err); otherwise it is removed once the traces are collected.
+    A RuntimeError is raised if no task succeeded.
+
+    :param controller: controller running the simulations in the array tasks
+    :param scheduler: a SlurmScheduler, HTCondorScheduler or LocalScheduler
+    :param candidates_per_job: number of candidates simulated by each task
+    :param work_dir: shared directory for the job directories; None for
+        the current directory
+    :param python: python interpreter run by the tasks; None for the one
+        running this process
+    :param keep_files: whether to keep the job directories of successful runs
+    """
+
+    def __init__(
+        self,
+        controller,
+        scheduler,
+        candidates_per_job=1,
+        work_dir=None,
+        python=None,
+        keep_files=False,
+    ):
+
+        if candidates_per_job < 1:
+            raise ValueError(
+                "candidates_per_job must be at least 1, not %s" % candidates_per_job
             )
-            fitness.append(exp_fitness)
 
-        for job_num in range(self.num_jobs):
-            jobdbname = "outputdb" + str(job_num) + ".sqlite"
-            jobdbpath = os.path.join(self.datadir, jobdbname)
-            print(jobdbpath)
-            os.remove(jobdbpath)
+        self.controller = controller
+        self.scheduler = scheduler
+        self.candidates_per_job = candidates_per_job
+        self.work_dir = os.path.abspath(work_dir or os.getcwd())
+        self.python = python or sys.executable
+        self.keep_files = keep_files
 
-        return fitness
+    def _write_job(self, job_dir, candidates, parameters, protocol):
+        """
+        Write the job shared by the array tasks and the script they run.
+        """
+        job = {
+            "controller": self.controller,
+            "candidates": [list(candidate) for candidate in candidates],
+            "parameters": list(parameters),
+            "protocol": protocol,
+            "abort_predicates": list(self.abort_predicates),
+            "recording_spec": self.recording_spec,
+            "candidates_per_job": self.candidates_per_job,
+        }
+        with open(os.path.join(job_dir, "job.pkl"), "wb") as job_file:
+            pickle.dump(job, job_file, pickle.HIGHEST_PROTOCOL)
+
+        script = os.path.join(job_dir, "task.sh")
+        with open(script, "w") as script_file:
+            script_file.write(
+                _TASK_SCRIPT
+                % {
+                    "python": shlex.quote(self.python),
+                    "job_dir": shlex.quote(job_dir),
+                    "task": self.scheduler.task_argument,
+                }
+            )
+        os.chmod(script, 0o755)
+        return script
+
+    def run(self, candidates, parameters, protocol=None):
+        """
+        Run the simulations as a job array and return their [times, samples]
+        in candidate order.
+        """
+        if len(candidates) == 0:
+            return []
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        job_dir = tempfile.mkdtemp(prefix="neurotune_", dir=self.work_dir)
+        script = self._write_job(job_dir, candidates, parameters, protocol)
+
+        n_tasks = int(math.ceil(len(candidates) / float(self.candidates_per_job)))
+        self.scheduler.run_array(script, n_tasks, job_dir)
+
+        simulations_data = []
+        failed = []
+        for task in range(n_tasks):
+            first = task * self.candidates_per_job
+            n_candidates = len(candidates[first : first + self.candidates_per_job])
+            try:
+                with open(os.path.join(job_dir, "result_%i.pkl" % task), "rb") as f:
+                    traces = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                failed.append(task)
+                traces = [(np.zeros(0), None)] * n_candidates
+            simulations_data.extend([times, samples] for times, samples in traces)
+
+        if len(failed) == n_tasks:
+            raise RuntimeError(
+                "All %i array tasks failed, see their logs in %s" % (n_tasks, job_dir)
+            )
+        if failed:
+            print(
+                "Array tasks %s failed, see their logs in %s"
+                % (", ".join(str(task) for task in failed), job_dir)
+            )
+        elif not self.keep_files:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+        return simulations_data
 
 
 class SineWaveController(__Controller):
     """
     Simple sine wave generator which takes a number of variables ('amp', 'period', 'offset')
     and produces an output based on these.
+
+    The whole population is generated as one (candidates x samples) array
+    at sample times 0, dt, 2 dt, ... up to sim_time.
     """
 
-    def __init__(self, sim_time, dt):
+    def __init__(self, sim_time, dt, dtype=np.float64):
 
         self.sim_time = sim_time
         self.dt = dt
+        self.dtype = dtype
+
+    def times(self):
+        """
+        Return the sample times of a simulation.
+        """
+        # computed as multiples of dt, as accumulating dt drifts
+        n_samples = int(math.floor(self.sim_time / self.dt + 1e-9)) + 1
+        return np.arange(n_samples) * self.dt
+
+    def sine_waves(self, sim_var, times):
+        """
+        Return offset + amp * sin(2 pi t / period) at times.
 
-    def run_individual(self, sim_var, gen_plot=False, show_plot=False):
+        The values of sim_var may be numbers, for a single trace, or
+        (candidates x 1) arrays, for a (candidates x samples) array of traces.
+        """
+        volts = np.multiply(2 * math.pi, times) / sim_var["period"]
+        np.sin(volts, out=volts)
+        volts *= sim_var["amp"]
+        volts += sim_var["offset"]
+        return volts.astype(self.dtype, copy=False)
+
+    def run_individual(
+        self, sim_var, gen_plot=False, show_plot=False, recording_spec=None
+    ):
         """
         Run an individual simulation.
 
@@ -466,22 +1807,18 @@ class SineWaveController(__Controller):
         sim_var dict contains parameter:value key value pairs, which are
         applied to the model before it is simulated.
 
+        If an abort predicate stops the simulation, the times simulated so
+        far are returned with None for the voltages. If a recording_spec is
+        given, only the samples it asks for are returned.
+
         """
         print(">> Running individual: %s" % (sim_var))
 
-        import numpy as np
-
-        t = 0
-        times = []
-        volts = []
-
-        while t <= self.sim_time:
-            v = sim_var["offset"] + (
-                sim_var["amp"] * (math.sin(2 * math.pi * t / sim_var["period"]))
-            )
-            times.append(t)
-            volts.append(v)
-            t += self.dt
+        chunks = list(self._run_chunks(sim_var, self.abort_check_interval))
+        times = np.concatenate([chunk[0] for chunk in chunks])
+        if chunks[-1][1] is None:
+            return times, None
+        volts = np.concatenate([chunk[1] for chunk in chunks])
 
         if gen_plot:
             from matplotlib import pyplot as plt
@@ -501,21 +1838,102 @@ class SineWaveController(__Controller):
             if show_plot:
                 plt.show()
 
-        return np.array(times), np.array(volts)
+        if recording_spec is not None:
+            return recording_spec.select(times, volts)
+
+        return times, volts
+
+    def _chunk_slices(self, n_samples, chunk_time):
+        step = max(1, int(round(chunk_time / self.dt)))
+        return [slice(start, start + step) for start in range(0, n_samples, step)]
+
+    def _run_chunks(self, sim_var, chunk_time):
+        """
+        Generate the trace of sim_var in chunks of chunk_time ms, yielding
+        (times, volts) arrays. The abort predicates are checked on each
+        chunk; if one of them is tripped, the chunk is yielded with None
+        for the voltages and the simulation stops.
+        """
+        times = self.times()
+
+        self._reset_abort_predicates()
+
+        for chunk in self._chunk_slices(len(times), chunk_time):
+            chunk_times = times[chunk]
+            volts = self.sine_waves(sim_var, chunk_times)
+            if self.abort_predicates and self._should_abort(chunk_times, volts):
+                print(">> Aborted at t = %s" % chunk_times[-1])
+                yield chunk_times, None
+                return
+            yield chunk_times, volts
+
+    def _aborted(self, times, volts):
+        """
+        Return a boolean array flagging the traces (rows of volts) for which
+        an abort predicate is tripped, checking them chunk by chunk as
+        during a simulation.
+        """
+        aborted = np.zeros(len(volts), dtype=bool)
+        chunks = self._chunk_slices(len(times), self.abort_check_interval)
+
+        for row in range(len(volts)):
+            self._reset_abort_predicates()
+            for chunk in chunks:
+                if self._should_abort(times[chunk], volts[row, chunk]):
+                    aborted[row] = True
+                    break
+
+        return aborted
 
     def run(self, candidates, parameters):
         """
         Run simulation for each candidate
 
-        This run method will loop through each candidate and run the simulation
-        corresponding to its parameter values. It will populate an array called
-        traces with the resulting voltage traces for the simulation and return it.
+        All candidates are simulated at once, broadcasting their parameter
+        values against the time axis. It returns the resulting voltage
+        traces as a TraceBatch, stored with the controller's dtype. Only the
+        samples asked for by the recording spec are generated, unless abort
+        predicates need to see the whole traces.
         """
 
-        traces = []
-        for candidate in candidates:
-            sim_var = dict(zip(parameters, candidate))
-            t, v = self.run_individual(sim_var)
-            traces.append([t, v])
+        columns = np.asarray(candidates, dtype=float).reshape(
+            len(candidates), len(parameters)
+        )
+        sim_var = dict(
+            (parameter, columns[:, k : k + 1]) for k, parameter in enumerate(parameters)
+        )
+
+        times = self.times()
+        window = slice(None)
+        if self.recording_spec is not None:
+            window = self.recording_spec.sample_slice(times)
+
+        if not self.abort_predicates:
+            times = times[window]
+            return TraceBatch(times, self.sine_waves(sim_var, times))
+
+        volts = self.sine_waves(sim_var, times)
+        aborted = self._aborted(times, volts)
+
+        return TraceBatch(
+            times[window],
+            np.ascontiguousarray(volts[:, window]),
+            aborted=aborted,
+        )
 
-        return traces
+    def run_chunked(self, candidates, parameters, chunk_time):
+        """
+        Run simulation for each candidate, yielding its trace in chunks of
+        chunk_time ms as (index, times, volts, last). The recording spec is
+        not applied to the chunks, which are dropped once analysed anyway.
+        """
+
+        for index, candidate in enumerate(candidates):
+            sim_var = dict(zip(parameters, candidate))
+            chunks = self._run_chunks(sim_var, chunk_time)
+            # look one chunk ahead to flag the last one
+            previous = next(chunks)
+            for chunk in chunks:
+                yield index, previous[0], previous[1], False
+                previous = chunk
+            yield index, previous[0], previous[1], True
@@ -1,11 +1,22 @@
+import asyncio
+import json
+import math
 import os
+import pprint
 import sys
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from threading import Thread
-from pyelectro import analysis
+
 import numpy
-import math
+from pyelectro import analysis
 
-import pprint
+from neurotune import features
+from neurotune.traces import RecordingSpec, TraceBatch
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -87,6 +98,19 @@ def normalised_cost_function(value, target, Q=None):
     return fitness
 
 
+def _normalised_costs(values, target):
+    """
+    normalised_cost_function, with Q picked automatically, applied to an
+    array of values.
+    """
+    target = float(target)
+    if target != 0:
+        Q = 7 / (300 * (target ** 2))
+    else:
+        Q = 0.023333
+    return 1 - 1 / (Q * (target - numpy.asarray(values, dtype=float)) ** 2 + 1)
+
+
 class __CandidateData(object):
     """Container for information about a candidate (chromosome)"""
 
@@ -104,131 +128,384 @@ class __CandidateData(object):
 
 
 class __Evaluator(object):
-    """Base class for Evaluators"""
+    """Base class for Evaluators
+
+    Traces can be analysed and scored in parallel by setting
+    analysis_executor to "thread", "process" or an existing
+    concurrent.futures.Executor, with analysis_workers workers. Threads share
+    the traces with the evaluator and are the best choice when the analysis
+    releases the GIL or overlaps with simulations in other processes; a
+    process pool parallelises the (pure Python) pyelectro analysis and is
+    reused across generations until close() is called. If only
+    analysis_workers > 0 is given a thread pool is used.
+
+    Evaluators given a stream_chunk_time analyse traces in streaming mode:
+    the controller hands each trace back in chunks of that many ms (see the
+    controllers' run_chunked) and the features are accumulated chunk by
+    chunk, so that whole traces of very long simulations are never held in
+    memory. Only features computable incrementally (spike times, rates,
+    extrema, interspike interval statistics) are available in this mode.
+
+    evaluate_async is the asynchronous counterpart of evaluate, for use
+    from an asyncio event loop (evaluate remains the entry point for
+    inspyred). Simulations are awaited through the controller's run_async,
+    so that controllers wrapping subprocesses, sockets or remote simulators
+    can multiplex many candidates on one event loop.
+
+    Evaluators given a traces.TraceStore (see set_trace_store) record the
+    candidates, fitness, traces and (where the evaluator can extract them
+    in batch) features of every generation, so that the optimization can
+    later be rescored with other weights or targets without re-simulating.
+    """
 
-    def __init__(self, parameters, weights, targets, controller):
+    def __init__(
+        self,
+        parameters,
+        weights,
+        targets,
+        controller,
+        analysis_workers=0,
+        analysis_executor=None,
+    ):
 
         self.parameters = parameters
         self.weights = weights
         self.targets = targets
         self.controller = controller
+        self.analysis_workers = analysis_workers
+
+        if analysis_executor not in (None, "thread", "process") and not isinstance(
+            analysis_executor, Executor
+        ):
+            raise ValueError(
+                "analysis_executor must be 'thread', 'process' or an Executor, not %s"
+                % analysis_executor
+            )
+        self.analysis_executor = analysis_executor
+        self._analysis_pool = None
+        self.trace_store = None
+
+    def __getstate__(self):
+        # Only the analysis settings are needed in worker processes
+        state = self.__dict__.copy()
+        state["controller"] = None
+        state["_analysis_pool"] = None
+        state["trace_store"] = None
+        if isinstance(self.analysis_executor, Executor):
+            state["analysis_executor"] = None
+        state["parameters"] = list(self.parameters)
+        return state
+
+    def add_abort_predicate(self, predicate):
+        """
+        Register a controllers.AbortPredicate with the controller, so that
+        simulations tripping it are stopped early and given the worst fitness.
+        """
+        if not hasattr(self.controller, "add_abort_predicate"):
+            raise ValueError(
+                "Controller %s does not support abort predicates" % self.controller
+            )
+        self.controller.add_abort_predicate(predicate)
+
+    def recording_spec(self):
+        """
+        Return the traces.RecordingSpec describing the data this evaluator
+        analyses, or None if it needs the full traces.
+        """
+        return None
+
+    def set_trace_store(self, trace_store):
+        """
+        Record every evaluated generation in trace_store, a
+        traces.TraceStore, or stop recording if it is None.
+
+        The traces of a generation are then kept in memory until all of
+        them have been scored.
+        """
+        if trace_store is not None and getattr(self, "stream_chunk_time", None):
+            raise ValueError("Traces cannot be stored in streaming mode")
+        self.trace_store = trace_store
+
+    def batch_features(self, batch):
+        """
+        Return the features of a TraceBatch to be stored along with it, as
+        a dict of feature name vs. array of values, or None if this
+        evaluator cannot extract features in batch.
+        """
+        return None
+
+    def feature_metadata(self):
+        """
+        Return a JSON serialisable description of the settings the features
+        returned by batch_features depend on.
+        """
+        return None
+
+    def _store_traces(self, candidates, traces, fitness):
+        """
+        Add a generation of candidates, their traces (a TraceBatch or a
+        list of [times, samples] pairs) and fitness to the trace store.
+        """
+        if not isinstance(traces, TraceBatch):
+            try:
+                traces = TraceBatch.from_traces(traces)
+            except ValueError:
+                # no shared time axis, only the fitness can be stored
+                self.trace_store.add(candidates, fitness)
+                return
+
+        self.trace_store.add(
+            candidates,
+            fitness,
+            batch=traces,
+            features=self.batch_features(traces),
+            metadata=self.feature_metadata(),
+        )
+
+    def _publish_recording_spec(self):
+        if hasattr(self.controller, "set_recording_spec"):
+            self.controller.set_recording_spec(self.recording_spec())
+
+    def close(self):
+        """
+        Shut down the analysis pool created by this evaluator, if any.
+        """
+        if self._analysis_pool is not None:
+            self._analysis_pool.shutdown()
+            self._analysis_pool = None
+
+    def _get_analysis_executor(self):
+        """
+        Return the executor used to score traces, or None to score inline.
+        """
+        if isinstance(self.analysis_executor, Executor):
+            return self.analysis_executor
+
+        if self.analysis_executor is None and self.analysis_workers <= 0:
+            return None
+
+        if self._analysis_pool is None:
+            max_workers = self.analysis_workers if self.analysis_workers > 0 else None
+            if self.analysis_executor == "process":
+                self._analysis_pool = ProcessPoolExecutor(max_workers=max_workers)
+            else:
+                self._analysis_pool = ThreadPoolExecutor(max_workers=max_workers)
+
+        return self._analysis_pool
+
+    def _iter_simulations(self, candidates):
+        """
+        Yield (index, times, samples) for each candidate as soon as the
+        controller has finished simulating it.
+        """
+        if hasattr(self.controller, "run_iter"):
+            return self.controller.run_iter(candidates, self.parameters)
+
+        simulations_data = self.controller.run(candidates, self.parameters)
+        return ((i, data[0], data[1]) for i, data in enumerate(simulations_data))
+
+    def _iter_chunks(self, candidates, chunk_time):
+        """
+        Yield (index, times, samples, last) for consecutive chunks of each
+        candidate's trace.
+        """
+        if hasattr(self.controller, "run_chunked"):
+            return self.controller.run_chunked(candidates, self.parameters, chunk_time)
+
+        return (
+            (index, times, samples, True)
+            for index, times, samples in self._iter_simulations(candidates)
+        )
+
+    def _score_streams(self, candidates, chunk_time, new_analysis, score):
+        """
+        Run the candidates through the controller in streaming mode.
 
+        new_analysis() creates the incremental analysis of one trace, which
+        is updated with each chunk; score(data_analysis, candidate) is
+        called once the last chunk has been analysed, with None for the
+        analysis of an aborted simulation.
 
-'''
-    PG: Disabling these until they're tested again...
-    
-class __CondorContext(object):
-    """manager for dealing with a condor-based grid"""
-        
-    def __split_list(self,alist, wanted_parts=1):
-        
-        length = len(alist)
-        return [ alist[i*length // wanted_parts: (i+1)*length // wanted_parts] 
-                 for i in range(wanted_parts) ]
-    
-    def __prepare_candidates(self,candidates,candidates_per_job=1):
-        
-        #Split candidate list into smaller ones (jobs):
-        #and make a job list
-        if optimizer_params.candidates_in_job != None:
-            candidates_in_job=optimizer_params.candidates_in_job
+        :return: fitness values in candidate order
+        """
+        fitness = [None] * len(candidates)
+        streams = {}
+
+        for index, times, samples, last in self._iter_chunks(candidates, chunk_time):
+            if samples is None:
+                streams.pop(index, None)
+                fitness[index] = score(None, candidates[index])
+                continue
+
+            if index not in streams:
+                streams[index] = new_analysis()
+            streams[index].update(times, samples)
+
+            if last:
+                fitness[index] = score(streams.pop(index), candidates[index])
+
+        return fitness
+
+    async def evaluate_async(self, candidates, args, max_concurrency=None):
+        """
+        Asynchronous counterpart of evaluate, returning the fitness values
+        in candidate order.
+
+        With max_concurrency, each candidate is simulated with its own
+        run_async call and at most max_concurrency of them are in flight at
+        once; otherwise the whole population is passed to one run_async
+        call. This default runs evaluate in the event loop's default
+        executor; evaluators scoring traces one at a time override it.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.evaluate, candidates, args)
+
+    async def _run_async(self, candidates):
+        if hasattr(self.controller, "run_async"):
+            return await self.controller.run_async(candidates, self.parameters)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.controller.run, candidates, self.parameters
+        )
+
+    async def _score_simulations_async(self, candidates, score, max_concurrency=None):
+        """
+        Asynchronous counterpart of _score_simulations (see evaluate_async).
+        Traces are scored on the analysis executor if there is one, or
+        inline on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._get_analysis_executor()
+        shared = executor is None or isinstance(executor, ThreadPoolExecutor)
+
+        fitness = [None] * len(candidates)
+        stored = None
+        if self.trace_store is not None:
+            stored = [None] * len(candidates)
+
+        async def score_trace(index, times, samples):
+            if stored is not None:
+                stored[index] = [times, samples]
+            if executor is None:
+                fitness[index] = score(times, samples, candidates[index])
+                return
+            if not shared:
+                times, samples = _trace_arrays(times, samples)
+            fitness[index] = await loop.run_in_executor(
+                executor, score, times, samples, candidates[index]
+            )
+
+        async def simulate(indices, semaphore=None):
+            group = [candidates[index] for index in indices]
+            if semaphore is None:
+                simulations_data = await self._run_async(group)
+            else:
+                async with semaphore:
+                    simulations_data = await self._run_async(group)
+            await asyncio.gather(
+                *[
+                    score_trace(index, data[0], data[1])
+                    for index, data in zip(indices, simulations_data)
+                ]
+            )
+
+        if max_concurrency is None:
+            await simulate(list(range(len(candidates))))
+        else:
+            semaphore = asyncio.Semaphore(max_concurrency)
+            await asyncio.gather(
+                *[simulate([index], semaphore) for index in range(len(candidates))]
+            )
+
+        if stored is not None:
+            self._store_traces(candidates, stored, fitness)
+
+        return fitness
+
+    def _score_simulations(self, candidates, score):
+        """
+        Run the candidates through the controller and score each trace as
+        soon as it is available.
+
+        score(times, samples, candidate) is called for every simulation,
+        on the analysis executor if there is one, so that analysis overlaps
+        with the simulations still running. Each trace is released once it
+        has been scored.
+
+        :return: fitness values in candidate order
+        """
+        fitness = [None] * len(candidates)
+
+        stored = None
+        if self.trace_store is not None:
+            stored = [None] * len(candidates)
+
+        executor = self._get_analysis_executor()
+
+        if executor is None:
+            for index, times, samples in self._iter_simulations(candidates):
+                if stored is not None:
+                    stored[index] = [times, samples]
+                fitness[index] = score(times, samples, candidates[index])
+            if stored is not None:
+                self._store_traces(candidates, stored, fitness)
+            return fitness
+
+        # threads share the traces; anything else gets them as contiguous
+        # arrays, which pickle as one buffer rather than one object per sample
+        shared = isinstance(executor, ThreadPoolExecutor)
+
+        futures = {}
+        for index, times, samples in self._iter_simulations(candidates):
+            if stored is not None:
+                stored[index] = [times, samples]
+            if not shared:
+                times, samples = _trace_arrays(times, samples)
+            future = executor.submit(score, times, samples, candidates[index])
+            futures[future] = index
+
+        for future in as_completed(futures):
+            fitness[futures[future]] = future.result()
+
+        if stored is not None:
+            self._store_traces(candidates, stored, fitness)
+
+        return fitness
+
+
+def _worst_fitness(target_dict, target_weights=None, default_weight=1.0):
+    """
+    Return the fitness of a candidate which misses every target, i.e. the
+    sum of the target weights (all of them, as IClampEvaluator always has,
+    including zero and negative weights).
+    """
+    worst_cumulative_fitness = 0
+    for target in target_dict.keys():
+        if target_weights is None:
+            target_weight = 1
         else:
-            candidates_in_job=candidates_per_job
-
-        num_candidates=len(candidates)
-        ids=range(num_candidates)
-        enumerated_candidates=zip(candidates,ids)
-        num_jobs=num_candidates/candidates_in_job
-        self.num_jobs=num_jobs
-        self.job_list=self.__split_list(enumerated_candidates,wanted_parts=self.num_jobs)
-    
-    def __make_job_file(self,job,job_number):
-        #write the header:
-        filepath = os.path.join(self.tmpdir, 'run' + str(job_number) + '.sh')
-        run_shell = open(filepath, 'w')
-        run_shell.write('#!/bin/bash\n')
-        run_shell.write('reldir=`dirname $0`\n')
-        run_shell.write('cd $reldir\n')
-        run_shell.write('directory=`pwd`\n')
-        run_shell.write('pndirectory=$directory\n')
-        run_shell.write('#Untar the file:\n')
-        run_shell.write('/bin/tar xzf ./portable-neuron.tar.gz\n')
-        tarfile_name=optimizer_params.tarred_nrnproj
-        run_shell.write('/bin/tar xzf ./'+tarfile_name+'\n')
-        
-        #CandidateData_list=[]
-        for enumerated_candidate in job:
-                
-            chromosome = enumerated_candidate[0]
-            candidate_info = CandidateData(chromosome)
-            exp_id = enumerated_candidate[1]
-            candidate_info.set_exp_id(exp_id)
-            candidate_info.set_job_num(job_number)
-            self.CandidateData_list.append(candidate_info)
-                
-            nproj = controllers.NrnProjSimRun(optimizer_params.project_path, chromosome)
-            run_shell.write('#issue the commands\n')
-            run_shell.write('$pndirectory/pnpython.sh \
-                    $directory/src/simrunner.py "sim_var[\'exp_id\'] \
-                    = ' + str(exp_id) + '\" ' + '"sim_var[\'''dbname''\'] \
-                    = \'outputdb' + str(job_number) + '.sqlite\'"' + 
-                    nproj.sim_var_string + '\n')
-            run_shell.write('echo \'done\'\n')
-        
-        run_shell.write('cp $directory/sims/outputdb' + str(job_number) + '.sqlite $directory\n')
-        #self.CandidateData_list=CandidateData_list
-        run_shell.close()
-
-    def __make_submit_file(self):
-        #now we write the submit file
-        filepath = os.path.join(self.tmpdir, 'submitfile.submit')
-        submit_file=open(filepath,'w')
-        
-        submit_file.write('universe   = vanilla\n')
-        submit_file.write('log        = pneuron.log\n')
-        submit_file.write('Error   = err.$(Process)\n')                                                
-        submit_file.write('Output  = out.$(Process)\n')
-        submit_file.write('requirements = GLIBC == "2.11"\n')
-        tarfile_name=optimizer_params.tarred_nrnproj
-        submit_file.write('transfer_input_files = portable-neuron.tar.gz,'+tarfile_name+'\n')
-        submit_file.write('should_transfer_files   = yes\n')
-        submit_file.write('when_to_transfer_output = on_exit_or_evict\n')
-        #this is where you have to do the clever stuff:
-        
-        for shellno in range(self.num_jobs):
-            submit_file.write('executable = run'+str(shellno)+'.sh\n')
-            submit_file.write('queue\n')
-        
-        #finally close the submit file
-        submit_file.close()
-    
-    def __build_condor_files(self,candidates,candidates_per_job=100):
-        
-        #prepare list of candidates to be farmed on grid:
-        self.__prepare_candidates(candidates,candidates_per_job=100)
-        
-        #make the job files (shell scripts to be executed on the execute nodes)
-        job_number=0 #run shell script number
-        for job in self.job_list:
-            self.__make_job_file(job,job_number)
-            job_number+=1
-        
-        #now make the submit file
-        self.__make_submit_file()
-
-    def __delete_remote_files(self,host):
-        import ssh_utils
-        command='rm -rf ./*'
-        ssh_utils.issue_command(host, command)
-    
-    def __put_multiple_files(self,host,filelist,localdir='/',remotedir='/'):
-        import ssh_utils
-        
-        for file in filelist:
-            localpath=os.path.join(localdir,file)
-            remotepath=os.path.join(remotedir,file)
-            ssh_utils.put_file(host,localpath,remotepath)
-'''
+            target_weight = target_weights.get(target, default_weight)
+
+        worst_cumulative_fitness += target_weight
+
+    return worst_cumulative_fitness
+
+
+def _target_entity(target):
+    """Entity a network target refers to, e.g. cell0 for cell0:maximum"""
+    return target.split("/")[0].split(":")[0]
+
+
+def _trace_arrays(times, samples):
+    """Return times and samples (an array or a dict of arrays) as numpy arrays"""
+    if samples is None:
+        pass
+    elif isinstance(samples, dict):
+        samples = dict((ref, numpy.asarray(v)) for ref, v in samples.items())
+    else:
+        samples = numpy.asarray(samples)
+    return numpy.asarray(times), samples
 
 
 class DumbEvaluator(__Evaluator):
@@ -242,10 +519,17 @@ class DumbEvaluator(__Evaluator):
         self.fitness_filename_prefix = fitness_filename_prefix
         self.threads_number = threads_number
 
+    def set_trace_store(self, trace_store):
+        """
+        The simulations' traces never reach this evaluator, so none can be stored.
+        """
+        if trace_store is not None:
+            raise ValueError("DumbEvaluator cannot store traces")
+
     def evaluate(self, candidates, args):
 
         threads_number = int(self.threads_number)
-        candidates_per_thread = (len(candidates)) / threads_number
+        candidates_per_thread = (len(candidates)) // threads_number
         remainder_candidates = len(candidates) % threads_number
         chunk_begin = 0
         chunk_end = candidates_per_thread
@@ -287,7 +571,7 @@ class DumbEvaluator(__Evaluator):
                 # we should let the main thread handle keybord interrupts
                 while True:
                     threads[i].join(1)
-                    if not threads[i].isAlive():
+                    if not threads[i].is_alive():
                         break
 
                 # get their fitness from the file
@@ -301,12 +585,110 @@ class DumbEvaluator(__Evaluator):
         return fitness
 
 
+def _pptd_error(pptd_density, t, v):
+    """
+    Return the PPTD error of a trace, or infinity (the worst cost) if it
+    cannot be computed, so that only the pptd_error target is penalised.
+    """
+    try:
+        return pptd_density.error(t, v)
+    except:
+        print("Cannot compute the PPTD error, setting it to infinity")
+        return float("inf")
+
+
+class _LazyIClampResults(dict):
+    """
+    analysis_results of an IClampAnalysis which computes each feature the
+    first time it is looked up, following IClampAnalysis.analyse.
+
+    Used when pruning so that features of abandoned candidates are never
+    calculated.
+    """
+
+    def __init__(self, data_analysis, pptd_density=None):
+        super(_LazyIClampResults, self).__init__()
+        self.data_analysis = data_analysis
+        self.pptd_density = pptd_density
+        self._spike_widths = None
+
+    def spike_widths(self):
+        if self._spike_widths is None:
+            a = self.data_analysis
+            self._spike_widths = analysis.spike_widths(
+                a.v, a.t, a.max_min_dictionary, a.baseline, a.delta
+            )
+        return self._spike_widths
+
+    def __missing__(self, feature):
+        a = self.data_analysis
+        max_min_dictionary = a.max_min_dictionary
+        maxima_times = max_min_dictionary["maxima_times"]
+        maxima_values = max_min_dictionary["maxima_values"]
+        minima_times = max_min_dictionary["minima_times"]
+        minima_values = max_min_dictionary["minima_values"]
+
+        if feature == "average_minimum":
+            value = numpy.average(minima_values)
+        elif feature == "average_maximum":
+            value = numpy.average(maxima_values)
+        elif feature == "min_peak_no":
+            value = max_min_dictionary["minima_number"]
+        elif feature == "max_peak_no":
+            value = max_min_dictionary["maxima_number"]
+        elif feature == "mean_spike_frequency":
+            value = analysis.mean_spike_frequency(maxima_times)
+        elif feature == "interspike_time_covar":
+            value = analysis.spike_covar(maxima_times)
+        elif feature == "first_spike_time":
+            value = maxima_times[0]
+        elif feature == "max_interspike_time":
+            value = analysis.max_min_interspike_time(maxima_times)[0]
+        elif feature == "min_interspike_time":
+            value = analysis.max_min_interspike_time(maxima_times)[1]
+        elif feature == "trough_phase_adaptation":
+            trough_phases = analysis.minima_phases(max_min_dictionary)
+            value = analysis.exp_fit(trough_phases[0], trough_phases[1])
+        elif feature == "spike_width_adaptation":
+            spike_width_list = self.spike_widths()
+            value = analysis.exp_fit(spike_width_list[0], spike_width_list[1])
+        elif feature == "spike_broadening":
+            value = analysis.spike_broadening(self.spike_widths()[1])
+        elif feature == "peak_decay_exponent":
+            value = analysis.three_spike_adaptation(maxima_times, maxima_values)
+        elif feature == "trough_decay_exponent":
+            value = analysis.three_spike_adaptation(minima_times, minima_values)
+        elif feature == "spike_frequency_adaptation":
+            spike_frequency_list = analysis.spike_frequencies(maxima_times)
+            value = analysis.exp_fit(spike_frequency_list[0], spike_frequency_list[1])
+        elif feature == "peak_linear_gradient":
+            value = analysis.linear_fit(maxima_times, maxima_values)
+        elif feature == "pptd_error" and self.pptd_density is not None:
+            value = _pptd_error(self.pptd_density, a.t, a.v)
+        else:
+            raise KeyError(feature)
+
+        self[feature] = value
+        return value
+
+
 class IClampEvaluator(__Evaluator):
     """
     Locally-evaluates (not using cluster or grid computing) a model.
 
     The evaluate routine runs the model and returns its fitness value
 
+    If prune_survivors is set, candidates are abandoned as soon as they can
+    no longer be among the prune_survivors fittest candidates evaluated so
+    far: targets are scored in decreasing order of weight times the average
+    cost seen for them, features are only computed when their target is
+    scored, and scoring stops once the partial fitness exceeds the
+    prune_survivors-th best fitness of the previous generations. Abandoned
+    candidates get that partial fitness, which is a lower bound of their
+    full fitness (the cost functions are non-negative), so the ranking of
+    the candidates which could survive selection is unaffected. Set it to
+    at least the population size.
+
     """
 
     def __init__(
@@ -321,9 +703,22 @@ class IClampEvaluator(__Evaluator):
         targets=None,
         automatic=False,
         verbose=True,
+        analysis_workers=0,
+        analysis_executor=None,
+        prune_survivors=None,
+        recording_dt=None,
+        stream_chunk_time=None,
+        vectorized_analysis=False,
     ):
 
-        super(IClampEvaluator, self).__init__(parameters, weights, targets, controller)
+        super(IClampEvaluator, self).__init__(
+            parameters,
+            weights,
+            targets,
+            controller,
+            analysis_workers,
+            analysis_executor,
+        )
 
         self.analysis_start_time = analysis_start_time
         self.analysis_end_time = analysis_end_time
@@ -331,6 +726,16 @@ class IClampEvaluator(__Evaluator):
         self.analysis_var = analysis_var
         self.verbose = verbose
 
+        self.prune_survivors = prune_survivors
+        self._survivor_fitness = []
+        self._target_costs = {}
+        self._cost_log = None
+
+        self.recording_dt = recording_dt
+        self.stream_chunk_time = stream_chunk_time
+        self.vectorized_analysis = vectorized_analysis
+        self._pptd_density = None
+
         print("target data path in evaluator:" + target_data_path)
 
         if automatic is True:
@@ -354,135 +759,654 @@ class IClampEvaluator(__Evaluator):
             print("Obtained targets are:")
             print(self.targets)
 
+        if stream_chunk_time and vectorized_analysis:
+            raise ValueError(
+                "Streaming mode and vectorized analysis cannot be combined"
+            )
+
+        for mode, enabled, available in (
+            ("streaming mode", stream_chunk_time, features.STREAMABLE_ICLAMP_FEATURES),
+            ("vectorized analysis", vectorized_analysis, features.BATCH_ICLAMP_FEATURES),
+        ):
+            if not enabled:
+                continue
+            unavailable = [
+                target
+                for target in self.targets
+                if (weights is None or weights.get(target, 1.0) > 0)
+                and target not in available
+            ]
+            if unavailable:
+                raise ValueError(
+                    "Targets %s cannot be computed in %s" % (unavailable, mode)
+                )
+
+        self._publish_recording_spec()
+
+    def recording_spec(self):
+        """
+        Only the analysis window, at recording_dt if given, is analysed.
+        """
+        return RecordingSpec(
+            self.analysis_start_time, self.analysis_end_time, dt=self.recording_dt
+        )
+
     def evaluate(self, candidates, args):
 
         print("\n>>>>>  Evaluating: ")
         for cand in candidates:
             print(">>>>>       %s" % cand)
 
-        simulations_data = self.controller.run(candidates, self.parameters)
+        if self.stream_chunk_time:
+            fitness = self._score_streams(
+                candidates,
+                self.stream_chunk_time,
+                self.new_stream_analysis,
+                self.score_stream,
+            )
+        elif self.vectorized_analysis:
+            fitness = self._score_batch(candidates)
+        elif self._costs_recorded_remotely():
+            fitness = self._merge_costs(
+                self._score_simulations(candidates, self._score_trace_with_costs)
+            )
+        else:
+            fitness = self._score_simulations(candidates, self.score_trace)
 
-        fitness = []
+        self._keep_survivors(fitness)
 
-        for data in simulations_data:
+        return fitness
 
-            times = data[0]
-            samples = data[1]
+    async def evaluate_async(self, candidates, args, max_concurrency=None):
 
-            data_analysis = analysis.IClampAnalysis(
-                samples,
-                times,
-                self.analysis_var,
-                start_analysis=self.analysis_start_time,
-                end_analysis=self.analysis_end_time,
-                target_data_path=self.target_data_path,
+        if self.stream_chunk_time or self.vectorized_analysis:
+            return await super(IClampEvaluator, self).evaluate_async(
+                candidates, args, max_concurrency
             )
 
-            try:
-                data_analysis.analyse()
-            except:
-                data_analysis.analysable_data = False
-
-            fitness_value = self.evaluate_fitness(
-                data_analysis,
-                self.targets,
-                self.weights,
-                cost_function=normalised_cost_function,
+        if self._costs_recorded_remotely():
+            fitness = self._merge_costs(
+                await self._score_simulations_async(
+                    candidates, self._score_trace_with_costs, max_concurrency
+                )
+            )
+        else:
+            fitness = await self._score_simulations_async(
+                candidates, self.score_trace, max_concurrency
             )
-            fitness.append(fitness_value)
 
-            print("Fitness: %s\n" % fitness_value)
+        self._keep_survivors(fitness)
 
         return fitness
 
-    def evaluate_fitness(
-        self,
-        data_analysis,
-        target_dict={},
-        target_weights=None,
-        cost_function=normalised_cost_function,
-    ):
+    def _costs_recorded_remotely(self):
         """
-        Return the estimated fitness of the data, based on the cost function being used.
-            :param data_analysis: IClampAnalysis instance
-            :param target_dict: key-value pairs for targets
-            :param target_weights: key-value pairs for target weights
-            :param cost_function: cost function (callback) to assign individual targets sub-fitness.
+        Whether traces are scored on a copy of this evaluator in another
+        process while pruning, so that the target costs recorded for
+        ordering the targets must be sent back with the fitness.
         """
+        executor = self._get_analysis_executor()
+        return (
+            bool(self.prune_survivors)
+            and executor is not None
+            and not isinstance(executor, ThreadPoolExecutor)
+        )
 
-        # calculate max fitness value (TODO: there may be a more pythonic way to do this..)
-        worst_cumulative_fitness = 0
-        for target in target_dict.keys():
-            if target_weights is None:
-                target_weight = 1
-            else:
-                if target in target_weights.keys():
-                    target_weight = target_weights[target]
-                else:
-                    target_weight = 1.0
+    def _score_trace_with_costs(self, times, samples, candidate=None):
+        """
+        Score a trace with score_trace and return the fitness together with
+        the (target, cost) pairs recorded meanwhile.
+        """
+        self._cost_log = []
+        fitness = self.score_trace(times, samples, candidate)
+        return fitness, self._cost_log
 
-            worst_cumulative_fitness += target_weight
+    def _merge_costs(self, scored):
+        """
+        Record the target costs returned by _score_trace_with_costs and
+        return the fitness values.
+        """
+        for fitness, costs in scored:
+            for target, cost in costs:
+                self._record_cost(target, cost)
+        return [fitness for fitness, costs in scored]
 
-        # if we have 1 or 0 peaks we won't conduct any analysis
-        if data_analysis.analysable_data is False:
-            print("Data is non-analysable")
-            return worst_cumulative_fitness
+    def _keep_survivors(self, fitness):
+        if self.prune_survivors:
+            survivors = sorted(self._survivor_fitness + fitness)
+            self._survivor_fitness = survivors[: self.prune_survivors]
 
-        else:
-            fitness = 0
+    def prune_bound(self):
+        """
+        Return the fitness above which candidates are abandoned, or None if
+        no candidate can be abandoned (yet).
+        """
+        if self.prune_survivors and len(self._survivor_fitness) >= self.prune_survivors:
+            return self._survivor_fitness[-1]
+        return None
 
-            for target in target_dict.keys():
+    def worst_fitness(self):
+        """
+        Return the fitness given to candidates which cannot be analysed.
+        """
+        return _worst_fitness(self.targets, self.weights)
 
-                target_value = target_dict[target]
-                cost = "?"
+    def score_trace(self, times, samples, candidate=None):
+        """
+        Analyse a single simulation and return its fitness.
+        """
 
-                if target_weights is None:
-                    target_weight = 1
-                else:
-                    if target in target_weights.keys():
-                        target_weight = target_weights[target]
-                    else:
-                        target_weight = 1.0
-                if target_weight > 0:
-                    value = data_analysis.analysis_results[target]
-                    # let function pick Q automatically
-                    cost = cost_function(value, target_value)
-                    inc = target_weight * cost
-                    fitness += inc
-                    if self.verbose:
-                        print(
-                            "Target %s (weight %s): target val: %s, actual: %s, cost: %s, fitness inc: %s"
-                            % (target, target_weight, target_value, value, cost, inc)
-                        )
+        if samples is None:
+            print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+            return self.worst_fitness()
+
+        # pptd_error is computed against the cached target density rather
+        # than by pyelectro, which would reload the target data every time
+        data_analysis = analysis.IClampAnalysis(
+            samples,
+            times,
+            self.analysis_var,
+            start_analysis=self.analysis_start_time,
+            end_analysis=self.analysis_end_time,
+        )
 
-            return fitness
+        pptd_density = self.pptd_density()
+        lazy = self.prune_bound() is not None
 
+        if lazy:
+            data_analysis.analysis_results = _LazyIClampResults(
+                data_analysis, pptd_density
+            )
+        else:
+            try:
+                data_analysis.analyse()
+            except:
+                data_analysis.analysable_data = False
+            if pptd_density is not None and data_analysis.analysis_results:
+                data_analysis.analysis_results["pptd_error"] = _pptd_error(
+                    pptd_density, data_analysis.t, data_analysis.v
+                )
 
-class NetworkEvaluator(__Evaluator):
-    """
-    Locally-evaluates (not using cluster or grid computing) a model.
+        return self._score_analysis(data_analysis)
 
-    The evaluate routine runs the model and returns its fitness value
+    def pptd_density(self):
+        """
+        Return the features.PhasePlaneDensity of the target data, built on
+        first use, or None if pptd_error is not a weighted target.
+        """
+        if self._pptd_density is None and self.target_data_path:
+            weighted = self.weights is None or self.weights.get("pptd_error", 1.0) > 0
+            if self.targets and "pptd_error" in self.targets and weighted:
+                self._pptd_density = features.PhasePlaneDensity.from_csv(
+                    self.target_data_path,
+                    dvdt_threshold=self.analysis_var["dvdt_threshold"],
+                )
+        return self._pptd_density
 
-    """
+    def _score_batch(self, candidates):
+        """
+        Run all candidates and analyse their traces together with
+        features.BatchIClampAnalysis.
+        """
+        simulations_data = self.controller.run(candidates, self.parameters)
 
-    def __init__(
-        self,
-        analysis_start_time,
-        controller,
-        analysis_end_time,
-        parameters,
-        analysis_var,
+        if isinstance(simulations_data, TraceBatch):
+            batch = simulations_data
+        else:
+            simulations_data = list(simulations_data)
+            try:
+                batch = TraceBatch.from_traces(simulations_data)
+            except ValueError:
+                # no shared time axis, analyse the traces one by one
+                return [
+                    self.score_trace(data[0], data[1], candidate)
+                    for data, candidate in zip(simulations_data, candidates)
+                ]
+
+        if batch.samples.shape[1] != 1:
+            raise ValueError("IClampEvaluator requires single channel traces")
+
+        completed = numpy.flatnonzero(~batch.aborted)
+        volts = batch.channel(0)
+        if len(completed) < len(batch):
+            volts = volts[completed]
+
+        data_analysis = None
+        if len(completed) > 0:
+            data_analysis = features.BatchIClampAnalysis(
+                volts,
+                batch.times,
+                self.analysis_var,
+                start_analysis=self.analysis_start_time,
+                end_analysis=self.analysis_end_time,
+                pptd_density=self.pptd_density(),
+            )
+            data_analysis.analyse()
+
+        rows = dict((index, row) for row, index in enumerate(completed))
+        fitness = []
+
+        for index in range(len(candidates)):
+            if index not in rows:
+                print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+                fitness.append(self.worst_fitness())
+                continue
+
+            fitness.append(self._score_analysis(data_analysis.trace(rows[index])))
+
+        if self.trace_store is not None:
+            self._store_traces(candidates, batch, fitness)
+
+        return fitness
+
+    def batch_features(self, batch, pptd_density=None):
+        """
+        Return the BATCH_ICLAMP_FEATURES of the traces in batch, and
+        whether each trace is analysable, as arrays with one value per
+        candidate (NaN for aborted and non-analysable simulations).
+
+        pptd_error is included if a pptd_density is given or pptd_error is
+        a weighted target.
+        """
+        if pptd_density is None:
+            pptd_density = self.pptd_density()
+
+        completed = numpy.flatnonzero(~batch.aborted)
+        names = [
+            f
+            for f in features.BATCH_ICLAMP_FEATURES
+            if f != "pptd_error" or pptd_density is not None
+        ]
+        analysed = dict((f, numpy.full(len(batch), numpy.nan)) for f in names)
+        analysed["analysable"] = numpy.zeros(len(batch), dtype=bool)
+
+        if len(completed) > 0:
+            data_analysis = features.BatchIClampAnalysis(
+                batch.channel(0)[completed],
+                batch.times,
+                self.analysis_var,
+                start_analysis=self.analysis_start_time,
+                end_analysis=self.analysis_end_time,
+                pptd_density=pptd_density,
+            )
+            for feature, values in data_analysis.analyse().items():
+                analysed[feature][completed] = values
+            analysed["analysable"][completed] = data_analysis.analysable_data
+
+        return analysed
+
+    def feature_metadata(self):
+        """
+        The stored features depend on the analysis settings and, for
+        pptd_error, on the target data.
+        """
+        return {
+            "analysis_var": self.analysis_var,
+            "analysis_start_time": self.analysis_start_time,
+            "analysis_end_time": self.analysis_end_time,
+            "target_data_path": self.target_data_path,
+        }
+
+    def rescore(
+        self,
+        trace_store,
+        weights=None,
+        targets=None,
+        cost_function=normalised_cost_function,
+    ):
+        """
+        Recompute the fitness of every candidate in trace_store with new
+        weights, targets and/or cost function (by default the evaluator's
+        own), without re-simulating, and rank them.
+
+        If every weighted target is one of features.BATCH_ICLAMP_FEATURES,
+        stored features are reused if they were extracted with the current
+        analysis settings and include every weighted target; otherwise they
+        are extracted again from the stored traces, a generation at a time
+        with features.BatchIClampAnalysis. With the default cost function,
+        the fitness of a whole generation is then computed with array
+        operations. Any other target is computed by analysing the stored
+        traces one by one with pyelectro's IClampAnalysis, as score_trace
+        does.
+
+        :param trace_store: traces.TraceStore written by this evaluator
+        :param weights: key-value pairs for target weights
+        :param targets: key-value pairs for targets
+        :param cost_function: cost function (callback) to assign individual
+            targets sub-fitness
+
+        :return: list of (fitness, candidate) pairs, fittest first
+        """
+        if weights is None:
+            weights = self.weights
+        if targets is None:
+            targets = self.targets
+
+        weighted = [
+            (target, 1.0 if weights is None else weights.get(target, 1.0))
+            for target in targets
+        ]
+        weighted = [(target, weight) for target, weight in weighted if weight > 0]
+
+        batched = all(
+            target in features.BATCH_ICLAMP_FEATURES for target, weight in weighted
+        )
+
+        pptd_density = None
+        if any(target == "pptd_error" for target, weight in weighted):
+            pptd_density = self.pptd_density()
+            if pptd_density is None:
+                pptd_density = features.PhasePlaneDensity.from_csv(
+                    self.target_data_path,
+                    dvdt_threshold=self.analysis_var["dvdt_threshold"],
+                )
+
+        metadata = json.loads(json.dumps(self.feature_metadata(), sort_keys=True))
+        worst = _worst_fitness(targets, weights)
+
+        fitness = []
+        candidates = []
+
+        for stored in trace_store.batches():
+            analysed = stored["features"]
+            reusable = batched and stored["metadata"] == metadata
+            reusable = reusable and all(
+                target in analysed for target, weight in weighted
+            )
+            if not reusable and stored["batch"] is None:
+                raise ValueError(
+                    "Features cannot be extracted again from a store without traces"
+                )
+
+            if not batched:
+                generation_fitness = self._rescore_traces(
+                    stored["batch"], weighted, targets, worst, cost_function, pptd_density
+                )
+            else:
+                if not reusable:
+                    analysed = self.batch_features(stored["batch"], pptd_density)
+
+                generation_fitness = numpy.zeros(len(stored["fitness"]))
+                for target, weight in weighted:
+                    if cost_function is normalised_cost_function:
+                        costs = _normalised_costs(analysed[target], targets[target])
+                    else:
+                        costs = [
+                            cost_function(value, targets[target])
+                            for value in analysed[target]
+                        ]
+                    generation_fitness += weight * numpy.asarray(costs, dtype=float)
+                generation_fitness[~analysed["analysable"]] = worst
+
+            fitness.append(generation_fitness)
+            candidates.append(stored["candidates"])
+
+        if len(fitness) == 0:
+            return []
+
+        fitness = numpy.concatenate(fitness)
+        candidates = numpy.concatenate(candidates)
+        order = numpy.argsort(fitness, kind="stable")
+
+        return [(fitness[i], list(candidates[i])) for i in order]
+
+    def _rescore_traces(
+        self, batch, weighted, targets, worst, cost_function, pptd_density
+    ):
+        """
+        Return the fitness of each trace of a stored TraceBatch, analysed
+        one by one with IClampAnalysis, given the (target, weight) pairs of
+        the weighted targets.
+        """
+        fitness = numpy.full(len(batch), float(worst))
+
+        for index in numpy.flatnonzero(~batch.aborted):
+            data_analysis = analysis.IClampAnalysis(
+                numpy.asarray(batch.channel(0)[index], dtype=float),
+                numpy.asarray(batch.times, dtype=float),
+                self.analysis_var,
+                start_analysis=self.analysis_start_time,
+                end_analysis=self.analysis_end_time,
+            )
+            try:
+                data_analysis.analyse()
+            except:
+                continue
+            if data_analysis.analysable_data is False:
+                continue
+
+            results = data_analysis.analysis_results
+            if pptd_density is not None:
+                results["pptd_error"] = _pptd_error(
+                    pptd_density, data_analysis.t, data_analysis.v
+                )
+
+            fitness[index] = sum(
+                weight * cost_function(results[target], targets[target])
+                for target, weight in weighted
+            )
+
+        return fitness
+
+    def new_stream_analysis(self):
+        """
+        Return the incremental analysis of one trace in streaming mode.
+        """
+        return features.StreamingIClampAnalysis(
+            self.analysis_var,
+            start_analysis=self.analysis_start_time,
+            end_analysis=self.analysis_end_time,
+        )
+
+    def score_stream(self, data_analysis, candidate=None):
+        """
+        Return the fitness of a simulation analysed in streaming mode, given
+        its features.StreamingIClampAnalysis (None if it was aborted).
+        """
+
+        if data_analysis is None:
+            print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+            return self.worst_fitness()
+
+        data_analysis.analysis_results = _LazyIClampResults(data_analysis)
+
+        return self._score_analysis(data_analysis)
+
+    def _score_analysis(self, data_analysis):
+        """
+        Return the fitness of an analysed simulation. A feature failing
+        (with lazy analysis results) or missing from the analysis results
+        makes the data non-analysable, as it would have in
+        IClampAnalysis.analyse.
+        """
+        try:
+            fitness_value = self.evaluate_fitness(
+                data_analysis,
+                self.targets,
+                self.weights,
+                cost_function=normalised_cost_function,
+            )
+        except:
+            # a feature failed or is missing, as analyse() would have failed
+            data_analysis.analysable_data = False
+            fitness_value = self.evaluate_fitness(
+                data_analysis,
+                self.targets,
+                self.weights,
+                cost_function=normalised_cost_function,
+            )
+
+        print("Fitness: %s\n" % fitness_value)
+
+        return fitness_value
+
+    def evaluate_fitness(
+        self,
+        data_analysis,
+        target_dict={},
+        target_weights=None,
+        cost_function=normalised_cost_function,
+    ):
+        """
+        Return the estimated fitness of the data, based on the cost function being used.
+            :param data_analysis: IClampAnalysis instance
+            :param target_dict: key-value pairs for targets
+            :param target_weights: key-value pairs for target weights
+            :param cost_function: cost function (callback) to assign individual targets sub-fitness.
+        """
+
+        worst_cumulative_fitness = _worst_fitness(target_dict, target_weights)
+
+        # if we have 1 or 0 peaks we won't conduct any analysis
+        if data_analysis.analysable_data is False:
+            print("Data is non-analysable")
+            return worst_cumulative_fitness
+
+        else:
+            fitness = 0
+
+            bound = self.prune_bound()
+            targets = target_dict.keys()
+            if bound is not None:
+                targets = self._pruning_order(target_dict, target_weights)
+
+            for target in targets:
+
+                target_value = target_dict[target]
+                cost = "?"
+
+                if target_weights is None:
+                    target_weight = 1
+                else:
+                    if target in target_weights.keys():
+                        target_weight = target_weights[target]
+                    else:
+                        target_weight = 1.0
+                if target_weight > 0:
+                    value = data_analysis.analysis_results[target]
+                    # let function pick Q automatically
+                    cost = cost_function(value, target_value)
+                    inc = target_weight * cost
+                    fitness += inc
+                    if self.prune_survivors:
+                        self._record_cost(target, cost)
+                    if self.verbose:
+                        print(
+                            "Target %s (weight %s): target val: %s, actual: %s, cost: %s, fitness inc: %s"
+                            % (target, target_weight, target_value, value, cost, inc)
+                        )
+
+                    if bound is not None and fitness > bound:
+                        if self.verbose:
+                            print(
+                                "Abandoning candidate: fitness %s already exceeds %s"
+                                % (fitness, bound)
+                            )
+                        break
+
+            return fitness
+
+    def _record_cost(self, target, cost):
+        total, count = self._target_costs.get(target, (0.0, 0))
+        self._target_costs[target] = (total + cost, count + 1)
+        if self._cost_log is not None:
+            self._cost_log.append((target, cost))
+
+    def _pruning_order(self, target_dict, target_weights=None):
+        """
+        Order targets by decreasing weight times average cost, so that
+        hopeless candidates exceed the bound after as few features as possible.
+        """
+
+        def expected_inc(target):
+            if target_weights is None:
+                target_weight = 1
+            else:
+                target_weight = target_weights.get(target, 1.0)
+            total, count = self._target_costs.get(target, (1.0, 1))
+            return target_weight * total / count
+
+        return sorted(target_dict.keys(), key=expected_inc, reverse=True)
+
+
+class NetworkEvaluator(__Evaluator):
+    """
+    Locally-evaluates (not using cluster or grid computing) a model.
+
+    The evaluate routine runs the model and returns its fitness value
+
+    With stream_chunk_time, traces are analysed in streaming mode; all
+    weighted targets must then be accepted by
+    features.streamable_network_target.
+
+    With vectorized_analysis, the traces of all population members are
+    analysed together as one (members x samples) array by
+    features.BatchNetworkAnalysis instead of one by one by pyelectro's
+    NetworkAnalysis, which is much faster for large populations.
+
+    """
+
+    def __init__(
+        self,
+        analysis_start_time,
+        controller,
+        analysis_end_time,
+        parameters,
+        analysis_var,
         weights,
         targets=None,
+        analysis_workers=0,
+        analysis_executor=None,
+        recording_dt=None,
+        stream_chunk_time=None,
+        vectorized_analysis=False,
     ):
 
-        super(NetworkEvaluator, self).__init__(parameters, weights, targets, controller)
+        super(NetworkEvaluator, self).__init__(
+            parameters,
+            weights,
+            targets,
+            controller,
+            analysis_workers,
+            analysis_executor,
+        )
 
         self.analysis_start_time = analysis_start_time
         self.analysis_end_time = analysis_end_time
         self.analysis_var = analysis_var
         self.targets = targets
+        self.recording_dt = recording_dt
+        self.stream_chunk_time = stream_chunk_time
+        self.vectorized_analysis = vectorized_analysis
+
+        if stream_chunk_time:
+            unavailable = [
+                target
+                for target in targets
+                if (weights is None or weights.get(target, 0) > 0)
+                and not features.streamable_network_target(target)
+            ]
+            if unavailable:
+                raise ValueError(
+                    "Targets %s cannot be computed in streaming mode" % unavailable
+                )
+
+        self._publish_recording_spec()
+
+    def recording_spec(self):
+        """
+        Only the analysis window of the population members mentioned in the
+        targets (e.g. cell0 for cell0:mean_spike_frequency) is analysed.
+        """
+        channels = None
+        if self.targets is not None:
+            channels = sorted(set(target.rsplit(":", 1)[0] for target in self.targets))
+        return RecordingSpec(
+            self.analysis_start_time,
+            self.analysis_end_time,
+            dt=self.recording_dt,
+            channels=channels,
+        )
 
     def evaluate(self, candidates, args):
 
@@ -490,17 +1414,93 @@ class NetworkEvaluator(__Evaluator):
         for cand in candidates:
             print(">>>>>       %s" % cand)
 
-        simulations_data = self.controller.run(candidates, self.parameters)
+        if self.stream_chunk_time:
+            return self._score_streams(
+                candidates,
+                self.stream_chunk_time,
+                self.new_stream_analysis,
+                self.score_stream,
+            )
 
-        fitness = []
+        return self._score_simulations(candidates, self.score_trace)
+
+    async def evaluate_async(self, candidates, args, max_concurrency=None):
+
+        if self.stream_chunk_time:
+            return await super(NetworkEvaluator, self).evaluate_async(
+                candidates, args, max_concurrency
+            )
+
+        return await self._score_simulations_async(
+            candidates, self.score_trace, max_concurrency
+        )
+
+    def worst_fitness(self):
+        """
+        Return the fitness given to candidates which cannot be analysed.
+        """
+        return _worst_fitness(self.targets, self.weights, default_weight=0)
+
+    def new_stream_analysis(self):
+        """
+        Return the incremental analysis of one network trace in streaming mode.
+        """
+        return features.StreamingNetworkAnalysis(
+            self.analysis_var,
+            start_analysis=self.analysis_start_time,
+            end_analysis=self.analysis_end_time,
+            targets=self.targets,
+        )
+
+    def score_stream(self, data_analysis, candidate=None):
+        """
+        Return the fitness of a network simulation analysed in streaming
+        mode, given its features.StreamingNetworkAnalysis (None if it was
+        aborted).
+        """
 
-        for i in range(len(simulations_data)):
+        if data_analysis is None:
+            print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+            return self.worst_fitness()
+
+        print(
+            "- Evaluating %s from %s -> %s (streamed)"
+            % (candidate, self.analysis_start_time, self.analysis_end_time)
+        )
 
-            data = simulations_data[i]
-            candidate = candidates[i]
-            times = data[0]
-            volts = data[1]
+        data_analysis.analyse(self.targets)
 
+        fitness_value = self.evaluate_fitness(
+            data_analysis,
+            self.targets,
+            self.weights,
+            cost_function=normalised_cost_function,
+        )
+
+        print("Fitness: %s\n" % fitness_value)
+
+        return fitness_value
+
+    def score_trace(self, times, volts, candidate=None):
+        """
+        Analyse a single network simulation and return its fitness.
+        """
+
+        if volts is None:
+            print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+            return self.worst_fitness()
+
+        if self.vectorized_analysis:
+            refs = list(volts.keys())
+            data_analysis = features.BatchNetworkAnalysis(
+                numpy.array([volts[ref] for ref in refs]),
+                times,
+                self.analysis_var,
+                refs,
+                start_analysis=self.analysis_start_time,
+                end_analysis=self.analysis_end_time,
+            )
+        else:
             data_analysis = analysis.NetworkAnalysis(
                 volts,
                 times,
@@ -509,30 +1509,29 @@ class NetworkEvaluator(__Evaluator):
                 end_analysis=self.analysis_end_time,
             )
 
-            print(
-                "- Evaluating %s from %s -> %s (data %s -> %s)"
-                % (
-                    candidate,
-                    self.analysis_start_time,
-                    self.analysis_end_time,
-                    times[0],
-                    times[-1],
-                )
+        print(
+            "- Evaluating %s from %s -> %s (data %s -> %s)"
+            % (
+                candidate,
+                self.analysis_start_time,
+                self.analysis_end_time,
+                times[0],
+                times[-1],
             )
+        )
 
-            data_analysis.analyse(self.targets)
+        data_analysis.analyse(self.targets)
 
-            fitness_value = self.evaluate_fitness(
-                data_analysis,
-                self.targets,
-                self.weights,
-                cost_function=normalised_cost_function,
-            )
-            fitness.append(fitness_value)
+        fitness_value = self.evaluate_fitness(
+            data_analysis,
+            self.targets,
+            self.weights,
+            cost_function=normalised_cost_function,
+        )
 
-            print("Fitness: %s\n" % fitness_value)
+        print("Fitness: %s\n" % fitness_value)
 
-        return fitness
+        return fitness_value
 
     def evaluate_fitness(
         self,
@@ -551,6 +1550,9 @@ class NetworkEvaluator(__Evaluator):
 
         fitness = 0
 
+        # entities with results, indexed on the first missing target
+        analysed_entities = None
+
         for target in target_dict.keys():
 
             target_value = target_dict[target]
@@ -578,14 +1580,14 @@ class NetworkEvaluator(__Evaluator):
                 else:
                     # Check if any targets for the provided entity are included
                     # in the analysis results. If not, something is wrong.
-                    valid = False
-                    entity = target.split("/")[0].split(":")[0]
-                    for atarget in data_analysis.analysis_results.keys():
-                        if entity in atarget:
-                            valid = True
-                            break
-
-                    if not valid:
+                    if analysed_entities is None:
+                        analysed_entities = set(
+                            _target_entity(atarget)
+                            for atarget in data_analysis.analysis_results.keys()
+                        )
+                    entity = _target_entity(target)
+
+                    if entity not in analysed_entities:
                         raise RuntimeError("No target values for entity {} were found in the analysis results.  Please check your target parameter strings.\nAll target parameters are: {}".format(entity, data_analysis.analysis_results.keys()))
 
                     value = (
@@ -606,186 +1608,60 @@ class NetworkEvaluator(__Evaluator):
         return fitness
 
 
-'''
-class IClampCondorEvaluator(IClampEvaluator):
+def point_target_times(targets):
     """
-    Evaluate simulations and return their fitness on a condor grid.
-    
-        Tested and known to work on CamGrid 
-        (http://www.escience.cam.ac.uk/projects/camgrid/)
-      
-        WARNING:
-        this entire class should now be considered obsolete, the evaluator
-        is just an IClampEvaluator and everything here that is different
-        from that class needs to become its own controller
+    Parse the sample times out of point targets.
+
+    Point targets are named ``value_<time>``, e.g. ``value_200`` for the
+    value at 200 ms.
 
+    :param targets: iterable of point target names
+    :return: numpy array with the time of each target
     """
+    return numpy.array([float(target.split("_")[1]) for target in targets])
 
-    def __init__(self,local_analysis=False):
 
-        super(IClampCondorEvaluator,self).__init__()
+class PointBasedAnalysis(object):
+    """
+    Extract the values of a trace at given points in time.
 
-        #other things like the number of nodes to divide the work onto and
-        #host connection parameters need to go into this constructor
+    The value reported for a target time is that of the last sample
+    preceding it. Target times outside of the recording are clamped to its
+    first or last sample.
 
-        if local_analysis:
-            self.evaluate=self.__local_evaluate
-        else:
-            self.evaluate=self.__remote_evaluate__
-
-    def __condor_evaluate(self,candidates,args):
-        """
-        Run simulations on grid and analyse data locally
-        WARNING: (???I'm quite confused here...there is a mistake somewhere
-        as the name doesn't match the description - which method is which?)
-      
-            Once each generation has finished, all data is pulled to local
-            workstation in form of sqlite databases (1 database per job)
-            and these are analysed and the fitness estimated sequentially
-            the fitness array is then returned.
-        """
-        
-        import time
-        import ssh_utils
-        
-        self.CandidateData_list=[]
-       
-        self.__build_condor_files(candidates) #Build submit and runx.sh files, exp_id now corresponds to position in chromosome and fitness arrays
-        
-        messagehost=ssh_utils.host(optimizer_params.host,optimizer_params.username,optimizer_params.password,optimizer_params.port)
-        
-        self.__delete_remote_files__(messagehost)#delete everything in thssh_utilse directory you're about to put files in
-        filelist=os.listdir(self.tmpdir)
-        self.__put_multiple_files(messagehost,filelist,localdir=self.tmpdir,remotedir=optimizer_params.remotedir)#copy local files over
-        filelist=os.listdir(self.portableswdir)
-        self.__put_multiple_files(messagehost,filelist,localdir=self.portableswdir,remotedir=optimizer_params.remotedir)#copy local files over
-        
-        ssh_utils.issue_command(messagehost,'export PATH=/opt/Condor/release/bin:$PATH\ncondor_submit submitfile.submit')
-        
-        self.jobdbnames=[]
-        for job_num in range(self.num_jobs):        #make a list of the databases we need:
-            jobdbname='outputdb'+str(job_num)+'.sqlite'
-            self.jobdbnames.append(jobdbname)
-           
-        #wait till you know file exists:
-        dbs_created=False
-        pulled_dbs=[] # list of databases which have been extracted from remote server
-        while (dbs_created==False):
-            print('waiting..')
-            time.sleep(20)            
-            print('checking if dbs created:')
-            command='ls'
-            remote_filelist=ssh_utils.issue_command(messagehost, command)
-
-            for jobdbname in self.jobdbnames:
-
-                db_exists=jobdbname+'\n' in remote_filelist
-                
-                if (db_exists==False):
-                    print(jobdbname +' has not been generated')
-                    dbs_created=False
-
-                elif db_exists==True and jobdbname not in pulled_dbs:
-                    print(jobdbname +' has been generated')
-                    remotefile=optimizer_params.remotedir+jobdbname
-                    localpath=os.path.join(self.datadir,str(self.generation)+jobdbname)
-                    ssh_utils.get_file(messagehost,remotefile,localpath)
-                    pulled_dbs.append(jobdbname) #so that it is not extracted more than once
-                    #here pop-in the fitness evaluation
-
-                if len(pulled_dbs)==len(self.jobdbnames):
-                    dbs_created=True
-            
-        fitness=[]
-        for CandidateData in self.CandidateData_list:
-            job_num = CandidateData.job_num
-            
-            dbname=str(self.generation)+'outputdb'+str(job_num)+'.sqlite'
-            dbpath=os.path.join(self.datadir,dbname)
-            exp_id=CandidateData.exp_id
-            
-            connection=sqldbutils.db_connect(dbpath) #establish a database connection
-            query='SELECT numerical_value\
-                    FROM output_params WHERE experiment_id=\
-                    '+str(exp_id)+' AND parameter="fitness"'       
-
-            exp_fitness=sqldbutils.execute_query(connection,query)
-            exp_fitness=exp_fitness.fetchall()
-            exp_fitness=exp_fitness[0][0]
-            
-            #print('fitness: %s'%exp_fitness)
-    
-            fitness.append(exp_fitness)
-
-        self.generation+=1
-        return fitness
+    :param v: a single trace, or a 2-D (traces x samples) array of traces
+        sharing the same time axis
+    :param t: time array
+    """
 
-    def __local_evaluate(self,candidates,args):
-        import time
-     
-        self.CandidateData_list=[]
-        analysis_var=self.analysis_var
-        
-        #Build submitfile.submit and runx.sh files:
-        self.__build_condor_files(candidates) #exp_id now corresponds to position in chromosome/fitness array
-        
-        fitness=[]
-        #submit the jobs to the grid
-        os.chdir(self.tmpdir)
-        os.system('condor_submit submitfile.submit')
-        
-        #wait till you know file exists:
-        dbs_created=False
-        while (dbs_created==False):
-            print('checking if dbs created:')
-            for job_num in range(self.num_jobs):
-                jobdbname='outputdb'+str(job_num)+'.sqlite'
-                jobdbpath=os.path.join(self.datadir,jobdbname)
-                print(jobdbpath)
-                db_exists=os.path.exists(jobdbpath)
-                
-                if (db_exists==False):
-                    time.sleep(60)
-                    dbs_created=False
-                    break
-                
-                dbs_created=True
-
-        for CandidateData in self.CandidateData_list:
-            job_num = CandidateData.job_num
-            dbname='/outputdb'+str(job_num)+'.sqlite'
-            dbpath=self.datadir+dbname
-            exp_id=CandidateData.exp_id
-            exp_data=sqldbutils.sim_data(dbpath,exp_id)
-            analysis=analysis.IClampAnalysis(exp_data.samples,exp_data.t,analysis_var,5000,10000)
-            exp_fitness=analysis.evaluate_fitness(optimizer_params.targets,optimizer_params.weights,cost_function=analysis.normalised_cost_function)
-            fitness.append(exp_fitness)
-
-        for job_num in range(self.num_jobs):
-            jobdbname='outputdb'+str(job_num)+'.sqlite'
-            jobdbpath=os.path.join(self.datadir,jobdbname)
-            print(jobdbpath)
-            os.remove(jobdbpath)
+    def __init__(self, v, t):
 
-        return fitness
- '''
+        self.v = numpy.asarray(v)
+        self.t = numpy.asarray(t)
 
+    def sample_indices(self, target_times):
+        """
+        Return the index of the sample used for each target time
+        """
+        indices = numpy.searchsorted(self.t, target_times, side="left") - 1
+        return numpy.clip(indices, 0, len(self.t) - 1)
 
-class PointBasedAnalysis(object):
-    def __init__(self, v, t):
+    def values_at(self, target_times):
+        """
+        Return the trace values at target_times.
 
-        self.v = numpy.array(v)
-        self.t = numpy.array(t)
+        :param target_times: array of times, e.g. from :func:`point_target_times`
+        :return: array of shape (..., len(target_times)); one row per trace
+            if the analysis holds several traces
+        """
+        return self.v[..., self.sample_indices(target_times)]
 
     def analyse(self, targets):
-        analysis_results = {}
+        targets = list(targets)
+        values = self.values_at(point_target_times(targets))
 
-        for target in targets:
-            target_time = float(target.split("_")[1])
-            i = 0
-            while self.t[i] < target_time:
-                value = self.v[i]
-                i += 1
+        analysis_results = {}
+        for target, value in zip(targets, values.T):
             analysis_results[target] = value
 
         return analysis_results
@@ -805,6 +1681,16 @@ class PointValueEvaluator(__Evaluator):
             parameters, weights, targets, controller
         )
 
+        self._publish_recording_spec()
+
+    def recording_spec(self):
+        """
+        Nothing after the last target time is needed.
+        """
+        if not self.targets:
+            return None
+        return RecordingSpec(end=max(point_target_times(self.targets.keys())))
+
     def evaluate(self, candidates, args):
 
         print("\n>>>>>  Evaluating: ")
@@ -813,25 +1699,94 @@ class PointValueEvaluator(__Evaluator):
 
         simulations_data = self.controller.run(candidates, self.parameters)
 
+        target_names = list(self.targets.keys())
+        target_times = point_target_times(target_names)
+
+        # aborted simulations come back without samples
+        completed = []
+        if isinstance(simulations_data, TraceBatch):
+            if simulations_data.samples.shape[1] != 1:
+                raise ValueError("Point targets require single channel traces")
+            # the population already is one (traces x samples) array
+            batch = simulations_data
+            values = PointBasedAnalysis(batch.channel(0), batch.times).values_at(
+                target_times
+            )
+            values = values[~batch.aborted]
+        else:
+            completed = [data for data in simulations_data if data[1] is not None]
+            values = []
+
+        if len(completed) > 0:
+            times = numpy.asarray(completed[0][0])
+            shared_times = all(
+                numpy.array_equal(data[0], times) for data in completed[1:]
+            )
+
+            if shared_times:
+                # one pass over all traces of the population
+                samples = numpy.vstack([numpy.asarray(data[1]) for data in completed])
+                values = PointBasedAnalysis(samples, times).values_at(target_times)
+            else:
+                values = [
+                    PointBasedAnalysis(data[1], data[0]).values_at(target_times)
+                    for data in completed
+                ]
+
+        values = iter(values)
         fitness = []
 
         for data in simulations_data:
 
-            times = data[0]
-            samples = data[1]
+            if data[1] is None:
+                fitness_value = self.worst_fitness()
+                print("Simulation aborted, fitness: %s\n" % fitness_value)
+                fitness.append(fitness_value)
+                continue
 
-            data_analysis = PointBasedAnalysis(samples, times)
+            analysed = dict(zip(target_names, next(values)))
 
-            fitness_value = self.evaluate_fitness(
-                data_analysis, self.targets, self.weights
+            fitness_value = self._fitness_from_values(
+                analysed, self.targets, self.weights
             )
 
             fitness.append(fitness_value)
 
             print("Fitness: %s\n" % fitness_value)
 
+        if self.trace_store is not None:
+            self._store_traces(candidates, simulations_data, fitness)
+
         return fitness
 
+    async def evaluate_async(self, candidates, args, max_concurrency=None):
+        return await self._score_simulations_async(
+            candidates, self.score_trace, max_concurrency
+        )
+
+    def worst_fitness(self):
+        """
+        Return the fitness given to candidates whose simulation was aborted.
+        """
+        return _worst_fitness(self.targets, self.weights)
+
+    def score_trace(self, times, samples, candidate=None):
+        """
+        Analyse a single simulation and return its fitness.
+        """
+
+        if samples is None:
+            print("Simulation aborted, fitness: %s\n" % self.worst_fitness())
+            return self.worst_fitness()
+
+        fitness_value = self.evaluate_fitness(
+            PointBasedAnalysis(samples, times), self.targets, self.weights
+        )
+
+        print("Fitness: %s\n" % fitness_value)
+
+        return fitness_value
+
     def evaluate_fitness(
         self,
         data_analysis,
@@ -848,10 +1803,21 @@ class PointValueEvaluator(__Evaluator):
             :param cost_function: cost function (callback) to assign individual targets sub-fitness.
         """
 
-        fitness = 0
-
         analysed = data_analysis.analyse(target_dict)
 
+        return self._fitness_from_values(
+            analysed, target_dict, target_weights, cost_function
+        )
+
+    def _fitness_from_values(
+        self,
+        analysed,
+        target_dict,
+        target_weights=None,
+        cost_function=normalised_cost_function,
+    ):
+        fitness = 0
+
         for target in target_dict.keys():
 
             target_value = target_dict[target]
@@ -876,3 +1842,471 @@ class PointValueEvaluator(__Evaluator):
                 )
 
         return fitness
+
+
+class CompositeEvaluator(__Evaluator):
+    """
+    Scores each simulation with several evaluators, running the controller
+    only once per candidate.
+
+    Every trace is passed to the score_trace method of each sub-evaluator
+    (e.g. an IClampEvaluator for spike features and a PointValueEvaluator
+    for point values), and the candidate's fitness is the weighted sum of
+    their fitness values. The sub-evaluators' own controllers are not used,
+    and their evaluation modes (streaming, vectorized analysis, pruning)
+    do not apply.
+
+    :param controller: controller running the simulations
+    :param parameters: names of the parameters of a candidate
+    :param evaluators: list of sub-evaluators, or of (evaluator, weight)
+        pairs; the weight defaults to 1
+    """
+
+    def __init__(
+        self,
+        controller,
+        parameters,
+        evaluators,
+        analysis_workers=0,
+        analysis_executor=None,
+    ):
+
+        self.evaluators = []
+        for evaluator in evaluators:
+            if isinstance(evaluator, (tuple, list)):
+                evaluator, weight = evaluator
+            else:
+                weight = 1.0
+            if not hasattr(evaluator, "score_trace"):
+                raise ValueError(
+                    "Evaluator %s cannot score a single trace" % evaluator
+                )
+            self.evaluators.append((evaluator, weight))
+
+        super(CompositeEvaluator, self).__init__(
+            parameters,
+            [weight for evaluator, weight in self.evaluators],
+            None,
+            controller,
+            analysis_workers,
+            analysis_executor,
+        )
+
+        self._publish_recording_spec()
+
+    def recording_spec(self):
+        """
+        Everything any of the sub-evaluators analyses is needed.
+        """
+        return RecordingSpec.union(
+            evaluator.recording_spec() for evaluator, weight in self.evaluators
+        )
+
+    def evaluate(self, candidates, args):
+
+        print("\n>>>>>  Evaluating: ")
+        for cand in candidates:
+            print(">>>>>       %s" % cand)
+
+        return self._score_simulations(candidates, self.score_trace)
+
+    async def evaluate_async(self, candidates, args, max_concurrency=None):
+        return await self._score_simulations_async(
+            candidates, self.score_trace, max_concurrency
+        )
+
+    def worst_fitness(self):
+        """
+        Return the fitness given to candidates whose simulation was aborted.
+        """
+        return sum(
+            weight * evaluator.worst_fitness() for evaluator, weight in self.evaluators
+        )
+
+    def score_trace(self, times, samples, candidate=None):
+        """
+        Score a single simulation with every sub-evaluator and return the
+        weighted sum of their fitness values.
+        """
+        fitness_value = 0
+        for evaluator, weight in self.evaluators:
+            if weight > 0:
+                fitness_value += weight * evaluator.score_trace(
+                    times, samples, candidate
+                )
+
+        print("Composite fitness: %s\n" % fitness_value)
+
+        return fitness_value
+
+
+def _run_protocol(controller, candidates, parameters, protocol, evaluator):
+    """
+    Simulate the candidates under protocol and score their traces with
+    evaluator; run in the protocol workers of MultiProtocolEvaluator.
+    """
+    simulations_data = controller.run(candidates, parameters, protocol=protocol)
+    return [
+        evaluator.score_trace(data[0], data[1], candidate)
+        for data, candidate in zip(simulations_data, candidates)
+    ]
+
+
+class MultiProtocolEvaluator(__Evaluator):
+    """
+    Fits a model to recordings made under several stimulus protocols.
+
+    Each protocol (a controllers.Protocol, passed to the controller's run
+    method as protocol=...) is paired with the evaluator scoring its traces
+    against that protocol's target recording, e.g. an IClampEvaluator with
+    its own target_data_path and targets; the fitness of a candidate is the
+    weighted sum over all protocols.
+
+    The cheapest protocol (see Protocol.cost) is run first for all
+    candidates. Candidates failing it, i.e. scoring at least fail_fitness
+    (by default: the evaluator's worst fitness, as for non-analysable or
+    aborted traces), skip the remaining protocols and are given the worst
+    fitness for them. The remaining protocols are then run concurrently for
+    the other candidates, in protocol_workers worker processes (or threads,
+    with protocol_executor="thread", in which case the controller must be
+    safe to run from several threads at once): each job simulates
+    candidates_per_job of the candidates under one protocol. The process
+    pool is reused across generations until close() is called.
+
+    :param controller: controller running the simulations
+    :param parameters: names of the parameters of a candidate
+    :param protocols: list of (protocol, evaluator) or
+        (protocol, evaluator, weight) entries; the weight defaults to 1
+    :param fail_fitness: protocol fitness at or above which a candidate fails
+    :param protocol_workers: number of workers running protocols concurrently
+    :param protocol_executor: "process", "thread" or a concurrent.futures.Executor
+    :param candidates_per_job: number of candidates simulated by each job
+    """
+
+    def __init__(
+        self,
+        controller,
+        parameters,
+        protocols,
+        fail_fitness=None,
+        protocol_workers=None,
+        protocol_executor="process",
+        candidates_per_job=1,
+    ):
+
+        entries = []
+        for entry in protocols:
+            protocol, evaluator = entry[0], entry[1]
+            weight = entry[2] if len(entry) > 2 else 1.0
+            if not hasattr(evaluator, "score_trace"):
+                raise ValueError(
+                    "Evaluator %s cannot score a single trace" % evaluator
+                )
+            entries.append((protocol, evaluator, weight))
+        if len(entries) == 0:
+            raise ValueError("MultiProtocolEvaluator requires at least one protocol")
+
+        # cheapest first
+        self.protocols = sorted(entries, key=lambda entry: entry[0].cost)
+
+        super(MultiProtocolEvaluator, self).__init__(
+            parameters,
+            [weight for protocol, evaluator, weight in self.protocols],
+            None,
+            controller,
+        )
+
+        if protocol_executor not in ("thread", "process") and not isinstance(
+            protocol_executor, Executor
+        ):
+            raise ValueError(
+                "protocol_executor must be 'thread', 'process' or an Executor, not %s"
+                % protocol_executor
+            )
+        if candidates_per_job < 1:
+            raise ValueError(
+                "candidates_per_job must be at least 1, not %s" % candidates_per_job
+            )
+        self.fail_fitness = fail_fitness
+        self.protocol_workers = protocol_workers
+        self.protocol_executor = protocol_executor
+        self.candidates_per_job = candidates_per_job
+        self._protocol_pool = None
+
+        self._publish_recording_spec()
+
+    def __getstate__(self):
+        state = super(MultiProtocolEvaluator, self).__getstate__()
+        state["_protocol_pool"] = None
+        if isinstance(self.protocol_executor, Executor):
+            state["protocol_executor"] = None
+        return state
+
+    def recording_spec(self):
+        """
+        Everything any of the protocols' evaluators analyses is needed.
+        """
+        return RecordingSpec.union(
+            evaluator.recording_spec() for protocol, evaluator, weight in self.protocols
+        )
+
+    def close(self):
+        """
+        Shut down the pools created by this evaluator, if any.
+        """
+        super(MultiProtocolEvaluator, self).close()
+        if self._protocol_pool is not None:
+            self._protocol_pool.shutdown()
+            self._protocol_pool = None
+
+    def _get_protocol_executor(self):
+        if isinstance(self.protocol_executor, Executor):
+            return self.protocol_executor
+
+        if self._protocol_pool is None:
+            if self.protocol_executor == "process":
+                self._protocol_pool = ProcessPoolExecutor(
+                    max_workers=self.protocol_workers
+                )
+            else:
+                self._protocol_pool = ThreadPoolExecutor(
+                    max_workers=self.protocol_workers
+                )
+
+        return self._protocol_pool
+
+    def set_trace_store(self, trace_store):
+        """
+        The protocols are simulated on different time axes, and their
+        traces scored in the protocol workers, so they cannot be stored.
+        """
+        if trace_store is not None:
+            raise ValueError("MultiProtocolEvaluator cannot store traces")
+
+    def worst_fitness(self):
+        """
+        Return the fitness of a candidate failing every protocol.
+        """
+        return sum(
+            weight * evaluator.worst_fitness()
+            for protocol, evaluator, weight in self.protocols
+        )
+
+    def failed(self, evaluator, fitness_value):
+        """
+        Return True if a protocol's fitness_value (as scored by its
+        evaluator) means the candidate fails the protocol.
+        """
+        if self.fail_fitness is not None:
+            return fitness_value >= self.fail_fitness
+        return fitness_value >= evaluator.worst_fitness()
+
+    def evaluate(self, candidates, args):
+
+        print("\n>>>>>  Evaluating: ")
+        for cand in candidates:
+            print(">>>>>       %s" % cand)
+
+        protocol, evaluator, weight = self.protocols[0]
+        print(">>>>>  Protocol %s" % protocol.name)
+        first_fitness = _run_protocol(
+            self.controller, candidates, self.parameters, protocol, evaluator
+        )
+
+        fitness = [weight * fitness_value for fitness_value in first_fitness]
+        remaining = self.protocols[1:]
+
+        passed = []
+        for index, fitness_value in enumerate(first_fitness):
+            if self.failed(evaluator, fitness_value):
+                print(
+                    "Candidate %s fails protocol %s, skipping the others"
+                    % (candidates[index], protocol.name)
+                )
+                fitness[index] += sum(w * e.worst_fitness() for p, e, w in remaining)
+            else:
+                passed.append(index)
+
+        if remaining and passed:
+            executor = self._get_protocol_executor()
+            chunks = [
+                passed[first : first + self.candidates_per_job]
+                for first in range(0, len(passed), self.candidates_per_job)
+            ]
+
+            jobs = []
+            for protocol, evaluator, weight in remaining:
+                print(">>>>>  Protocol %s" % protocol.name)
+                for chunk in chunks:
+                    future = executor.submit(
+                        _run_protocol,
+                        self.controller,
+                        [candidates[index] for index in chunk],
+                        self.parameters,
+                        protocol,
+                        evaluator,
+                    )
+                    jobs.append((weight, chunk, future))
+
+            for weight, chunk, future in jobs:
+                for index, fitness_value in zip(chunk, future.result()):
+                    fitness[index] += weight * fitness_value
+
+        return fitness
+
+
+class RacingEvaluator(__Evaluator):
+    """
+    Wraps the evaluator of a stochastic model, re-evaluating candidates
+    only where noise makes their ranking around the selection cutoff
+    uncertain.
+
+    The running mean and variance of the fitness of every candidate
+    evaluated so far are cached (Welford's algorithm), and the mean is
+    returned as its fitness. After one evaluation of each candidate, the
+    cutoff is placed between the cutoff-th and the next best mean among the
+    candidates and the cutoff best candidates of previous generations.
+    Candidates whose mean is within confidence standard errors of the
+    cutoff are evaluated again, all at once, and this is repeated (racing)
+    until every ranking is resolved or those candidates have been evaluated
+    max_samples times. Until the noise has been measured, the 2 * cutoff
+    best candidates are evaluated a second time.
+
+    :param evaluator: evaluator of the model, whose evaluate method is called
+        with the candidates to (re-)evaluate
+    :param cutoff: number of candidates selected each generation, e.g. the
+        optimizer's num_selected
+    :param max_samples: maximum number of evaluations of a candidate
+    :param confidence: width of the uncertainty band, in standard errors
+    :param maximize: whether higher fitness is better
+    """
+
+    def __init__(
+        self, evaluator, cutoff, max_samples=4, confidence=1.96, maximize=False
+    ):
+
+        super(RacingEvaluator, self).__init__(
+            getattr(evaluator, "parameters", None),
+            getattr(evaluator, "weights", None),
+            getattr(evaluator, "targets", None),
+            getattr(evaluator, "controller", None),
+        )
+
+        self.evaluator = evaluator
+        self.cutoff = cutoff
+        self.max_samples = max_samples
+        self.confidence = confidence
+        self.maximize = maximize
+
+        # candidate -> [number of evaluations, mean, sum of squared deviations]
+        self._statistics = {}
+
+    def close(self):
+        if hasattr(self.evaluator, "close"):
+            self.evaluator.close()
+
+    def set_trace_store(self, trace_store):
+        """
+        Record the evaluations of the wrapped evaluator in trace_store, so
+        that every sample of a re-evaluated candidate is stored.
+        """
+        self.evaluator.set_trace_store(trace_store)
+        self.trace_store = trace_store
+
+    def statistics(self, candidate):
+        """
+        Return (number of evaluations, mean, variance) of the fitness of a
+        candidate; the variance is None until it has been evaluated twice.
+        """
+        n, mean, m2 = self._statistics[tuple(candidate)]
+        return n, mean, m2 / (n - 1) if n > 1 else None
+
+    def noise_variance(self):
+        """
+        Return the average fitness variance of the candidates evaluated more
+        than once, or None if there are none.
+        """
+        variances = [m2 / (n - 1) for n, mean, m2 in self._statistics.values() if n > 1]
+        if len(variances) == 0:
+            return None
+        return sum(variances) / len(variances)
+
+    def evaluate(self, candidates, args):
+
+        keys = [tuple(candidate) for candidate in candidates]
+
+        self._sample(candidates, args)
+        repeats = 0
+
+        while True:
+            uncertain = self._uncertain(keys)
+            if len(uncertain) == 0:
+                break
+            print(
+                ">>>>>  Racing: re-evaluating %i candidates near the cutoff"
+                % len(uncertain)
+            )
+            self._sample([list(key) for key in uncertain], args)
+            repeats += len(uncertain)
+
+        print(">>>>>  Racing: %i repeat evaluations" % repeats)
+
+        return [self._statistics[key][1] for key in keys]
+
+    def _sample(self, candidates, args):
+        """Evaluate candidates once more and update their statistics"""
+        fitness = self.evaluator.evaluate(candidates, args)
+        for candidate, value in zip(candidates, fitness):
+            statistics = self._statistics.setdefault(tuple(candidate), [0, 0.0, 0.0])
+            statistics[0] += 1
+            delta = value - statistics[1]
+            statistics[1] += delta / statistics[0]
+            statistics[2] += delta * (value - statistics[1])
+
+    def _uncertain(self, keys):
+        """
+        Return the candidates among keys whose rank relative to the cutoff
+        is still uncertain.
+        """
+        batch = list(dict.fromkeys(keys))
+        in_batch = set(batch)
+
+        def rank_key(key):
+            mean = self._statistics[key][1]
+            return -mean if self.maximize else mean
+
+        incumbents = sorted(
+            (key for key in self._statistics if key not in in_batch), key=rank_key
+        )[: self.cutoff]
+        pool = sorted(batch + incumbents, key=rank_key)
+
+        if len(pool) <= self.cutoff:
+            return []
+
+        boundary = (
+            self._statistics[pool[self.cutoff - 1]][1]
+            + self._statistics[pool[self.cutoff]][1]
+        ) / 2.0
+        contenders = set(pool[: 2 * self.cutoff])
+        noise_variance = self.noise_variance()
+
+        uncertain = []
+        for key in batch:
+            n, mean, m2 = self._statistics[key]
+            if n >= self.max_samples:
+                continue
+
+            # fewer than three samples give too rough a variance of their own
+            if n > 2:
+                variance = m2 / (n - 1)
+            else:
+                variance = noise_variance
+
+            if variance is None:
+                # noise not measured yet
+                if key in contenders:
+                    uncertain.append(key)
+            elif abs(mean - boundary) < self.confidence * math.sqrt(variance / n):
+                uncertain.append(key)
+
+        return uncertain
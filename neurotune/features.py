@@ -0,0 +1,1241 @@
+"""
+Feature extraction for neurotune's evaluators.
+
+pyelectro's analysis classes need the whole trace in memory. The classes here
+compute the features that only depend on spike times, extrema and
+interspike intervals incrementally, from a trace arriving in chunks, so that
+very long simulations can be scored without ever holding a full trace. Peak
+and trough detection follows pyelectro's max_min (as used by IClampAnalysis)
+and max_min_simple (as used by NetworkAnalysis), and the features are
+derived from the resulting max_min_dictionary in the same way as pyelectro.
+"""
+
+import numpy as np
+from pyelectro import analysis
+
+#: IClampAnalysis features which can be computed from a streamed trace
+STREAMABLE_ICLAMP_FEATURES = frozenset(
+    [
+        "average_minimum",
+        "average_maximum",
+        "min_peak_no",
+        "max_peak_no",
+        "mean_spike_frequency",
+        "interspike_time_covar",
+        "first_spike_time",
+        "max_interspike_time",
+        "min_interspike_time",
+        "trough_phase_adaptation",
+        "peak_decay_exponent",
+        "trough_decay_exponent",
+        "spike_frequency_adaptation",
+        "peak_linear_gradient",
+    ]
+)
+
+#: NetworkAnalysis features (after the "<ref>:" prefix) which can be computed
+#: from a streamed trace, besides value_<t> and average_<t1>_<t2>
+STREAMABLE_NETWORK_FEATURES = frozenset(
+    [
+        "maximum",
+        "minimum",
+        "min_peak_no",
+        "max_peak_no",
+        "average_maximum",
+        "first_spike_time",
+        "average_minimum",
+        "mean_spike_frequency",
+        "interspike_time_covar",
+        "trough_phase_adaptation",
+        "max_interspike_time",
+        "min_interspike_time",
+        "peak_decay_exponent",
+        "spike_frequency_adaptation",
+        "trough_decay_exponent",
+        "peak_linear_gradient",
+    ]
+)
+
+
+def _average_window(feature):
+    """
+    Return (start, end) of an average_<t1>_<t2> feature, or None for any
+    other feature.
+    """
+    parts = feature.split("_")
+    if parts[0] != "average" or len(parts) != 3:
+        return None
+    try:
+        return float(parts[1]), float(parts[2])
+    except ValueError:
+        return None
+
+
+def streamable_network_target(target):
+    """
+    Return True if a NetworkAnalysis target (e.g. cell0:mean_spike_frequency)
+    can be computed from a streamed trace.
+    """
+    feature = target.split(":", 1)[-1]
+    if feature.startswith("value_") or _average_window(feature) is not None:
+        return True
+    return feature in STREAMABLE_NETWORK_FEATURES
+
+
+class StreamingMaxMin(object):
+    """
+    Incremental peak and trough detection on a trace arriving in chunks.
+
+    The max_min_dictionary is the same as pyelectro's max_min (method
+    "max_min") or max_min_simple (method "max_min_simple") would give for
+    the analysis window of the full trace. Only the last two samples of
+    each chunk are kept between updates.
+
+    :param delta: peak_delta, for method "max_min"
+    :param peak_threshold: peaks below this value are discarded (max_min),
+        or the spike threshold (max_min_simple)
+    :param start_analysis: time where analysis is to start
+    :param end_analysis: time where analysis is to end
+    :param method: "max_min" or "max_min_simple"
+    :param inclusive_end: whether the sample nearest to end_analysis belongs
+        to the window (as in NetworkAnalysis) or not (as in IClampAnalysis)
+    """
+
+    def __init__(
+        self,
+        delta=0,
+        peak_threshold=None,
+        start_analysis=0,
+        end_analysis=None,
+        method="max_min",
+        inclusive_end=False,
+    ):
+
+        if method not in ("max_min", "max_min_simple"):
+            raise ValueError("Unknown peak detection method: %s" % method)
+
+        self.delta = delta
+        self.peak_threshold = -np.inf if peak_threshold is None else peak_threshold
+        self.start_analysis = start_analysis
+        self.end_analysis = end_analysis
+        self.method = method
+        self.inclusive_end = inclusive_end
+
+        self.n_samples = 0
+        self.maximum = -np.inf
+        self.minimum = np.inf
+
+        self.maxima_locations = []
+        self.maxima_times = []
+        self.maxima_values = []
+        self.minima_locations = []
+        self.minima_times = []
+        self.minima_values = []
+
+        self._step = None
+
+        # max_min state
+        self._carry_t = np.empty(0)
+        self._carry_v = np.empty(0)
+        self._last_max = None
+        self._absorbed = 0
+        self._reset_trough()
+
+        # max_min_simple state
+        self._spiking = False
+        self._has_spiked = False
+        self._reset_peak()
+
+    def _reset_trough(self):
+        self._min_loc = -1
+        self._min_t = -1
+        self._min_v = np.inf
+
+    def _reset_peak(self):
+        self._max_loc = -1
+        self._max_t = -1
+        self._max_v = -np.inf
+
+    def _record_maximum(self, loc, t, v):
+        self.maxima_locations.append(loc)
+        self.maxima_times.append(t)
+        self.maxima_values.append(v)
+
+    def _record_minimum(self, loc, t, v):
+        self.minima_locations.append(loc)
+        self.minima_times.append(t)
+        self.minima_values.append(v)
+
+    @property
+    def max_min_dictionary(self):
+        return {
+            "maxima_locations": self.maxima_locations,
+            "minima_locations": self.minima_locations,
+            "maxima_number": len(self.maxima_locations),
+            "minima_number": len(self.minima_locations),
+            "maxima_times": self.maxima_times,
+            "minima_times": self.minima_times,
+            "maxima_values": self.maxima_values,
+            "minima_values": self.minima_values,
+        }
+
+    def window(self, times):
+        """
+        Return the slice of a chunk sampled at times inside the analysis window.
+
+        As in pyelectro, the window starts at the sample nearest to
+        start_analysis and ends at the sample nearest to end_analysis.
+        """
+        if self._step is None and len(times) >= 2:
+            self._step = times[1] - times[0]
+        half_step = 0.5 * (self._step or 0)
+
+        first = 0
+        last = len(times)
+        if self.start_analysis is not None:
+            first = np.searchsorted(times, self.start_analysis - half_step, side="left")
+        if self.end_analysis is not None:
+            if self.inclusive_end:
+                last = np.searchsorted(
+                    times, self.end_analysis + half_step, side="left"
+                )
+            else:
+                last = np.searchsorted(
+                    times, self.end_analysis - half_step, side="left"
+                )
+        return slice(int(first), int(max(first, last)))
+
+    def update(self, times, v):
+        """
+        Process the next chunk of the trace.
+        """
+        times = np.asarray(times, dtype=float)
+        v = np.asarray(v, dtype=float)
+        window = self.window(times)
+        times = times[window]
+        v = v[window]
+
+        if len(v) == 0:
+            return
+
+        self.maximum = max(self.maximum, float(np.max(v)))
+        self.minimum = min(self.minimum, float(np.min(v)))
+
+        if self.method == "max_min":
+            self._update_max_min(times, v)
+        else:
+            self._update_max_min_simple(times, v)
+
+        self.n_samples += len(v)
+
+    def _update_max_min(self, times, v):
+        x = np.concatenate([self._carry_v, v])
+        tx = np.concatenate([self._carry_t, times])
+        # sample index of x[0] in the windowed trace
+        offset = self.n_samples - len(self._carry_v)
+
+        positions = []
+        if len(x) >= 3:
+            centre = x[1:-1]
+            rise = centre - x[:-2]
+            fall = centre - x[2:]
+            is_max = (
+                (rise > 0)
+                & (fall > 0)
+                & (rise > self.delta)
+                & (fall > self.delta)
+                & (centre >= self.peak_threshold)
+            )
+            positions = np.flatnonzero(is_max) + 1
+
+        for position in positions:
+            location = offset + int(position)
+            self._absorb(x, tx, offset, location)
+            if self._last_max is not None:
+                self._record_minimum(self._min_loc, self._min_t, self._min_v)
+            self._record_maximum(location, tx[position], x[position])
+            self._last_max = location
+            self._absorbed = location
+            self._reset_trough()
+
+        self._absorb(x, tx, offset, offset + len(x))
+
+        self._carry_v = x[-2:]
+        self._carry_t = tx[-2:]
+
+    def _absorb(self, x, tx, offset, until):
+        """
+        Fold samples [self._absorbed, until) into the running minimum since
+        the last maximum (the first occurrence wins, as in max_min).
+        """
+        if until <= self._absorbed:
+            return
+        if self._last_max is not None:
+            segment = x[self._absorbed - offset : until - offset]
+            k = int(np.argmin(segment))
+            if segment[k] < self._min_v:
+                position = self._absorbed - offset + k
+                self._min_loc = offset + position
+                self._min_t = tx[position]
+                self._min_v = x[position]
+        self._absorbed = until
+
+    def _update_max_min_simple(self, times, v):
+        above = v >= self.peak_threshold
+        bounds = [0] + list(np.flatnonzero(above[1:] != above[:-1]) + 1) + [len(v)]
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if above[start] and not self._spiking:
+                self._spiking = True
+                self._has_spiked = True
+                if self._min_loc > 0:
+                    self._record_minimum(self._min_loc, self._min_t, self._min_v)
+                self._reset_trough()
+            elif not above[start] and self._spiking:
+                self._spiking = False
+                if self._max_loc > 0:
+                    self._record_maximum(self._max_loc, self._max_t, self._max_v)
+                self._reset_peak()
+
+            segment = v[start:end]
+            # max_min_simple keeps the last occurrence of the extreme value
+            if self._spiking:
+                k = len(segment) - 1 - int(np.argmax(segment[::-1]))
+                if segment[k] >= self._max_v:
+                    self._max_loc = self.n_samples + start + k
+                    self._max_t = times[start + k]
+                    self._max_v = segment[k]
+            elif self._has_spiked:
+                k = len(segment) - 1 - int(np.argmin(segment[::-1]))
+                if segment[k] <= self._min_v:
+                    self._min_loc = self.n_samples + start + k
+                    self._min_t = times[start + k]
+                    self._min_v = segment[k]
+
+
+class StreamingIClampAnalysis(StreamingMaxMin):
+    """
+    Counterpart of pyelectro's IClampAnalysis for traces arriving in chunks.
+
+    It provides the attributes evaluators use from an IClampAnalysis
+    (max_min_dictionary, analysable_data and the analysis variables), but
+    not the trace itself, so only the STREAMABLE_ICLAMP_FEATURES can be
+    derived from it.
+    """
+
+    def __init__(self, analysis_var, start_analysis=0, end_analysis=None):
+
+        super(StreamingIClampAnalysis, self).__init__(
+            delta=analysis_var["peak_delta"],
+            peak_threshold=analysis_var.get("peak_threshold"),
+            start_analysis=start_analysis,
+            end_analysis=end_analysis,
+            method="max_min",
+        )
+
+        self.baseline = analysis_var["baseline"]
+        self.dvdt_threshold = analysis_var["dvdt_threshold"]
+        self.v = None
+        self.t = None
+        self.analysis_results = None
+        self._error_during_analysis = False
+
+    @property
+    def analysable_data(self):
+        """Same criteria as IClampAnalysis.analysable_data"""
+        return not (
+            len(self.maxima_locations) < 3
+            or self.maximum > 100.0
+            or self.minimum > -5.0
+            or self.maximum < 10.0
+            or self._error_during_analysis
+        )
+
+    @analysable_data.setter
+    def analysable_data(self, val):
+        self._error_during_analysis = True
+
+
+def network_spike_features(max_min_dictionary, prefix="", targets=None):
+    """
+    Return the NetworkAnalysis features of one cell which only depend on its
+    max_min_dictionary, following NetworkAnalysis.analyse.
+
+    :param max_min_dictionary: peaks and troughs of the cell's trace
+    :param prefix: cell reference and colon, e.g. "cell0:"
+    :param targets: targets to compute; None for all
+    """
+    results = {}
+
+    def wanted(feature):
+        return targets is None or prefix + feature in targets
+
+    maxima_number = max_min_dictionary["maxima_number"]
+    minima_number = max_min_dictionary["minima_number"]
+    maxima_times = max_min_dictionary["maxima_times"]
+    maxima_values = max_min_dictionary["maxima_values"]
+
+    if wanted("min_peak_no"):
+        results[prefix + "min_peak_no"] = minima_number
+    if wanted("max_peak_no"):
+        results[prefix + "max_peak_no"] = maxima_number
+
+    if maxima_number >= 1:
+        if wanted("average_maximum"):
+            results[prefix + "average_maximum"] = np.average(maxima_values)
+        if wanted("first_spike_time"):
+            results[prefix + "first_spike_time"] = maxima_times[0]
+
+    if minima_number >= 1 and wanted("average_minimum"):
+        results[prefix + "average_minimum"] = np.average(
+            max_min_dictionary["minima_values"]
+        )
+
+    if wanted("mean_spike_frequency"):
+        if maxima_number >= 3:
+            results[prefix + "mean_spike_frequency"] = analysis.mean_spike_frequency(
+                maxima_times
+            )
+        else:
+            results[prefix + "mean_spike_frequency"] = 0
+
+    if maxima_number >= 3:
+        if wanted("interspike_time_covar"):
+            results[prefix + "interspike_time_covar"] = analysis.spike_covar(
+                maxima_times
+            )
+        if wanted("trough_phase_adaptation"):
+            trough_phases = analysis.minima_phases(max_min_dictionary)
+            try:
+                results[prefix + "trough_phase_adaptation"] = analysis.exp_fit(
+                    trough_phases[0], trough_phases[1]
+                )
+            except:
+                pass
+
+        max_min_isi = analysis.max_min_interspike_time(maxima_times)
+        if wanted("max_interspike_time"):
+            results[prefix + "max_interspike_time"] = max_min_isi[0]
+        if wanted("min_interspike_time"):
+            results[prefix + "min_interspike_time"] = max_min_isi[1]
+
+        if wanted("peak_decay_exponent"):
+            results[prefix + "peak_decay_exponent"] = analysis.three_spike_adaptation(
+                maxima_times, maxima_values
+            )
+        if wanted("spike_frequency_adaptation"):
+            spike_frequency_list = analysis.spike_frequencies(maxima_times)
+            results[prefix + "spike_frequency_adaptation"] = analysis.exp_fit(
+                spike_frequency_list[0], spike_frequency_list[1]
+            )
+        if wanted("trough_decay_exponent"):
+            results[prefix + "trough_decay_exponent"] = analysis.three_spike_adaptation(
+                max_min_dictionary["minima_times"], max_min_dictionary["minima_values"]
+            )
+        if wanted("peak_linear_gradient"):
+            results[prefix + "peak_linear_gradient"] = analysis.linear_fit(
+                maxima_times, maxima_values
+            )
+
+    return results
+
+
+class StreamingNetworkAnalysis(object):
+    """
+    Counterpart of pyelectro's NetworkAnalysis for traces arriving in chunks.
+
+    Chunks are passed to update as a time array and a dict of cell reference
+    vs. voltage array. Only targets accepted by streamable_network_target
+    can be computed.
+
+    :param analysis_var: dictionary containing parameters to be used in
+        analysis such as the peak_threshold
+    :param start_analysis: time t where analysis is to start
+    :param end_analysis: time in t where analysis is to end
+    :param targets: the targets which will be analysed, so that the values
+        needed for value_<t> and average_<t1>_<t2> targets can be collected
+    """
+
+    def __init__(self, analysis_var, start_analysis=0, end_analysis=None, targets=None):
+
+        self.analysis_var = analysis_var
+        self.start_analysis = start_analysis
+        self.end_analysis = end_analysis
+        self.targets = None if targets is None else list(targets)
+
+        self.max_min = {}
+        self.point_values = {}
+        self.sums = {}
+
+    def _cell_targets(self, ref):
+        pre = "%s:" % ref
+        return [t for t in self.targets or [] if t.startswith(pre)]
+
+    def update(self, times, volts):
+        times = np.asarray(times, dtype=float)
+
+        for ref, v in volts.items():
+            if ref not in self.max_min:
+                self.max_min[ref] = StreamingMaxMin(
+                    delta=self.analysis_var["peak_delta"],
+                    peak_threshold=self.analysis_var.get("peak_threshold"),
+                    start_analysis=self.start_analysis,
+                    end_analysis=self.end_analysis,
+                    method="max_min_simple",
+                    inclusive_end=True,
+                )
+            max_min = self.max_min[ref]
+            window = max_min.window(times)
+            max_min.update(times, v)
+
+            t = times[window]
+            v = np.asarray(v, dtype=float)[window]
+            if len(v) == 0:
+                continue
+
+            for target in self._cell_targets(ref):
+                feature = target.split(":", 1)[1]
+                if feature.startswith("value_"):
+                    # value of the last sample before the target time
+                    target_time = float(feature.split("_")[1])
+                    i = np.searchsorted(t, target_time, side="left") - 1
+                    if i >= 0:
+                        self.point_values[target] = v[i]
+                elif _average_window(feature) is not None:
+                    start_time, end_time = _average_window(feature)
+                    inside = v[(t >= start_time) & (t <= end_time)]
+                    total, num = self.sums.get(target, (0.0, 0))
+                    self.sums[target] = (
+                        total + float(np.sum(inside)),
+                        num + len(inside),
+                    )
+
+    def analyse(self, targets=None):
+        """Analyses and puts all results into a dict, as NetworkAnalysis.analyse"""
+
+        analysis_results = {}
+
+        for ref, max_min in self.max_min.items():
+            pre = "%s:" % ref
+
+            if max_min.n_samples > 0:
+                if targets is None or pre + "maximum" in targets:
+                    analysis_results[pre + "maximum"] = max_min.maximum
+                if targets is None or pre + "minimum" in targets:
+                    analysis_results[pre + "minimum"] = max_min.minimum
+
+            analysis_results.update(
+                network_spike_features(max_min.max_min_dictionary, pre, targets)
+            )
+
+        for target, value in self.point_values.items():
+            analysis_results[target] = value
+        for target, (total, num) in self.sums.items():
+            if num > 0:
+                analysis_results[target] = total / num
+
+        self.analysis_results = analysis_results
+        return analysis_results
+
+
+def _nearest_index(times, target_value):
+    """Index of the first sample of times nearest to target_value, as in pyelectro"""
+    differences = np.abs(np.asarray(times) - target_value)
+    return int(np.nonzero(differences == differences.min())[0][0])
+
+
+def _segment_extrema(x, starts, stops, maximum=True, last=True):
+    """
+    Return the extreme values of the 1-D array x over the segments
+    [starts[i], stops[i]), and the position of their last (or first)
+    occurrence.
+    """
+    lengths = stops - starts
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+    values = x[positions]
+    reduce = np.maximum if maximum else np.minimum
+    extremes = reduce.reduceat(values, offsets)
+    hits = values == np.repeat(extremes, lengths)
+    if last:
+        found = np.maximum.reduceat(np.where(hits, positions, -1), offsets)
+    else:
+        found = np.minimum.reduceat(np.where(hits, positions, len(x)), offsets)
+    return extremes, found
+
+
+class SpikeBatch(object):
+    """
+    Peaks and troughs of a batch of traces, as flat arrays ordered by trace
+    and then by time.
+
+    For each of maxima and minima, <kind>_traces gives the row of the trace
+    a peak or trough belongs to, and <kind>_locations, <kind>_times and
+    <kind>_values its index in the trace, time and value.
+    """
+
+    def __init__(self, n_traces, maxima, minima):
+        self.n_traces = n_traces
+        (
+            self.maxima_traces,
+            self.maxima_locations,
+            self.maxima_times,
+            self.maxima_values,
+        ) = maxima
+        (
+            self.minima_traces,
+            self.minima_locations,
+            self.minima_times,
+            self.minima_values,
+        ) = minima
+
+        self.maxima_number = np.bincount(self.maxima_traces, minlength=n_traces)
+        self.minima_number = np.bincount(self.minima_traces, minlength=n_traces)
+        self._maxima_start = np.cumsum(self.maxima_number) - self.maxima_number
+        self._minima_start = np.cumsum(self.minima_number) - self.minima_number
+
+    def max_min_dictionary(self, row):
+        """
+        Return the peaks and troughs of one trace as a pyelectro max_min_dictionary.
+        """
+        maxima = slice(
+            self._maxima_start[row], self._maxima_start[row] + self.maxima_number[row]
+        )
+        minima = slice(
+            self._minima_start[row], self._minima_start[row] + self.minima_number[row]
+        )
+        return {
+            "maxima_locations": self.maxima_locations[maxima].tolist(),
+            "minima_locations": self.minima_locations[minima].tolist(),
+            "maxima_number": int(self.maxima_number[row]),
+            "minima_number": int(self.minima_number[row]),
+            "maxima_times": self.maxima_times[maxima].tolist(),
+            "minima_times": self.minima_times[minima].tolist(),
+            "maxima_values": self.maxima_values[maxima].tolist(),
+            "minima_values": self.minima_values[minima].tolist(),
+        }
+
+    def spike_features(self):
+        """
+        Return a dict of feature name vs. array of that feature for every
+        trace, with NaN where a trace has too few spikes for it: the spike
+        counts, average_maximum, average_minimum, first_spike_time,
+        mean_spike_frequency, interspike_time_covar, max_interspike_time
+        and min_interspike_time, computed as pyelectro does from the
+        max_min_dictionary of each trace.
+        """
+        n = self.n_traces
+        maxima_number = self.maxima_number
+        minima_number = self.minima_number
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average_maximum = (
+                np.bincount(self.maxima_traces, self.maxima_values, minlength=n)
+                / maxima_number
+            )
+            average_minimum = (
+                np.bincount(self.minima_traces, self.minima_values, minlength=n)
+                / minima_number
+            )
+
+            first_spike_time = np.full(n, np.nan)
+            spiking = maxima_number > 0
+            first_spike_time[spiking] = self.maxima_times[self._maxima_start[spiking]]
+
+            # interspike intervals, dropping those spanning two traces
+            same_trace = self.maxima_traces[1:] == self.maxima_traces[:-1]
+            isi = np.diff(self.maxima_times)[same_trace]
+            isi_traces = self.maxima_traces[1:][same_trace]
+            isi_number = np.bincount(isi_traces, minlength=n)
+
+            mean_isi = np.bincount(isi_traces, isi, minlength=n) / isi_number
+            deviation = isi - mean_isi[isi_traces]
+            std_isi = np.sqrt(
+                np.bincount(isi_traces, deviation * deviation, minlength=n) / isi_number
+            )
+
+            max_isi = np.full(n, -np.inf)
+            min_isi = np.full(n, np.inf)
+            np.maximum.at(max_isi, isi_traces, isi)
+            np.minimum.at(min_isi, isi_traces, isi)
+            max_isi[isi_number == 0] = np.nan
+            min_isi[isi_number == 0] = np.nan
+
+            mean_spike_frequency = 1000.0 / mean_isi
+            interspike_time_covar = std_isi / mean_isi
+
+        return {
+            "max_peak_no": maxima_number,
+            "min_peak_no": minima_number,
+            "average_maximum": average_maximum,
+            "average_minimum": average_minimum,
+            "first_spike_time": first_spike_time,
+            "mean_spike_frequency": mean_spike_frequency,
+            "interspike_time_covar": interspike_time_covar,
+            "max_interspike_time": max_isi,
+            "min_interspike_time": min_isi,
+        }
+
+
+def max_min_simple_batch(volts, times, peak_threshold):
+    """
+    Threshold-based peak and trough detection on every row of a
+    (traces x samples) array at once, with the same results as pyelectro's
+    max_min_simple on each row.
+
+    A peak is the (last) highest sample of each complete excursion above
+    peak_threshold, and a trough the (last) lowest sample between two
+    consecutive excursions.
+
+    :return: SpikeBatch
+    """
+    volts = np.asarray(volts, dtype=float)
+    times = np.asarray(times, dtype=float)
+    n_traces, n_samples = volts.shape
+
+    above = volts >= peak_threshold
+    previous = np.zeros_like(above)
+    previous[:, 1:] = above[:, :-1]
+
+    # first sample of each excursion, and first sample after it
+    up_rows, up_columns = np.nonzero(above & ~previous)
+    down_rows, down_columns = np.nonzero(~above & previous)
+    ups = up_rows * n_samples + up_columns
+    downs = down_rows * n_samples + down_columns
+
+    flat = volts.ravel()
+
+    # complete excursions: those ending within their trace
+    k = np.searchsorted(downs, ups)
+    complete = k < len(downs)
+    complete[complete] = down_rows[k[complete]] == up_rows[complete]
+    peak_starts = ups[complete]
+    peak_stops = downs[k[complete]]
+
+    maxima = [np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0), np.empty(0)]
+    if len(peak_starts) > 0:
+        values, positions = _segment_extrema(flat, peak_starts, peak_stops, True)
+        columns = positions % n_samples
+        # max_min_simple ignores a peak in the first sample of the trace
+        keep = columns > 0
+        maxima = [
+            positions[keep] // n_samples,
+            columns[keep],
+            times[columns[keep]],
+            values[keep],
+        ]
+
+    # troughs: from the end of an excursion to the start of the next one
+    minima = [np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0), np.empty(0)]
+    following = np.flatnonzero(complete) + 1
+    following = following[following < len(ups)]
+    following = following[up_rows[following] == up_rows[following - 1]]
+    if len(following) > 0:
+        trough_starts = downs[k[following - 1]]
+        trough_stops = ups[following]
+        values, positions = _segment_extrema(flat, trough_starts, trough_stops, False)
+        columns = positions % n_samples
+        minima = [positions // n_samples, columns, times[columns], values]
+
+    return SpikeBatch(n_traces, maxima, minima)
+
+
+def max_min_batch(volts, times, delta=0, peak_threshold=None):
+    """
+    Gradient-based peak and trough detection on every row of a
+    (traces x samples) array at once, with the same results as pyelectro's
+    max_min on each row.
+
+    A peak is a sample exceeding both neighbours by more than delta and not
+    below peak_threshold, and a trough the (first) lowest sample from a peak
+    up to the next one.
+
+    :return: SpikeBatch
+    """
+    volts = np.asarray(volts, dtype=float)
+    times = np.asarray(times, dtype=float)
+    n_traces, n_samples = volts.shape
+
+    if peak_threshold is None:
+        peak_threshold = -np.inf
+
+    centre = volts[:, 1:-1]
+    rise = centre - volts[:, :-2]
+    fall = centre - volts[:, 2:]
+    is_max = (
+        (rise > 0)
+        & (fall > 0)
+        & (rise > delta)
+        & (fall > delta)
+        & (centre >= peak_threshold)
+    )
+    rows, columns = np.nonzero(is_max)
+    columns = columns + 1
+
+    maxima = [rows, columns, times[columns], volts[rows, columns]]
+
+    minima = [np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0), np.empty(0)]
+    consecutive = np.flatnonzero(rows[1:] == rows[:-1])
+    if len(consecutive) > 0:
+        positions = rows * n_samples + columns
+        values, found = _segment_extrema(
+            volts.ravel(),
+            positions[consecutive],
+            positions[consecutive + 1],
+            maximum=False,
+            last=False,
+        )
+        trough_columns = found % n_samples
+        minima = [rows[consecutive], trough_columns, times[trough_columns], values]
+
+    return SpikeBatch(n_traces, maxima, minima)
+
+
+def phase_plane(t, volts, dvdt_threshold=None):
+    """
+    Return the phase plane points (V, dV/dt) of one trace or of every row
+    of a (traces x samples) array, as in pyelectro's phase_plane, along with
+    a mask of the points whose dV/dt exceeds dvdt_threshold (all points if
+    it is None).
+    """
+    volts = np.asarray(volts, dtype=float)
+    dvdt = np.diff(volts, axis=-1) / np.diff(np.asarray(t, dtype=float))
+    v = volts[..., :-1]
+    if dvdt_threshold is None:
+        selected = np.ones(dvdt.shape, dtype=bool)
+    else:
+        selected = dvdt > dvdt_threshold
+    return v, dvdt, selected
+
+
+def _bin_indices(x, edges):
+    """
+    Return the histogram bin of each value of x and whether it lies within
+    the evenly spaced edges, following numpy.histogram (the last bin is
+    closed on the right).
+    """
+    bins = len(edges) - 1
+    inside = (x >= edges[0]) & (x <= edges[-1])
+    index = ((x - edges[0]) * (bins / (edges[-1] - edges[0]))).astype(int)
+    np.clip(index, 0, bins - 1, out=index)
+    # correct rounding, as numpy.histogram does
+    index[x < edges[index]] -= 1
+    index[(x >= edges[index + 1]) & (index != bins - 1)] += 1
+    return index, inside
+
+
+class PhasePlaneDensity(object):
+    """
+    Phase plane trajectory density (PPTD) of a target trace, the
+    normalised 2-D histogram of its dV/dt vs. V points (Van Geit et al.
+    2007), against which model traces are scored.
+
+    The target histogram is built once; the histograms of model traces use
+    the same bins, and those of a whole batch of traces are computed in a
+    single vectorized binning pass.
+
+    :param t: time-vector of the target trace
+    :param v: target trace
+    :param bins: number of bins along each axis
+    :param dvdt_threshold: only points with a greater dV/dt are counted
+    """
+
+    def __init__(self, t, v, bins=10, dvdt_threshold=None):
+
+        self.bins = bins
+        self.dvdt_threshold = dvdt_threshold
+
+        v_points, dvdt, selected = phase_plane(t, v, dvdt_threshold)
+        density, self.dvdt_edges, self.v_edges = np.histogram2d(
+            dvdt[selected], v_points[selected], bins=bins
+        )
+        self.density = density / density.sum()
+
+    @classmethod
+    def from_csv(cls, path, bins=10, dvdt_threshold=None):
+        """
+        Build the density of the target trace stored in a CSV file, as read
+        by pyelectro's load_csv_data.
+        """
+        t, v = analysis.load_csv_data(path)
+        return cls(t, v, bins=bins, dvdt_threshold=dvdt_threshold)
+
+    def densities(self, t, volts):
+        """
+        Return the normalised densities of every row of a (traces x samples)
+        array, as a (traces x bins x bins) array. Points outside the target's
+        bins are not counted; traces without any point inside get a zero
+        density.
+        """
+        volts = np.atleast_2d(volts)
+        n_traces = volts.shape[0]
+        v_points, dvdt, selected = phase_plane(t, volts, self.dvdt_threshold)
+
+        rows = np.repeat(np.arange(n_traces), selected.sum(axis=1))
+        dvdt = dvdt[selected]
+        v_points = v_points[selected]
+
+        dvdt_index, dvdt_inside = _bin_indices(dvdt, self.dvdt_edges)
+        v_index, v_inside = _bin_indices(v_points, self.v_edges)
+        counted = dvdt_inside & v_inside
+
+        flat_bins = (
+            rows[counted] * self.bins + dvdt_index[counted]
+        ) * self.bins + v_index[counted]
+        counts = np.bincount(flat_bins, minlength=n_traces * self.bins * self.bins)
+        counts = counts.reshape(n_traces, self.bins, self.bins).astype(float)
+
+        totals = counts.sum(axis=(1, 2))
+        totals[totals == 0] = 1.0
+        return counts / totals[:, np.newaxis, np.newaxis]
+
+    def errors(self, t, volts):
+        """
+        Return the PPTD error of every row of a (traces x samples) array:
+        the square of the summed square roots of the absolute differences
+        between the target and trace densities.
+        """
+        difference = np.abs(self.density - self.densities(t, volts))
+        return np.sum(np.sqrt(difference), axis=(1, 2)) ** 2
+
+    def error(self, t, v):
+        """
+        Return the PPTD error of a single trace.
+        """
+        return float(self.errors(t, np.asarray(v, dtype=float)[np.newaxis, :])[0])
+
+
+#: IClampAnalysis features computed by BatchIClampAnalysis
+BATCH_ICLAMP_FEATURES = frozenset(
+    [
+        "average_minimum",
+        "average_maximum",
+        "min_peak_no",
+        "max_peak_no",
+        "mean_spike_frequency",
+        "interspike_time_covar",
+        "first_spike_time",
+        "max_interspike_time",
+        "min_interspike_time",
+        "pptd_error",
+    ]
+)
+
+
+class TraceResults(object):
+    """
+    Analysis results of one trace of a batch, standing in for an
+    IClampAnalysis in the evaluators (analysable_data and analysis_results).
+    """
+
+    def __init__(self, analysis_results, analysable):
+        self.analysis_results = analysis_results
+        self._analysable = analysable
+
+    @property
+    def analysable_data(self):
+        return self._analysable
+
+    @analysable_data.setter
+    def analysable_data(self, val):
+        self._analysable = False
+
+
+class BatchIClampAnalysis(object):
+    """
+    Vectorized counterpart of pyelectro's IClampAnalysis for a batch of
+    traces sharing one time axis.
+
+    Peaks and troughs of all traces are found at once (see max_min_batch),
+    and the BATCH_ICLAMP_FEATURES computed for all traces with array
+    operations. The results match IClampAnalysis.analyse within floating
+    point tolerance. pptd_error is computed if a PhasePlaneDensity of the
+    target data is given.
+
+    :param volts: (traces x samples) array of voltage traces
+    :param t: time-vector
+    :param analysis_var: dictionary containing parameters to be used in
+        analysis (peak_delta, peak_threshold, baseline, dvdt_threshold)
+    :param start_analysis: time in t where analysis is to start
+    :param end_analysis: time in t where analysis is to end
+    :param pptd_density: PhasePlaneDensity of the target data
+    """
+
+    def __init__(
+        self,
+        volts,
+        t,
+        analysis_var,
+        start_analysis=0,
+        end_analysis=None,
+        pptd_density=None,
+    ):
+
+        volts = np.asarray(volts, dtype=float)
+        t = np.asarray(t, dtype=float)
+        if volts.ndim != 2 or volts.shape[1] != len(t):
+            raise ValueError(
+                "Expected a (traces x %i) array of traces, not %s"
+                % (len(t), volts.shape)
+            )
+
+        # same window as TraceAnalysis, which excludes the end sample
+        if end_analysis is None:
+            end_analysis = t[-1]
+        start_index = _nearest_index(t, start_analysis)
+        end_index = _nearest_index(t, end_analysis)
+
+        self.t = t[start_index:end_index]
+        self.volts = volts[:, start_index:end_index]
+
+        self.delta = analysis_var["peak_delta"]
+        self.baseline = analysis_var["baseline"]
+        self.dvdt_threshold = analysis_var["dvdt_threshold"]
+        self.pptd_density = pptd_density
+
+        self.spikes = max_min_batch(
+            self.volts, self.t, self.delta, analysis_var.get("peak_threshold")
+        )
+
+        if self.volts.shape[1] > 0:
+            maximum = self.volts.max(axis=1)
+            minimum = self.volts.min(axis=1)
+        else:
+            maximum = np.full(len(self.volts), np.nan)
+            minimum = np.full(len(self.volts), np.nan)
+
+        # same criteria as IClampAnalysis.analysable_data
+        self.analysable_data = (
+            (self.spikes.maxima_number >= 3)
+            & (maximum <= 100.0)
+            & (minimum <= -5.0)
+            & (maximum >= 10.0)
+        )
+
+        self.analysis_results = None
+
+    def analyse(self):
+        """
+        Compute the features of all traces, as a dict of feature name vs.
+        array of values (NaN for traces which are not analysable).
+        """
+        analysis_results = self.spikes.spike_features()
+        if self.pptd_density is not None:
+            analysis_results["pptd_error"] = self.pptd_errors()
+        for feature, values in analysis_results.items():
+            values = values.astype(float)
+            values[~self.analysable_data] = np.nan
+            analysis_results[feature] = values
+
+        self.analysis_results = analysis_results
+        return analysis_results
+
+    def pptd_errors(self):
+        """
+        Return the PPTD error of every trace, computing those of the traces
+        one at a time if the batch fails; infinity (the worst cost) for the
+        traces whose error cannot be computed.
+        """
+        try:
+            return self.pptd_density.errors(self.t, self.volts)
+        except:
+            errors = np.full(len(self.volts), np.inf)
+            for index, v in enumerate(self.volts):
+                try:
+                    errors[index] = self.pptd_density.error(self.t, v)
+                except:
+                    print("Cannot compute the PPTD error, setting it to infinity")
+            return errors
+
+    def trace(self, index):
+        """
+        Return the TraceResults of one trace, with the analysis_results
+        IClampAnalysis would have given for the BATCH_ICLAMP_FEATURES.
+        """
+        if self.analysis_results is None:
+            self.analyse()
+
+        if not self.analysable_data[index]:
+            return TraceResults({}, False)
+
+        analysis_results = dict(
+            (feature, values[index])
+            for feature, values in self.analysis_results.items()
+        )
+        for count in ("min_peak_no", "max_peak_no"):
+            analysis_results[count] = int(analysis_results[count])
+        return TraceResults(analysis_results, True)
+
+
+def _target_ref(target):
+    """Reference of the cell a NetworkAnalysis target refers to, e.g. cell0"""
+    return target.rsplit(":", 1)[0]
+
+
+class BatchNetworkAnalysis(object):
+    """
+    Vectorized counterpart of pyelectro's NetworkAnalysis, for the traces
+    of all population members held in one (members x samples) array.
+
+    Spikes are detected and the common spike features computed for all
+    members at once; only members mentioned in the targets are analysed.
+    analyse gives the same analysis_results as NetworkAnalysis.analyse,
+    within floating point tolerance.
+
+    :param volts: (members x samples) array of voltage traces
+    :param t: time-vector
+    :param analysis_var: dictionary containing parameters to be used in
+        analysis such as the peak_threshold
+    :param refs: reference of each member, e.g. cell0
+    :param start_analysis: time t where analysis is to start
+    :param end_analysis: time in t where analysis is to end
+    """
+
+    def __init__(
+        self, volts, t, analysis_var, refs, start_analysis=0, end_analysis=None
+    ):
+
+        volts = np.asarray(volts, dtype=float)
+        t = np.asarray(t, dtype=float)
+        if volts.shape != (len(refs), len(t)):
+            raise ValueError(
+                "Expected a (%i x %i) array of traces, not %s"
+                % (len(refs), len(t), volts.shape)
+            )
+
+        start_index = _nearest_index(t, start_analysis)
+        if end_analysis is None:
+            end_index = len(t) - 1
+        else:
+            end_index = _nearest_index(t, end_analysis)
+
+        self.t = t[start_index : end_index + 1]
+        self.volts = volts[:, start_index : end_index + 1]
+        self.refs = list(refs)
+        self.analysis_var = analysis_var
+        self.delta = analysis_var["peak_delta"]
+        self.baseline = analysis_var["baseline"]
+        self.peak_threshold = analysis_var.get("peak_threshold")
+
+    def analyse(self, targets=None):
+        """Analyses and puts all results into a dict, as NetworkAnalysis.analyse"""
+
+        if targets is None:
+            rows = list(range(len(self.refs)))
+            wanted = dict((ref, None) for ref in self.refs)
+        else:
+            wanted = {}
+            for target in targets:
+                wanted.setdefault(_target_ref(target), set()).add(target)
+            rows = [i for i, ref in enumerate(self.refs) if ref in wanted]
+
+        volts = self.volts[rows]
+        spikes = max_min_simple_batch(volts, self.t, self.peak_threshold)
+        batch_features = spikes.spike_features()
+        maximum = volts.max(axis=1) if volts.shape[1] > 0 else None
+        minimum = volts.min(axis=1) if volts.shape[1] > 0 else None
+
+        analysis_results = {}
+
+        for i, row in enumerate(rows):
+            ref = self.refs[row]
+            pre = "%s:" % ref
+            ref_targets = wanted[ref]
+
+            def want(feature):
+                return ref_targets is None or pre + feature in ref_targets
+
+            def add(feature, value):
+                if want(feature):
+                    analysis_results[pre + feature] = value
+
+            if maximum is not None:
+                add("maximum", maximum[i])
+                add("minimum", minimum[i])
+
+            maxima_number = int(spikes.maxima_number[i])
+            add("min_peak_no", int(spikes.minima_number[i]))
+            add("max_peak_no", maxima_number)
+
+            if maxima_number >= 1:
+                add("average_maximum", batch_features["average_maximum"][i])
+                add("first_spike_time", batch_features["first_spike_time"][i])
+            if spikes.minima_number[i] >= 1:
+                add("average_minimum", batch_features["average_minimum"][i])
+
+            if maxima_number >= 3:
+                add("mean_spike_frequency", batch_features["mean_spike_frequency"][i])
+                add("interspike_time_covar", batch_features["interspike_time_covar"][i])
+                add("max_interspike_time", batch_features["max_interspike_time"][i])
+                add("min_interspike_time", batch_features["min_interspike_time"][i])
+
+                # the remaining spike features are fits, computed per member
+                fitted = [
+                    pre + feature
+                    for feature in (
+                        "trough_phase_adaptation",
+                        "peak_decay_exponent",
+                        "spike_frequency_adaptation",
+                        "trough_decay_exponent",
+                        "peak_linear_gradient",
+                    )
+                    if want(feature)
+                ]
+                if fitted:
+                    analysis_results.update(
+                        network_spike_features(
+                            spikes.max_min_dictionary(i), pre, fitted
+                        )
+                    )
+                if want("spike_broadening") or want("spike_width_adaptation"):
+                    self._spike_width_features(
+                        i, row, spikes, pre, want, analysis_results
+                    )
+            else:
+                add("mean_spike_frequency", 0)
+
+            if want("average_last_1percent"):
+                num_points_to_ave = int(self.volts.shape[1] / 100.0)
+                if num_points_to_ave > 0:
+                    analysis_results[pre + "average_last_1percent"] = np.mean(
+                        self.volts[row, -num_points_to_ave:]
+                    )
+
+            for target in ref_targets or []:
+                feature = target[len(pre) :]
+                if feature.startswith("value_"):
+                    # e.g. cell0:value_100 => value at 100ms
+                    target_time = float(feature.split("_")[1])
+                    index = np.searchsorted(self.t, target_time, side="left") - 1
+                    if index >= 0:
+                        analysis_results[target] = self.volts[row, index]
+                elif _average_window(feature) is not None:
+                    # e.g. cell0:average_100_200 => average value between 100ms & 200ms
+                    start_time, end_time = _average_window(feature)
+                    inside = (self.t >= start_time) & (self.t <= end_time)
+                    if inside.any():
+                        analysis_results[target] = np.mean(self.volts[row, inside])
+
+        self.analysis_results = analysis_results
+        return analysis_results
+
+    def _spike_width_features(self, i, row, spikes, pre, want, analysis_results):
+        spike_width_list = analysis.spike_widths(
+            self.volts[row],
+            self.t,
+            spikes.max_min_dictionary(i),
+            self.baseline,
+            self.delta,
+        )
+        if len(spike_width_list) >= 2 and len(spike_width_list[0]) > 0:
+            if want("spike_broadening"):
+                analysis_results[pre + "spike_broadening"] = analysis.spike_broadening(
+                    spike_width_list[1]
+                )
+            if want("spike_width_adaptation"):
+                try:
+                    analysis_results[pre + "spike_width_adaptation"] = analysis.exp_fit(
+                        spike_width_list[0], spike_width_list[1]
+                    )
+                except:
+                    pass
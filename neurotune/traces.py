@@ -0,0 +1,510 @@
+"""
+Containers for the simulation data passed from controllers to evaluators.
+
+A controller's run method traditionally returns a list of [times, samples]
+pairs, one per candidate. A TraceBatch holds the same data as one time
+vector shared by all candidates and a single contiguous
+(candidates x channels x samples) array, so a generation of traces costs
+no per-element Python objects and no duplicated time axes. It can still be
+indexed and iterated like the list of [times, samples] pairs, so evaluators
+and analysis code written for lists keep working.
+
+Traces simulated in worker processes can be handed back through shared
+memory (see write_shared_trace), so that only a small SharedTraceHandle is
+pickled and the parent reads the samples without copying them.
+
+A TraceStore keeps the traces and extracted features of every evaluated
+candidate on disk, so that an optimization can be rescored with other
+weights or targets without simulating again.
+"""
+
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+
+class TraceBatch(object):
+    """
+    Traces of a batch of simulations sharing one time axis.
+
+    :param times: 1-D array of sample times, shared by all traces
+    :param samples: array of shape (candidates, channels, samples), or
+        (candidates, samples) for single channel recordings
+    :param channels: optional list of channel names (e.g. cell references
+        in a network). With channel names, indexing the batch gives a dict
+        of channel name vs. trace for each candidate, as expected by
+        pyelectro's NetworkAnalysis
+    :param aborted: optional boolean array flagging simulations stopped by
+        an abort predicate; these are given None samples when indexed
+    :param dtype: storage type of the samples, e.g. numpy.float32 to halve
+        memory use. Defaults to the type of samples
+    """
+
+    def __init__(self, times, samples, channels=None, aborted=None, dtype=None):
+
+        self.times = np.asarray(times)
+
+        samples = np.asarray(samples, dtype=dtype)
+        if samples.ndim == 2:
+            samples = samples[:, np.newaxis, :]
+        if samples.ndim != 3:
+            raise ValueError(
+                "TraceBatch samples must have shape (candidates, channels, samples), not %s"
+                % (samples.shape,)
+            )
+        if samples.shape[2] != len(self.times):
+            raise ValueError(
+                "Traces have %i samples but the time axis has %i"
+                % (samples.shape[2], len(self.times))
+            )
+        self.samples = samples
+
+        if channels is not None:
+            channels = list(channels)
+            if len(channels) != samples.shape[1]:
+                raise ValueError(
+                    "%i channel names given for %i channels"
+                    % (len(channels), samples.shape[1])
+                )
+        self.channels = channels
+
+        if aborted is None:
+            aborted = np.zeros(samples.shape[0], dtype=bool)
+        self.aborted = np.asarray(aborted, dtype=bool)
+
+    @classmethod
+    def empty(cls, n_candidates, times, channels=None, n_channels=1, dtype=np.float64):
+        """
+        Allocate a batch to be filled in by a controller, one candidate at a time.
+
+        :param n_candidates: number of candidates in the batch
+        :param times: time axis shared by all traces
+        :param channels: optional list of channel names
+        :param n_channels: number of channels, if no channel names are given
+        :param dtype: storage type of the samples
+        """
+        if channels is not None:
+            n_channels = len(channels)
+        samples = np.empty((n_candidates, n_channels, len(times)), dtype=dtype)
+        return cls(times, samples, channels=channels)
+
+    @classmethod
+    def from_traces(cls, traces, channels=None, dtype=None):
+        """
+        Build a batch from a list of [times, samples] pairs sharing one time axis.
+
+        Samples may be arrays, lists or (for multichannel data) dicts of
+        channel name vs. trace; None marks an aborted simulation.
+        """
+        completed = [data for data in traces if data[1] is not None]
+        if len(completed) == 0:
+            times = []
+        else:
+            times = completed[0][0]
+            for data in completed[1:]:
+                if not np.array_equal(data[0], times):
+                    raise ValueError("Traces do not share the same time axis")
+
+        if (
+            channels is None
+            and len(completed) > 0
+            and isinstance(completed[0][1], dict)
+        ):
+            channels = list(completed[0][1].keys())
+
+        n_channels = 1 if channels is None else len(channels)
+        batch = cls.empty(
+            len(traces),
+            times,
+            channels=channels,
+            n_channels=n_channels,
+            dtype=np.float64 if dtype is None else dtype,
+        )
+
+        for index, data in enumerate(traces):
+            batch.set_trace(index, data[1])
+
+        return batch
+
+    def set_trace(self, index, samples):
+        """
+        Store the samples of candidate index; None marks it as aborted.
+        """
+        if samples is None:
+            self.aborted[index] = True
+        elif isinstance(samples, dict):
+            for k, channel in enumerate(self.channels):
+                self.samples[index, k, :] = samples[channel]
+        else:
+            self.samples[index, 0, :] = samples
+
+    def channel(self, channel=0):
+        """
+        Return a (candidates x samples) view of one channel, given by index or name.
+        """
+        if isinstance(channel, str):
+            channel = self.channels.index(channel)
+        return self.samples[:, channel, :]
+
+    @property
+    def nbytes(self):
+        """Memory used by the time axis and the samples"""
+        return self.times.nbytes + self.samples.nbytes
+
+    def __len__(self):
+        return self.samples.shape[0]
+
+    def __getitem__(self, index):
+        """
+        Return [times, samples] for one candidate, without copying.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TraceBatch index out of range")
+
+        if self.aborted[index]:
+            return [self.times, None]
+
+        if self.channels is None and self.samples.shape[1] == 1:
+            return [self.times, self.samples[index, 0]]
+
+        channels = self.channels
+        if channels is None:
+            channels = range(self.samples.shape[1])
+        return [
+            self.times,
+            dict(
+                (channel, self.samples[index, k]) for k, channel in enumerate(channels)
+            ),
+        ]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class RecordingSpec(object):
+    """
+    The part of each simulation an evaluator actually analyses.
+
+    Evaluators publish a RecordingSpec to their controller (see the
+    controllers' set_recording_spec), which should then only record, keep
+    and return that part of the traces.
+
+    :param start: time from which samples are needed; None for the start of
+        the simulation
+    :param end: time up to which samples are needed; None for the end of
+        the simulation
+    :param dt: sampling interval needed; None for the simulation's own
+        resolution
+    :param channels: names of the channels needed (e.g. cell references in
+        a network); None for all channels
+    """
+
+    def __init__(self, start=None, end=None, dt=None, channels=None):
+
+        self.start = start
+        self.end = end
+        self.dt = dt
+        self.channels = None if channels is None else list(channels)
+
+    def __repr__(self):
+        return "RecordingSpec(start=%s, end=%s, dt=%s, channels=%s)" % (
+            self.start,
+            self.end,
+            self.dt,
+            self.channels,
+        )
+
+    @classmethod
+    def union(cls, specs):
+        """
+        Return a spec covering everything needed by all of specs, or None
+        if one of them needs the full traces.
+        """
+        specs = list(specs)
+        if len(specs) == 0 or any(spec is None for spec in specs):
+            return None
+
+        def widest(values, pick):
+            if any(value is None for value in values):
+                return None
+            return pick(values)
+
+        channels = None
+        if all(spec.channels is not None for spec in specs):
+            channels = sorted(set(c for spec in specs for c in spec.channels))
+
+        return cls(
+            start=widest([spec.start for spec in specs], min),
+            end=widest([spec.end for spec in specs], max),
+            dt=widest([spec.dt for spec in specs], min),
+            channels=channels,
+        )
+
+    def wants_channel(self, channel):
+        return self.channels is None or channel in self.channels
+
+    def sample_slice(self, times):
+        """
+        Return the slice of a trace sampled at (evenly spaced) times which
+        the spec needs.
+
+        Samples within half a step of start and end are kept, so that
+        analyses looking for the sample nearest to those times find the
+        same one as in the full trace.
+        """
+        times = np.asarray(times)
+        if len(times) < 2:
+            return slice(0, len(times))
+
+        step = times[1] - times[0]
+        first = 0
+        last = len(times)
+        if self.start is not None:
+            first = int(np.searchsorted(times, self.start - step / 2, side="left"))
+        if self.end is not None:
+            last = int(np.searchsorted(times, self.end + step / 2, side="right"))
+
+        stride = 1
+        if self.dt is not None:
+            stride = max(1, int(round(self.dt / step)))
+
+        return slice(first, last, stride)
+
+    def select(self, times, samples):
+        """
+        Return views of times and samples (an array, or a dict of channel
+        name vs. array) restricted to what the spec needs.
+        """
+        window = self.sample_slice(times)
+        times = np.asarray(times)[window]
+
+        if isinstance(samples, dict):
+            samples = dict(
+                (channel, np.asarray(v)[window])
+                for channel, v in samples.items()
+                if self.wants_channel(channel)
+            )
+        elif samples is not None:
+            samples = np.asarray(samples)[window]
+
+        return times, samples
+
+
+class TraceStore(object):
+    """
+    On-disk record of evaluated candidates, their fitness and their traces
+    and/or extracted features, for rescoring without re-simulating (see
+    the evaluators' set_trace_store and IClampEvaluator.rescore).
+
+    Each evaluated generation is written to its own .npz file in the
+    directory path; traces are stored as one TraceBatch per generation.
+
+    :param path: directory of the store, created if needed
+    :param keep_traces: whether to store the traces
+    :param keep_features: whether to store the features extracted by the
+        evaluator
+    :param dtype: storage type of the samples; float32 halves the size of
+        the store
+    """
+
+    def __init__(self, path, keep_traces=True, keep_features=True, dtype=np.float32):
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.keep_traces = keep_traces
+        self.keep_features = keep_features
+        self.dtype = dtype
+
+    def _files(self):
+        return sorted(glob.glob(os.path.join(self.path, "batch_*.npz")))
+
+    def add(self, candidates, fitness, batch=None, features=None, metadata=None):
+        """
+        Store a generation of candidates with their fitness values.
+
+        :param batch: TraceBatch of their traces
+        :param features: dict of feature name vs. array of values, one per
+            candidate
+        :param metadata: JSON serialisable description of how the features
+            were extracted (e.g. analysis_var)
+        """
+        arrays = {
+            "candidates": np.asarray(candidates, dtype=float),
+            "fitness": np.asarray(fitness, dtype=float),
+        }
+        if self.keep_traces and batch is not None:
+            arrays["times"] = batch.times
+            arrays["samples"] = batch.samples.astype(self.dtype)
+            arrays["aborted"] = batch.aborted
+            if batch.channels is not None:
+                arrays["channels"] = np.array(batch.channels)
+        if self.keep_features and features:
+            for name, values in features.items():
+                arrays["feature." + name] = np.asarray(values)
+        if metadata is not None:
+            arrays["metadata"] = np.array(json.dumps(metadata, sort_keys=True))
+
+        file_name = os.path.join(self.path, "batch_%06i.npz" % len(self._files()))
+        np.savez(file_name, **arrays)
+
+    def batches(self):
+        """
+        Yield a dict for each stored generation, with the candidates and
+        fitness arrays, the TraceBatch of their traces (or None), the dict
+        of features and the metadata (or None).
+        """
+        for file_name in self._files():
+            with np.load(file_name) as data:
+                batch = None
+                if "samples" in data.files:
+                    channels = None
+                    if "channels" in data.files:
+                        channels = [str(c) for c in data["channels"]]
+                    batch = TraceBatch(
+                        data["times"],
+                        data["samples"],
+                        channels=channels,
+                        aborted=data["aborted"],
+                    )
+                metadata = None
+                if "metadata" in data.files:
+                    metadata = json.loads(str(data["metadata"]))
+                yield {
+                    "candidates": data["candidates"],
+                    "fitness": data["fitness"],
+                    "batch": batch,
+                    "features": dict(
+                        (name[len("feature.") :], data[name])
+                        for name in data.files
+                        if name.startswith("feature.")
+                    ),
+                    "metadata": metadata,
+                }
+
+    def __len__(self):
+        """Number of stored candidates"""
+        total = 0
+        for file_name in self._files():
+            with np.load(file_name) as data:
+                total += len(data["fitness"])
+        return total
+
+
+def _shared_memory(name, create=False, size=0):
+    """
+    Open (or create) a shared memory block without leaving it registered
+    with the resource tracker, which would otherwise unlink it when the
+    worker that created it exits. Blocks are unlinked by their reader.
+    """
+    from multiprocessing import resource_tracker, shared_memory
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+
+    block = shared_memory.SharedMemory(name, create=create, size=size)
+    if create:
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+def unlink_shared_trace(name):
+    """
+    Remove the shared memory block name if it exists, e.g. one written by
+    a worker which crashed before its handle was read.
+    """
+    try:
+        block = _shared_memory(name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+class SharedTraceHandle(object):
+    """
+    Picklable description of a trace written to shared memory by
+    write_shared_trace.
+
+    :param name: name of the shared memory block
+    :param layout: list of (key, dtype, shape, offset) of the arrays in
+        the block; the key is None for the time axis, and a channel name or
+        "" (single channel) for samples
+    :param aborted: whether the simulation was aborted (no samples)
+    """
+
+    def __init__(self, name, layout, aborted=False):
+        self.name = name
+        self.layout = layout
+        self.aborted = aborted
+
+    def attach(self):
+        """
+        Map the block and unlink its name, so that it disappears once
+        released, and return (block, times, samples) with times and samples
+        read-only views of it. Call block.close() once the views are no
+        longer used.
+        """
+        block = _shared_memory(self.name)
+        block.unlink()
+
+        times = None
+        samples = {}
+        for key, dtype, shape, offset in self.layout:
+            view = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+            view.flags.writeable = False
+            if key is None:
+                times = view
+            else:
+                samples[key] = view
+
+        if self.aborted:
+            samples = None
+        elif list(samples.keys()) == [""]:
+            samples = samples[""]
+
+        return block, times, samples
+
+
+def write_shared_trace(name, times, samples):
+    """
+    Copy a trace (samples being an array, a dict of channel name vs. array,
+    or None for an aborted simulation) to a new shared memory block called
+    name, and return its SharedTraceHandle.
+
+    The block outlives the writer: it is removed by the reader (see
+    SharedTraceHandle.attach) or, if the handle never arrives, by
+    unlink_shared_trace.
+    """
+    arrays = [(None, np.asarray(times))]
+    if isinstance(samples, dict):
+        arrays += [(key, np.asarray(v)) for key, v in samples.items()]
+    elif samples is not None:
+        arrays.append(("", np.asarray(samples)))
+
+    layout = []
+    size = 0
+    for key, array in arrays:
+        layout.append((key, array.dtype.str, array.shape, size))
+        # keep every array 8 byte aligned
+        size += -(-array.nbytes // 8) * 8
+
+    block = _shared_memory(name, create=True, size=max(size, 1))
+    try:
+        for (key, array), (_, dtype, shape, offset) in zip(arrays, layout):
+            view = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+            view[...] = array
+            del view
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+
+    return SharedTraceHandle(name, layout, aborted=samples is None)
@@ -7,6 +7,7 @@ rm -rf examples/*/x86_64/ examples/*/arm64
 #### Requires NEURON
 cd examples/example_1
 nrnivmodl
+python controller_check.py                   # NeuronController smoke check
 python optimization.py -nogui -silent        # run one of the examples supressing plots etc.
 
 #### Requires NEURON
@@ -16,9 +17,20 @@ python optimization.py -nogui -silent          # run one of the examples supress
 
 cd ../../examples/example_3
 python SineWaveOptimizer.py -nogui -silent   # run one of the examples supressing plots etc.
+python SineWaveStreamingCheck.py             # checks of the evaluation modes
+python SineWaveVectorizedCheck.py
+python SineWaveMultiProtocolCheck.py
+python SineWaveRacingCheck.py
+python SineWaveParallelContextCheck.py
+python SineWaveBatchSchedulerCheck.py
+python SineWaveWorkerPoolCheck.py
+python SineWavePPTDCheck.py
+python SineWaveMissingFeatureCheck.py
 
 cd ../../examples/example_4
 python SineWavePointOptimizer.py -nogui -silent   # run one of the examples supressing plots etc.
 
 cd ../../examples/example_5
 python SineWaveNetworkOptimizer.py -nogui -silent 
+python SineWaveNetworkStreamingCheck.py
+python SineWaveNetworkVectorizedCheck.py